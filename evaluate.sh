@@ -43,6 +43,10 @@ TABLE_PREFIX="naive"
 FORMAT_TYPE="json"
 SEP_START="$"
 SEP_END="$"
+# sqlite file shared by all runs to cache model responses, empty to disable
+RESPONSE_CACHE=""
+# queries generated together, one generate call per batch for local models, concurrent requests for APIs
+BATCH_SIZE=1
 
 # 确保 results 目录存在
 mkdir -p results
@@ -55,6 +59,7 @@ for ((i=0; i<max_length; i++)); do
 
     NEST_FLAG=""
     FEW_SHOT_FLAG=""
+    CACHE_FLAG=""
 
     if [ "$IS_NESTED" = true ]; then
         NEST_FLAG="--is_nested"
@@ -64,14 +69,21 @@ for ((i=0; i<max_length; i++)); do
         FEW_SHOT_FLAG="--add_examples"
     fi
 
+    if [ -n "$RESPONSE_CACHE" ]; then
+        CACHE_FLAG="--response_cache $RESPONSE_CACHE"
+    fi
+
     # 定义相关文件路径
     OUTPUT_FILE="results/${HANDLER}_${MODEL_NAME}_${TASK_NAME}_result.jsonl"
+    MANIFEST_FILE="results/${HANDLER}_${MODEL_NAME}_${TASK_NAME}_result.manifest.json"
     PASS_FILE="results/${HANDLER}_${MODEL_NAME}_${TASK_NAME}_result_pass.jsonl"
     FAIL_FILE="results/${HANDLER}_${MODEL_NAME}_${TASK_NAME}_result_fail.jsonl"
 
     # 检查是否需要运行 gen_solution.py
-    if [ ! -f "$OUTPUT_FILE" ]; then
+    # 未完成的运行（manifest 中 finished 不为 true）会从断点继续，没有 manifest 的旧结果视为已完成
+    if [ ! -f "$OUTPUT_FILE" ] || { [ -f "$MANIFEST_FILE" ] && ! grep -q '"finished": true' "$MANIFEST_FILE"; }; then
         echo "Running gen_solution.py for ${MODEL_NAME} ${TASK_NAME}..."
+        rm -f "$PASS_FILE" "$FAIL_FILE"
         python gen_solution.py \
             --retrieve_doc_num "$RETRIEVE_DOC_NUM" \
             --model_name "$MODEL_NAME" \
@@ -82,9 +94,11 @@ for ((i=0; i<max_length; i++)); do
             --format_type "$FORMAT_TYPE" \
             --sep_start "$SEP_START" \
             --sep_end "$SEP_END" \
-            $NEST_FLAG $FEW_SHOT_FLAG
+            --batch_size "$BATCH_SIZE" \
+            --resume \
+            $NEST_FLAG $FEW_SHOT_FLAG $CACHE_FLAG || continue
     else
-        echo "Skipping gen_solution.py for ${MODEL_NAME} ${TASK_NAME}, output file already exists."
+        echo "Skipping gen_solution.py for ${MODEL_NAME} ${TASK_NAME}, output file is complete."
     fi
 
     # 检查是否需要运行 result_checker.py
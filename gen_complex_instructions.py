@@ -1,6 +1,6 @@
 from string import Template
 import json
-from utils import SimilarityRecord, OpenAiGenerateResponse, HuggingFaceTokenizer
+from utils import create_similarity_record, OpenAiGenerateResponse, CachedGenerateResponse, HuggingFaceTokenizer
 from transformers import AutoTokenizer
 import random
 from openai import OpenAI
@@ -9,7 +9,9 @@ from tqdm import tqdm
 from typing import List, Dict, Iterable
 import argparse
 import copy
+import threading
 from utils.extract import extract_and_parse_jsons
+from utils.cache import ResponseCache
 from utils.prompt import COMPLEX_INSTRUCTION_SEED_PROMPT, COMPLEX_INSTRUCTION_GEN_PROMPT
 
 import logging
@@ -60,9 +62,14 @@ argparser.add_argument("--tokenizer_path", type=str, default="path/to/tokenizer"
 argparser.add_argument("--output", type=str, default="data/instructions_complex.jsonl")
 argparser.add_argument("--num_generate", type=int, default=80)
 argparser.add_argument("--similarity_threshold", type=float, default=0.75)
+argparser.add_argument("--similarity_backend", type=str, default="exact", choices=["exact", "lsh", "lsh_verify"],
+                       help="exact ROUGE-L, MinHash LSH (score is estimated jaccard) or LSH candidates re-checked with ROUGE-L")
 argparser.add_argument("--sample_num", type=int, default=8)
+argparser.add_argument("--pipeline_depth", type=int, default=0,
+                       help="if > 0, send this many batches of LLM requests concurrently while filtering the previous one")
 argparser.add_argument("--model_class", type=str, default="gpt", choices=["gpt", "deepseek"])
 argparser.add_argument("--model_name", type=str, default="gpt-4-turbo")
+argparser.add_argument("--response_cache", type=str, default="", help="sqlite file to cache LLM responses in, so a re-run does not pay again, disabled if empty")
 args = argparser.parse_args()
 
 MODEL_CLASS_MAP = {
@@ -120,18 +127,18 @@ class ApiSampler(Sampler):
         self.last_apis = []
         self.in_seed_generation_state = True
         self.data = data
+        # add_sample runs on the main thread while the pipelined collector samples in the background
+        self.lock = threading.Lock()
             
     def add_samples(self, samples_data: list[dict]):
         key = self.get_keys(self.last_apis)
-        if key not in self.apis2data:
-            self.apis2data[key] = []
-        self.apis2data[key].extend(samples_data)
+        with self.lock:
+            if key not in self.apis2data:
+                self.apis2data[key] = []
+            self.apis2data[key].extend(samples_data)
         
     def add_sample(self, sample_data: dict):
-        key = self.get_keys(self.last_apis)
-        if key not in self.apis2data:
-            self.apis2data[key] = []
-        self.apis2data[key].append(sample_data)
+        self.add_samples([sample_data])
     
     def random_sample_apis(self)->list:
         # first chose how much apis to sample
@@ -169,7 +176,8 @@ class ApiSampler(Sampler):
             self.in_seed_generation_state = False
         else:
             key = self.get_keys(apis)
-            data = self.apis2data.get(key, [])
+            with self.lock:
+                data = list(self.apis2data.get(key, []))
             examples_data = random.sample(data, min(len(data), self.seed_samples_num))
             examples_data_text = "\n".join([json.dumps(d, indent=2, ensure_ascii=False) for d in examples_data])
         return {"tools": tools_text, "examples": examples_data_text}
@@ -187,9 +195,11 @@ if __name__ == "__main__":
     tokenizer = HuggingFaceTokenizer(tokenizer)
     
 
-    records = SimilarityRecord(tokenizer)
+    records = create_similarity_record(args.similarity_backend, tokenizer, SIMILARITY_THRESHOLD)
     client = OpenAI(api_key=MODEL_CLASS_MAP[args.model_class]["api_key"], base_url=MODEL_CLASS_MAP[args.model_class]["base_url"])
     generate_response = OpenAiGenerateResponse(client=client, model=args.model_name, system_prompt="")
+    if args.response_cache:
+        generate_response = CachedGenerateResponse(generate_response, ResponseCache(args.response_cache))
     
     output_file = open(OUTPUT_FILE, "a")
     similarity_filter = SimilarityFilter(records, key="query", bound=SIMILARITY_THRESHOLD)
@@ -197,7 +207,8 @@ if __name__ == "__main__":
     
     sampler = ApiSampler(args.api_file, all_examples, seed_samples_num=7, max_api_num=3)
     collector = LLMDataCollector(INIT_PROMPT, sampler, filters,
-                                     generate_response=generate_response, verbose=True)
+                                     generate_response=generate_response, verbose=True,
+                                     pipeline_depth=args.pipeline_depth)
     
     for i in range(100):
         # this is initial collection
@@ -223,8 +234,9 @@ if __name__ == "__main__":
             num += 1
             sampler.add_sample(d)
         
-        records = SimilarityRecord(tokenizer)
-        similarity_filter.change_record(records)
+        records.clear()
+    
+    records.close()
     
 
     
@@ -1,6 +1,6 @@
 from string import Template
 import json
-from utils import SimilarityRecord, OpenAiGenerateResponse, HuggingFaceTokenizer
+from utils import create_similarity_record, OpenAiGenerateResponse, CachedGenerateResponse, HuggingFaceTokenizer, CachedTokenizer
 from transformers import AutoTokenizer
 import random
 from openai import OpenAI
@@ -9,6 +9,7 @@ from tqdm import tqdm
 from typing import List, Dict, Iterable
 import argparse
 from utils.extract import extract_and_parse_jsons
+from utils.cache import ResponseCache
 from utils.prompt import SEED_GENERATION_PROMPT, DATA_GENERATION_PROMPT
 
 import logging
@@ -57,11 +58,17 @@ argparser.add_argument("--sample_file", type=str, default="data/function_call/pr
 argparser.add_argument("--api_file", type=str, default="data/api.jsonl")
 argparser.add_argument("--tokenizer_path", type=str, default="path/to/tokenizer")
 argparser.add_argument("--output", type=str, default="data/instructions.jsonl")
+argparser.add_argument("--token_cache", type=str, default=None, help="tokenized queries cache, default to <output>.tokens.npz")
 argparser.add_argument("--num_generate", type=int, default=300)
 argparser.add_argument("--similarity_threshold", type=float, default=0.75)
+argparser.add_argument("--similarity_backend", type=str, default="exact", choices=["exact", "lsh", "lsh_verify"],
+                       help="exact ROUGE-L, MinHash LSH (score is estimated jaccard) or LSH candidates re-checked with ROUGE-L")
 argparser.add_argument("--sample_num", type=int, default=8)
+argparser.add_argument("--pipeline_depth", type=int, default=0,
+                       help="if > 0, send this many batches of LLM requests concurrently while filtering the previous one")
 argparser.add_argument("--model_class", type=str, default="gpt", choices=["gpt", "deepseek"])
 argparser.add_argument("--model_name", type=str, default="gpt-4-turbo")
+argparser.add_argument("--response_cache", type=str, default="", help="sqlite file to cache LLM responses in, so a re-run does not pay again, disabled if empty")
 args = argparser.parse_args()
 
 MODEL_CLASS_MAP = {
@@ -76,6 +83,7 @@ MODEL_CLASS_MAP = {
 }
 
 OUTPUT_FILE = args.output
+TOKEN_CACHE_FILE = args.token_cache or f"{OUTPUT_FILE}.tokens.npz"
 NUM_GENERATE = args.num_generate
 SIMILARITY_THRESHOLD = args.similarity_threshold
 SAMPLE_NUM = args.sample_num
@@ -96,7 +104,9 @@ if __name__ == "__main__":
         
     path = args.tokenizer_path
     tokenizer = AutoTokenizer.from_pretrained(path)
-    tokenizer = HuggingFaceTokenizer(tokenizer)
+    tokenizer = CachedTokenizer(HuggingFaceTokenizer(tokenizer))
+    # queries already in the output file were tokenized by the previous run
+    tokenizer.load(TOKEN_CACHE_FILE)
     
     func2instructions = {}
     if os.path.exists(args.output):
@@ -109,9 +119,11 @@ if __name__ == "__main__":
                     func2instructions[func_name] = []
                 func2instructions[func_name].append(d)
 
-    records = SimilarityRecord(tokenizer)
+    records = create_similarity_record(args.similarity_backend, tokenizer, SIMILARITY_THRESHOLD)
     client = OpenAI(api_key=MODEL_CLASS_MAP[args.model_class]["api_key"], base_url=MODEL_CLASS_MAP[args.model_class]["base_url"])
     generate_response = OpenAiGenerateResponse(client=client, model=args.model_name, system_prompt="")
+    if args.response_cache:
+        generate_response = CachedGenerateResponse(generate_response, ResponseCache(args.response_cache))
 
     with open(args.api_file) as f:
         all_tools = [json.loads(line) for line in f.readlines()]
@@ -120,10 +132,8 @@ if __name__ == "__main__":
     similarity_filter = SimilarityFilter(records, key="query", bound=SIMILARITY_THRESHOLD)
     filters = [JsonExtractor(), FormatFilter(), similarity_filter]
     for tool_idx, tool in enumerate(all_tools):
-        data = []
-        for example in func2instructions.get(tool["name"], []):
-            records.add(example["query"])
-            data.append(example)
+        data = list(func2instructions.get(tool["name"], []))
+        records.add_batch([example["query"] for example in data])
         
         initial_num = len(data)
         if initial_num >= NUM_GENERATE:
@@ -137,7 +147,8 @@ if __name__ == "__main__":
                 return {"examples": examples_text, "tool": tool_text}
         
         collector = LLMDataCollector(INIT_PROMPT, ExampleSampler(all_examples, 2), filters,
-                                     generate_response=generate_response, verbose=True)
+                                     generate_response=generate_response, verbose=True,
+                                     pipeline_depth=args.pipeline_depth)
         
         # this is initial collection
         while len(data) <= 0:
@@ -171,6 +182,8 @@ if __name__ == "__main__":
             output_file.write(json.dumps(d, ensure_ascii=False)+"\n")
             output_file.flush()
         
-        records = SimilarityRecord(tokenizer)
-        similarity_filter.change_record(records)
+        tokenizer.save(TOKEN_CACHE_FILE)
+        records.clear()
+    
+    records.close()
     
@@ -1,12 +1,16 @@
 import torch
 import json
-from typing import List
+from typing import List, Dict, Iterator
 from openai import OpenAI
 from string import Template
 from tqdm import tqdm
 import os
+import copy
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from utils.extract import extract_and_parse_jsons
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from transformers import AutoTokenizer, AutoModelForCausalLM, StoppingCriteriaList, LogitsProcessorList, TextIteratorStreamer
 import argparse
 import random
 from utils import Colors
@@ -36,6 +40,8 @@ class Handler:
         self.format_type = "json"
         self.sep_start = ""
         self.sep_end = ""
+        self.concurrency = 1
+        self.similar_examples = False
     
     def set_format_type(self, format_type: str):
         self.format_type = format_type
@@ -44,6 +50,14 @@ class Handler:
         self.sep_start = sep_start
         self.sep_end = sep_end
         
+    def set_similar_examples(self, similar_examples: bool):
+        # with add_examples, the example of each tool is the one whose query is the closest to the user query
+        self.similar_examples = similar_examples
+        
+    def set_concurrency(self, concurrency: int):
+        # max number of requests in flight in inference_batch, for the handlers of remote APIs
+        self.concurrency = concurrency
+        
     _SYSTEM_PROMPT_MAP = {
         "json": SYSTEM_PROMPT_FOR_FUNCTION_CALLING,
         "code": SYSTEM_PROMPT_FOR_FUNCTION_CALLING,
@@ -79,20 +93,28 @@ class Handler:
         "json_short": JsonFunctionCallingFormatter()
     }
         
-    def format_message(self, user_query: str, documents: List[str], is_nested: bool=False, 
-                       add_examples: bool = False) -> str:
+    # prompt formatter trees, built once per configuration
+    _USER_FORMATTERS: Dict[tuple, Formatter] = {}
+
+    def _user_formatter(self, is_nested: bool, add_examples: bool) -> Formatter:
+        key = (type(self), self.format_type, self.sep_start, self.sep_end, is_nested, add_examples, self.similar_examples)
+        user_formatter = Handler._USER_FORMATTERS.get(key)
+        if user_formatter is not None:
+            return user_formatter
         func_format_type = self.format_type
         if self.format_type in ["code", "code_short"]:
             func_format_type = "code"
         if self.format_type in ["json", "json_short"]:
             func_format_type = "json"
             
+        # copies, set_sep must not change the formatters of the other configurations
         user_formatter= Formatter(
             Handler._CALL_PROMPT_MAP[self.format_type],
             functions=FunctionFormatter(func_format_type),
-            call_format=Handler._CALL_FORMAT_MAP[self.format_type],
+            call_format=copy.copy(Handler._CALL_FORMAT_MAP[self.format_type]),
             nest_prompt=Handler._NEST_CALL_MAP[self.format_type] if is_nested else ConstantFormatter(""),
-            example=GetFunctionExampleFormatter("data/DroidCall_train.jsonl", Handler._FUNCTION_CALL_MAP[self.format_type]) if add_examples else ConstantFormatter(""),
+            example=GetFunctionExampleFormatter("data/DroidCall_train.jsonl", copy.copy(Handler._FUNCTION_CALL_MAP[self.format_type]),
+                                                self.similar_examples) if add_examples else ConstantFormatter(""),
             user_query=FieldFormatter("query"),
         )
         
@@ -100,11 +122,14 @@ class Handler:
             user_formatter.call_format.set_sep(self.sep_start, self.sep_end)
         if isinstance(user_formatter.example, GetFunctionExampleFormatter):
             user_formatter.example.call_formatter.set_sep(self.sep_start, self.sep_end)
+        Handler._USER_FORMATTERS[key] = user_formatter
+        return user_formatter
         
-        tools = [json.loads(doc) for doc in documents]
-        user_message = user_formatter.format(
+    def format_message(self, user_query: str, documents: List[str], is_nested: bool=False, 
+                       add_examples: bool = False) -> str:
+        user_message = self._user_formatter(is_nested, add_examples).format(
             query=user_query,
-            tools=tools
+            tools=load_tools(documents)
         )
         
                    
@@ -125,6 +150,10 @@ class Handler:
         # This method is used to retrive model response for each model.
         pass
     
+    def inference_batch(self, user_queries: List[str], documents: List[List[str]]) -> List[str]:
+        # responses of several queries, in order. handlers that can batch or run requests concurrently override it.
+        return [self.inference(user_query, docs) for user_query, docs in zip(user_queries, documents)]
+    
 
 class OpenAIHandler(Handler):
     def __init__(self, model_name, path, adapter_path, temperature=0.7, top_p=1, max_tokens=1000,
@@ -132,10 +161,7 @@ class OpenAIHandler(Handler):
         super().__init__(model_name, path, adapter_path, temperature, top_p, max_tokens, is_nested, add_examples)
         self.client = OpenAI()
 
-    def inference(self, user_query: str, documents: List[str]) -> str:
-        # This method is used to retrive model response for each model.
-        message = self.format_message(user_query, documents, self.is_nested, self.add_examples)
-        # print(message)
+    def _complete(self, message) -> str:
         response = self.client.chat.completions.create(
             messages=message,
             model=self.model_name,
@@ -145,6 +171,18 @@ class OpenAIHandler(Handler):
         )
         return response.choices[0].message.content
 
+    def inference(self, user_query: str, documents: List[str]) -> str:
+        # This method is used to retrive model response for each model.
+        message = self.format_message(user_query, documents, self.is_nested, self.add_examples)
+        # print(message)
+        return self._complete(message)
+    
+    def inference_batch(self, user_queries: List[str], documents: List[List[str]]) -> List[str]:
+        messages = [self.format_message(user_query, docs, self.is_nested, self.add_examples)
+                    for user_query, docs in zip(user_queries, documents)]
+        with ThreadPoolExecutor(max_workers=max(1, min(self.concurrency, len(messages)))) as executor:
+            return list(executor.map(self._complete, messages))
+
 class DeepseekHandler(OpenAIHandler):
     def __init__(self, model_name, path, adapter_path, temperature=0.7, top_p=1, max_tokens=1000,
                  is_nested: bool=False, add_examples: bool = False) -> None:
@@ -157,6 +195,10 @@ class HFCausalLMHandler(Handler):
     total_tokens = 0
     input_tokens = 0
     inference_count = 0
+    # early stopping: number of stopped samples, decode steps cut before max_tokens and their estimated time
+    early_stops = 0
+    saved_tokens = 0
+    saved_seconds = 0.0
     
     def __init__(self, model_name, path, adapter_path, temperature=0.7, top_p=1, max_tokens=1000,
                  is_nested: bool=False, add_examples: bool = False) -> None:
@@ -165,6 +207,84 @@ class HFCausalLMHandler(Handler):
         self.tok = AutoTokenizer.from_pretrained(path, trust_remote_code=True)
         self.model = AutoModelForCausalLM.from_pretrained(path, device_map="auto", trust_remote_code=True,
                                                           torch_dtype=torch.bfloat16)
+        self.prefix_cache = None
+        self.early_stop = False
+        self.constrained = False
+        self.draft = None
+        self.num_draft_tokens = 8
+        self.speculative_stats = None
+        
+    def set_speculative(self, draft_path: str = "", ngram_corpus: str = "", num_draft_tokens: int = 8):
+        """
+        greedy generation with a draft that proposes tokens the model checks in one forward pass:
+        a smaller model sharing the tokenizer if draft_path is given, else n-gram lookups in the prompt and in the
+        calls of ngram_corpus (a jsonl with answers, e.g. the training set) written in the output format.
+        only used when temperature is 0 and the output is not constrained.
+        """
+        from utils.speculative import NgramDraft, ModelDraft, SpeculativeStats, call_corpus
+        if draft_path:
+            draft_model = AutoModelForCausalLM.from_pretrained(draft_path, device_map="auto", trust_remote_code=True,
+                                                               torch_dtype=torch.bfloat16)
+            self.draft = ModelDraft(draft_model)
+        else:
+            formatter = (JsonFunctionCallingFormatter if self.format_type in ["json", "json_short"]
+                         else CodeFunctionCallingFormatter)(self.sep_start, self.sep_end)
+            self.draft = NgramDraft(call_corpus(self.tok, ngram_corpus, formatter) if ngram_corpus else [])
+        self.num_draft_tokens = num_draft_tokens
+        self.speculative_stats = SpeculativeStats()
+        
+    def _speculative(self) -> bool:
+        return self.draft is not None and self.temperature <= 0 and not self.constrained
+        
+    def set_constrained(self, constrained: bool):
+        # only let the model generate calls that parse, to the retrieved tools and their arguments
+        self.constrained = constrained
+        
+    def _grammar(self, documents: List[str]):
+        from utils.grammar import make_grammar
+        return make_grammar(self.format_type, documents, self.sep_start, self.sep_end)
+        
+    def _logits_processor(self, documents: List[List[str]], prompt_length: int):
+        if not self.constrained:
+            return None
+        from utils.grammar import GrammarLogitsProcessor
+        return GrammarLogitsProcessor(self.tok, [self._grammar(docs) for docs in documents], prompt_length,
+                                      self.model.generation_config.eos_token_id)
+        
+    def set_early_stop(self, early_stop: bool):
+        # stop generating as soon as a complete call block is emitted (sep_end or a closed json list)
+        self.early_stop = early_stop
+        
+    def _stopping_criteria(self, prompt_length: int):
+        from utils.stopping import CallBlockStoppingCriteria
+        criteria = CallBlockStoppingCriteria(self.tok, prompt_length, self.sep_start, self.sep_end,
+                                             json_format=self.format_type in ["json", "json_short"])
+        if not self.early_stop or not (criteria.sep_end or criteria.json_format):
+            return None
+        return criteria
+        
+    def _count_early_stops(self, criteria, output_lengths: List[int], elapsed: float):
+        if criteria is None:
+            return
+        seconds_per_token = elapsed / max(1, max(output_lengths))
+        for stopped, length in zip(criteria.stopped, output_lengths):
+            if stopped:
+                self.early_stops += 1
+                self.saved_tokens += self.max_tokens - length
+                self.saved_seconds += (self.max_tokens - length) * seconds_per_token
+        
+    def set_prefix_cache(self, max_entries: int):
+        # reuse the past key/values of the system prompt and of the tool docs across queries
+        from utils.serving import PrefixCache
+        self.prefix_cache = PrefixCache(self.model, max_entries) if max_entries > 0 else None
+        
+    def _prefix_positions(self, message, user_query: str) -> List[int]:
+        # char positions in the chat text where the system prompt and the tool docs (everything before the query) end
+        probe = self.tok.apply_chat_template([message[0], {"role": "user", "content": "\x00"}], tokenize=False)
+        start = probe.find("\x00")
+        if start < 0:
+            return []
+        return [start, start + message[-1]["content"].rfind(user_query)]
         
     def inference(self, user_query: str, documents: List[str]) -> str:
         # This method is used to retrive model response for each model.
@@ -174,22 +294,36 @@ class HFCausalLMHandler(Handler):
         # if "gemma-2-2b-it" in self.model_name:
         #     message = message[1:] # gemmma-2-2b-it not support system prompt
         
-        tokenized_chat = self.tok.apply_chat_template(message, tokenize=True, add_generation_prompt=True, return_tensors="pt")
+        kwargs = self._generate_kwargs()
+        if self.prefix_cache is not None:
+            from utils.serving import prefix_token_lengths
+            text = self.tok.apply_chat_template(message, tokenize=False, add_generation_prompt=True)
+            input_ids, prefix_lengths = prefix_token_lengths(self.tok, text, self._prefix_positions(message, user_query))
+            tokenized_chat = torch.tensor([input_ids])
+            kwargs["past_key_values"] = self.prefix_cache.get(input_ids, prefix_lengths)
+        else:
+            tokenized_chat = self.tok.apply_chat_template(message, tokenize=True, add_generation_prompt=True, return_tensors="pt",
+                                                           return_dict=False)
         # count input tokens
         self.input_tokens += tokenized_chat.size(1)
         
-        if self.temperature > 0:
-            outputs = self.model.generate(tokenized_chat.to(self.model.device), 
-                                        max_new_tokens=self.max_tokens, 
-                                        top_p=self.top_p, temperature=self.temperature,
-                                        do_sample=True)
+        criteria = self._stopping_criteria(tokenized_chat.size(1))
+        if criteria is not None:
+            kwargs["stopping_criteria"] = StoppingCriteriaList([criteria])
+        processor = self._logits_processor([documents], tokenized_chat.size(1))
+        if processor is not None:
+            kwargs["logits_processor"] = LogitsProcessorList([processor])
+        start = time.perf_counter()
+        if self._speculative():
+            from utils.speculative import speculative_generate
+            generated = speculative_generate(self.model, tokenized_chat[0].tolist(), self.draft, self.max_tokens,
+                                             self.model.generation_config.eos_token_id, self.num_draft_tokens,
+                                             past_key_values=kwargs.get("past_key_values"), stopping_criteria=criteria,
+                                             stats=self.speculative_stats)
+            outputs = torch.cat([tokenized_chat, torch.tensor([generated], dtype=torch.long)], dim=1)
         else:
-            self.model.generation_config.temperature=None
-            self.model.generation_config.top_p=None
-            self.model.generation_config.top_k=None
-            outputs = self.model.generate(tokenized_chat.to(self.model.device), 
-                                        max_new_tokens=self.max_tokens, 
-                                        do_sample=False, temperature=0, top_p=None, top_k=None)
+            outputs = self.model.generate(tokenized_chat.to(self.model.device), **kwargs)
+        self._count_early_stops(criteria, [outputs.size(1) - tokenized_chat.size(1)], time.perf_counter() - start)
         
         text = self.tok.decode(outputs[0][len(tokenized_chat[0]):], skip_special_tokens=True)
         # count total tokens
@@ -199,6 +333,103 @@ class HFCausalLMHandler(Handler):
         print(f"{Colors.BOLD} {prefix}\n\n{Colors.ENDC}")
         return text
     
+    def _generate_kwargs(self) -> dict:
+        if self.temperature > 0:
+            return dict(max_new_tokens=self.max_tokens, top_p=self.top_p, temperature=self.temperature, do_sample=True)
+        self.model.generation_config.temperature=None
+        self.model.generation_config.top_p=None
+        self.model.generation_config.top_k=None
+        return dict(max_new_tokens=self.max_tokens, do_sample=False, temperature=0, top_p=None, top_k=None)
+    
+    def inference_batch(self, user_queries: List[str], documents: List[List[str]]) -> List[str]:
+        if self._speculative():
+            # the drafts are per sequence, run them one by one (the method of the class, not the cached wrapper)
+            return [type(self).inference(self, user_query, docs) for user_query, docs in zip(user_queries, documents)]
+        # one left-padded generate call for the whole batch
+        prompts = [
+            self.tok.apply_chat_template(self.format_message(user_query, docs, self.is_nested, self.add_examples),
+                                         tokenize=False, add_generation_prompt=True)
+            for user_query, docs in zip(user_queries, documents)
+        ]
+        padding_side = self.tok.padding_side
+        self.tok.padding_side = "left"
+        if self.tok.pad_token is None:
+            self.tok.pad_token = self.tok.eos_token
+        inputs = self.tok(prompts, add_special_tokens=False, padding=True, return_tensors="pt").to(self.model.device)
+        self.tok.padding_side = padding_side
+        
+        kwargs = self._generate_kwargs()
+        criteria = self._stopping_criteria(inputs["input_ids"].size(1))
+        if criteria is not None:
+            kwargs["stopping_criteria"] = StoppingCriteriaList([criteria])
+        processor = self._logits_processor(documents, inputs["input_ids"].size(1))
+        if processor is not None:
+            kwargs["logits_processor"] = LogitsProcessorList([processor])
+        start = time.perf_counter()
+        outputs = self.model.generate(**inputs, **kwargs)
+        elapsed = time.perf_counter() - start
+        generated = outputs[:, inputs["input_ids"].size(1):]
+        texts = self.tok.batch_decode(generated, skip_special_tokens=True)
+        
+        # count the tokens as if every row was generated alone: no padding, output up to its first eos
+        # (rows stopped early are padded with pad tokens)
+        eos_token_id = self.model.generation_config.eos_token_id
+        if eos_token_id is None:
+            eos_token_id = self.tok.eos_token_id
+        end_ids = torch.tensor(eos_token_id, device=generated.device).flatten()
+        if criteria is not None:
+            end_ids = torch.cat([end_ids, torch.tensor([self.tok.pad_token_id], device=generated.device)])
+        ended = torch.isin(generated, end_ids)
+        output_lengths = torch.where(ended.any(dim=1), ended.int().argmax(dim=1) + 1, generated.size(1))
+        self._count_early_stops(criteria, output_lengths.tolist(), elapsed)
+        input_lengths = inputs["attention_mask"].sum(dim=1)
+        self.input_tokens += int(input_lengths.sum())
+        self.total_tokens += int((input_lengths + output_lengths).sum())
+        self.inference_count += len(prompts)
+        return texts
+    
+    def inference_stream(self, user_query: str, documents: List[str]) -> Iterator[str]:
+        """
+        yield the response piece by piece while it is generated, e.g. to start extracting calls before it ends.
+        the token counters are not updated.
+        """
+        message = self.format_message(user_query, documents, self.is_nested, self.add_examples)
+        tokenized_chat = self.tok.apply_chat_template(message, tokenize=True, add_generation_prompt=True, return_tensors="pt",
+                                                       return_dict=False)
+        # seconds to wait for the next piece before queue.Empty is raised
+        streamer = TextIteratorStreamer(self.tok, skip_prompt=True, skip_special_tokens=True, timeout=600.0)
+        kwargs = self._generate_kwargs()
+        from utils.stopping import EventStoppingCriteria
+        # generation stops once the consumer closes the stream
+        closed = threading.Event()
+        stopping = StoppingCriteriaList([EventStoppingCriteria(closed)])
+        criteria = self._stopping_criteria(tokenized_chat.size(1))
+        if criteria is not None:
+            stopping.append(criteria)
+        kwargs["stopping_criteria"] = stopping
+        processor = self._logits_processor([documents], tokenized_chat.size(1))
+        if processor is not None:
+            kwargs["logits_processor"] = LogitsProcessorList([processor])
+        errors = []
+
+        def generate():
+            try:
+                self.model.generate(tokenized_chat.to(self.model.device), **kwargs, streamer=streamer)
+            except BaseException as e:
+                errors.append(e)
+                # the streamer would wait for its end forever
+                streamer.end()
+
+        thread = threading.Thread(target=generate, daemon=True)
+        thread.start()
+        try:
+            yield from streamer
+        finally:
+            closed.set()
+            thread.join()
+        if errors:
+            raise errors[0]
+    
 
 class LoraCausalLMHandler(HFCausalLMHandler):
     def __init__(self, model_name, path, adapter_path, temperature=0.7, top_p=1, max_tokens=1000,
@@ -209,11 +440,122 @@ class LoraCausalLMHandler(HFCausalLMHandler):
         self.model = PeftModelForCausalLM.from_pretrained(self.base_model, adapter_path)
 
 
+class ServingCausalLMHandler(HFCausalLMHandler):
+    """
+    runs the generation on a ContinuousBatchingEngine (utils/serving.py) instead of model.generate,
+    so inference can be called from several threads at once and the requests are batched by the engine.
+    """
+    def __init__(self, model_name, path, adapter_path, temperature=0.7, top_p=1, max_tokens=1000,
+                 is_nested: bool=False, add_examples: bool = False, max_batch_size: int = 16) -> None:
+        super().__init__(model_name, path, adapter_path, temperature, top_p, max_tokens, is_nested, add_examples)
+        from utils.serving import ContinuousBatchingEngine
+        self.engine = ContinuousBatchingEngine(self.model, self.tok, max_batch_size=max_batch_size)
+        self._lock = threading.Lock()
+        
+    def _submit(self, user_query: str, documents: List[str]):
+        message = self.format_message(user_query, documents, self.is_nested, self.add_examples)
+        prefix = self.tok.apply_chat_template(message, tokenize=False, add_generation_prompt=True)
+        prompt_ids = self.tok(prefix, add_special_tokens=False)["input_ids"]
+        stop = None
+        if self.early_stop:
+            from utils.stopping import CallBlockDetector
+            stop = CallBlockDetector(self.sep_start, self.sep_end, json_format=self.format_type in ["json", "json_short"])
+        return self.engine.submit(prompt_ids, max_new_tokens=self.max_tokens, do_sample=self.temperature > 0,
+                                  temperature=self.temperature, top_p=self.top_p,
+                                  stop=stop if stop is not None and stop.enabled else None,
+                                  logits_processor=self._logits_processor([documents], 0))
+    
+    def _result(self, handle) -> str:
+        text = handle.result()["text"]
+        with self._lock:
+            if handle.stop is not None and handle.stop.done:
+                saved = self.max_tokens - len(handle.token_ids)
+                self.early_stops += 1
+                self.saved_tokens += saved
+                self.saved_seconds += saved * (handle.finished_at - handle.submitted_at) / max(1, len(handle.token_ids))
+            self.input_tokens += len(handle.prompt_ids)
+            self.total_tokens += len(handle.prompt_ids) + len(handle.token_ids)
+            self.inference_count += 1
+        return text
+        
+    def inference(self, user_query: str, documents: List[str]) -> str:
+        return self._result(self._submit(user_query, documents))
+    
+    def inference_batch(self, user_queries: List[str], documents: List[List[str]]) -> List[str]:
+        # submit every row before waiting so that the engine batches them
+        handles = [self._submit(user_query, docs) for user_query, docs in zip(user_queries, documents)]
+        return [self._result(handle) for handle in handles]
+    
+    def close(self):
+        self.engine.close()
+
+
+from utils.cache import ResponseCache, OccurrenceCounter
+
+def cache_inference(handler: Handler, cache: ResponseCache, deterministic_only: bool = False):
+    """
+    decorate handler.inference and handler.inference_batch with a ResponseCache, keyed on the model,
+    the formatted chat message and the sampling parameters. only the cache misses of a batch are generated.
+    deterministic_only: only cache when temperature <= 0.
+    sampled calls also key on how many times the message was already requested, so the retries of
+    a query replay different responses.
+    """
+    inference = handler.inference
+    inference_batch = handler.inference_batch
+    # the default inference_batch goes through handler.inference, which is the cached one once decorated
+    batched = type(handler).inference_batch is not Handler.inference_batch
+    occurrences = OccurrenceCounter()
+    
+    def make_key(user_query: str, documents: List[str]) -> str:
+        parts = dict(
+            handler=type(handler).__name__,
+            model=handler.model_name,
+            path=handler.path if isinstance(handler, HFCausalLMHandler) else None,
+            adapter_path=handler.adapter_path if isinstance(handler, LoraCausalLMHandler) else None,
+            message=handler.format_message(user_query, documents, handler.is_nested, handler.add_examples),
+            kwargs=dict(temperature=handler.temperature, top_p=handler.top_p, max_tokens=handler.max_tokens),
+        )
+        if getattr(handler, "constrained", False):
+            # added only when set so that the keys of unconstrained responses do not change
+            parts["kwargs"]["constrained"] = True
+        if handler.temperature > 0:
+            parts["occurrence"] = occurrences.next(ResponseCache.make_key(**parts))
+        return ResponseCache.make_key(**parts)
+    
+    def cached_inference_batch(user_queries: List[str], documents: List[List[str]]) -> List[str]:
+        if deterministic_only and handler.temperature > 0:
+            if batched:
+                return inference_batch(user_queries, documents)
+            return [inference(user_query, docs) for user_query, docs in zip(user_queries, documents)]
+        
+        keys = [make_key(user_query, docs) for user_query, docs in zip(user_queries, documents)]
+        responses = [cache.get(key) for key in keys]
+        missing = [i for i, response in enumerate(responses) if response is None]
+        if len(missing) == 1 or (missing and not batched):
+            generated = [inference(user_queries[i], documents[i]) for i in missing]
+        elif missing:
+            generated = inference_batch([user_queries[i] for i in missing], [documents[i] for i in missing])
+        else:
+            generated = []
+        for i, response in zip(missing, generated):
+            cache.put(keys[i], response)
+            responses[i] = response
+        return responses
+    
+    def cached_inference(user_query: str, documents: List[str]) -> str:
+        return cached_inference_batch([user_query], [documents])[0]
+    
+    handler.inference = cached_inference
+    handler.inference_batch = cached_inference_batch
+    return handler
+
+
 HANDLER_MAP = {
     "openai": OpenAIHandler,
     "hf_causal_lm": HFCausalLMHandler,
     "lora_causal_lm": LoraCausalLMHandler,
-    "deepseek": DeepseekHandler
+    "deepseek": DeepseekHandler,
+    "hf_serving": ServingCausalLMHandler
 }
 
 parser = argparse.ArgumentParser(description='Generate solution for the task')
@@ -221,26 +563,48 @@ parser.add_argument('--input', type=str, default='./data/DroidCall_test.jsonl',
 parser.add_argument('--retrieve_doc_num', type=int, default=2, help='Number of documents to retrieve')
 parser.add_argument('--model_name', type=str, default='gpt-4o-mini', help='model name')
 parser.add_argument('--handler', type=str, default='openai', help='Handler to use for inference',
-                    choices=["openai", "hf_causal_lm", "lora_causal_lm", "deepseek"])
+                    choices=["openai", "hf_causal_lm", "lora_causal_lm", "deepseek", "hf_serving"])
 parser.add_argument('--path', type=str, default="/data/share/Qwen2-1.5B-Instruct", help='local dir if model is in local')
 parser.add_argument('--adapter_path', type=str, default="./checkpoint/Qwen2-1.5B-Instruct", help='adapter path')
 parser.add_argument('--task_name', type=str, default='', help='task name')
-parser.add_argument('--retriever', type=str, default='fake', help='retriever to use', choices=["chromadb", "fake"])
+parser.add_argument('--retriever', type=str, default='fake', help='retriever to use', choices=["chromadb", "fake", "numpy", "hybrid", "classifier"])
+parser.add_argument('--vec_path', type=str, default="api_vec.jsonl", help='api embeddings for the numpy and hybrid retrievers, written by scripts/create_chromaDB.py')
+parser.add_argument('--embedding_path', type=str, default="/data/share/gte-small", help='embedding model of the numpy and hybrid retrievers')
+parser.add_argument('--classifier_path', type=str, default="data/intent_classifier.npz", help='model of the classifier retriever, written by scripts/train_classifier.py')
+parser.add_argument('--embedding_backend', type=str, default="torch", choices=["torch", "int8", "onnx"], help='inference of the embedding model, int8 and onnx run on cpu')
 parser.add_argument('--temperature', type=float, default=0.0, help='temperature for generation')
 parser.add_argument('--top_p', type=float, default=1, help='top_p for generation')
 parser.add_argument('--max_tokens', type=int, default=500, help='max tokens for generation')
 parser.add_argument('--is_nested', action="store_true", help='use nested function calling or not')
 parser.add_argument('--add_examples', action="store_true", help='add examples in the prompt or not')
+parser.add_argument('--similar_examples', action="store_true", help='with --add_examples, use the training example closest to the query (BM25) for each tool instead of the first one')
 parser.add_argument('--format_type', type=str, default="json", help='format type for the prompt', choices=["json", "code", "code_short", "json_short"])
 parser.add_argument('--sep_start', type=str, default="", help='start separator for function call')
 parser.add_argument('--sep_end', type=str, default="", help='end separator for function call')
+parser.add_argument('--response_cache', type=str, default="", help='sqlite file to cache model responses in, disabled if empty')
+parser.add_argument('--cache_deterministic_only', action="store_true", help='only cache responses generated with temperature 0')
+parser.add_argument('--cache_max_entries', type=int, default=100000, help='max number of cached responses')
+parser.add_argument('--batch_size', type=int, default=1, help='number of queries generated together, one generate call per batch for the local handlers')
+parser.add_argument('--concurrency', type=int, default=8, help='max concurrent requests of a batch for the openai/deepseek handlers')
+parser.add_argument('--prefix_cache', type=int, default=0, help='number of prompt prefixes (system prompt, tool docs) whose past key/values are kept for hf_causal_lm and lora_causal_lm (not hf_serving), 0 to disable')
+parser.add_argument('--early_stop', action="store_true", help='hf handlers stop generating once a complete call block is emitted (at sep_end, or the end of the json list for json formats)')
+parser.add_argument('--constrained', action="store_true", help='hf handlers only generate calls that parse in the format of format_type, to the retrieved tools and their arguments')
+parser.add_argument('--draft_model', type=str, default="", help='speculative decoding for the hf handlers with this smaller model (same tokenizer) as the draft, greedy only (not hf_serving)')
+parser.add_argument('--ngram_draft', action="store_true", help='speculative decoding for the hf handlers with n-gram lookups in the prompt and in the calls of --ngram_corpus as the draft, greedy only (not hf_serving)')
+parser.add_argument('--ngram_corpus', type=str, default="data/DroidCall_train.jsonl", help='jsonl with answers whose calls the n-gram draft looks up, empty for the prompt only')
+parser.add_argument('--num_draft_tokens', type=int, default=8, help='max tokens proposed by the draft per step')
+parser.add_argument('--resume', action="store_true", help='keep the rows of an unfinished run of the same configuration and only generate the missing ones')
 arg = parser.parse_args()
+if arg.similar_examples and not arg.add_examples:
+    parser.error("--similar_examples picks the examples of --add_examples, it does nothing without it")
+if arg.prefix_cache > 0 and arg.handler == "hf_serving":
+    parser.error("--prefix_cache is not used by the continuous batching engine of hf_serving")
 
 
 HANDLER = arg.handler # "openai"
 MODEL_NAME = arg.model_name # "gpt-4o-mini"
 
-from utils.retriever import ChromaDBRetriever, FakeRetriever, Retriever
+from utils.retriever import ChromaDBRetriever, FakeRetriever, NumpyRetriever, HybridRetriever, ClassifierRetriever, GTEEmbedding, Retriever
 
 RETRIEVER_MAP = {
     "chromadb": ChromaDBRetriever,
@@ -266,12 +630,120 @@ def check_format(ans):
         return False
     return True
 
+def solve_batch(handler: Handler, call_extractor: CallExtractor, queries: List[str],
+                documents: List[List[str]], retry_num: int = 4) -> List[list]:
+    """
+    the extracted calls of every query of a batch, in order.
+    a query whose calls are malformed is retried up to retry_num times when sampling, only the failed
+    queries of a round are sent again.
+    """
+    results = [None] * len(queries)
+    pending = list(range(len(queries)))
+    while pending and retry_num > 0:
+        if len(pending) == 1:
+            responses = [handler.inference(queries[pending[0]], documents[pending[0]])]
+        else:
+            responses = handler.inference_batch([queries[i] for i in pending], [documents[i] for i in pending])
+        failed = []
+        for i, response in zip(pending, responses):
+            print(f"{Colors.OKGREEN}response: {response}{Colors.ENDC}\n\n")
+            results[i] = [call for call in call_extractor.extract(response)]
+            if not (results[i] and all([check_format(ans) for ans in results[i]])):
+                failed.append(i)
+        retry_num -= 1
+        if arg.temperature <= 0:
+            break
+        pending = failed
+    return results
+
+def run_manifest() -> dict:
+    # everything a result row depends on, a run can only be resumed with the same values
+    return dict(
+        handler=HANDLER,
+        model_name=MODEL_NAME,
+        path=arg.path if HANDLER not in ["openai", "deepseek"] else None,
+        adapter_path=arg.adapter_path if HANDLER == "lora_causal_lm" else None,
+        input=os.path.abspath(arg.input),
+        retriever=arg.retriever,
+        retrieve_doc_num=arg.retrieve_doc_num,
+        format_type=arg.format_type,
+        sep_start=arg.sep_start,
+        sep_end=arg.sep_end,
+        is_nested=arg.is_nested,
+        add_examples=arg.add_examples,
+        temperature=arg.temperature,
+        top_p=arg.top_p,
+        max_tokens=arg.max_tokens,
+        # only recorded when set, so that the manifests of older runs still match
+        **({"constrained": True} if arg.constrained else {}),
+        **({"similar_examples": True} if arg.similar_examples else {}),
+        **(dict(vec_path=os.path.abspath(arg.vec_path), embedding_path=arg.embedding_path,
+               embedding_backend=arg.embedding_backend) if arg.retriever in ("numpy", "hybrid") else {}),
+        **(dict(classifier_path=os.path.abspath(arg.classifier_path)) if arg.retriever == "classifier" else {}),
+    )
+
+def write_atomic(path: str, text: str):
+    with open(path + ".tmp", "w") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+def load_checkpoint(output_path: str, manifest_path: str, manifest: dict) -> List[dict]:
+    """
+    the rows of a previous run of the same configuration, empty if there is none.
+    exits if the previous run was made with a different configuration.
+    """
+    if not os.path.exists(output_path):
+        return []
+    if not os.path.exists(manifest_path):
+        raise SystemExit(f"{output_path} has no manifest {manifest_path}, can not tell how it was generated. "
+                         "remove it or run without --resume")
+    with open(manifest_path) as f:
+        saved = json.load(f)
+    # keys recorded only when a flag is set have to match too, in both directions
+    keys = sorted((set(saved) | set(manifest)) - {"finished"})
+    mismatched = [f"{k}: {saved.get(k)!r} != {manifest.get(k)!r}" for k in keys if saved.get(k) != manifest.get(k)]
+    if mismatched:
+        raise SystemExit(f"refusing to resume {output_path}, it was generated with a different configuration:\n  "
+                         + "\n  ".join(mismatched))
+    with open(output_path) as f:
+        lines = [line for line in f if line.strip()]
+    rows = []
+    for n, line in enumerate(lines):
+        try:
+            rows.append(json.loads(line))
+        except json.JSONDecodeError:
+            # rows are appended, a crash can cut the last one short
+            if n != len(lines) - 1:
+                raise
+    return rows
+
 def main():
+    output_path = f"./results/{HANDLER}_{MODEL_NAME}_{arg.task_name}_result.jsonl"
+    manifest_path = output_path[:-len(".jsonl")] + ".manifest.json"
+    manifest = run_manifest()
+    done_rows = load_checkpoint(output_path, manifest_path, manifest) if arg.resume else []
+    
     handler = HANDLER_MAP[HANDLER](MODEL_NAME, arg.path, arg.adapter_path, arg.temperature, arg.top_p, arg.max_tokens,
                                    arg.is_nested, arg.add_examples)
     handler.set_format_type(arg.format_type)
     handler.set_sep(arg.sep_start, arg.sep_end)
+    handler.set_concurrency(arg.concurrency)
+    handler.set_similar_examples(arg.similar_examples)
+    if arg.prefix_cache > 0 and isinstance(handler, HFCausalLMHandler) and not isinstance(handler, ServingCausalLMHandler):
+        handler.set_prefix_cache(arg.prefix_cache)
+    if arg.early_stop and isinstance(handler, HFCausalLMHandler):
+        handler.set_early_stop(True)
+    if arg.constrained and isinstance(handler, HFCausalLMHandler):
+        handler.set_constrained(True)
+    if (arg.draft_model or arg.ngram_draft) and isinstance(handler, HFCausalLMHandler):
+        handler.set_speculative(arg.draft_model, arg.ngram_corpus if arg.ngram_draft else "", arg.num_draft_tokens)
     call_extractor = CALL_EXTRACTOR_MAP[arg.format_type]
+    cache = None
+    if arg.response_cache:
+        cache = ResponseCache(arg.response_cache, arg.cache_max_entries)
+        cache_inference(handler, cache, arg.cache_deterministic_only)
     
     all_instructions = []
     with open(arg.input, "r") as f:
@@ -282,33 +754,76 @@ def main():
     # create output directory if not exists
     if not os.path.exists("./results"):
         os.makedirs("./results")
-    output_file = open(f"./results/{HANDLER}_{MODEL_NAME}_{arg.task_name}_result.jsonl", "w")
+    write_atomic(manifest_path, json.dumps(dict(manifest, finished=False), indent=2, ensure_ascii=False))
     
-    retriever = RETRIEVER_MAP[arg.retriever](arg.input)
+    # rows of the previous run are matched to the instructions by query, a query asked n times needs n rows
+    done = {}
+    for row in done_rows:
+        done.setdefault(row["query"], []).append(row)
+    rows = [None] * len(all_instructions)
+    for i, instruction in enumerate(all_instructions):
+        if done.get(instruction["query"]):
+            rows[i] = done[instruction["query"]].pop(0)
+    todo = [i for i, row in enumerate(rows) if row is None]
+    if arg.resume:
+        print(f"resuming: {len(all_instructions) - len(todo)} of {len(all_instructions)} queries already done")
     
-    for instruction in tqdm(all_instructions):
-        query = instruction["query"]
-        documents = retriever.retrieve(query, arg.retrieve_doc_num)
-        
-        retry_num = 4
+    if arg.retriever in ("numpy", "hybrid"):
+        retriever = NumpyRetriever(arg.vec_path, GTEEmbedding(arg.embedding_path, backend=arg.embedding_backend))
+        if arg.retriever == "hybrid":
+            retriever = HybridRetriever(retriever)
+    elif arg.retriever == "classifier":
+        retriever = ClassifierRetriever(arg.classifier_path)
+    else:
+        retriever = RETRIEVER_MAP[arg.retriever](arg.input)
+    
+    # the documents of the whole file at once, the queries are embedded in batches and searched together
+    retrieved = dict(zip(todo, retriever.retrieve_many([all_instructions[i]["query"] for i in todo], arg.retrieve_doc_num)))
+    
+    # the rows of the previous run once, then every batch is appended
+    write_atomic(output_path, "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows if row is not None))
+    output = open(output_path, "a")
+    progress = tqdm(total=len(all_instructions), initial=len(all_instructions) - len(todo))
+    for start in range(0, len(todo), arg.batch_size):
+        batch = todo[start:start + arg.batch_size]
+        queries = [all_instructions[i]["query"] for i in batch]
+        documents = [retrieved[i] for i in batch]
         
-        while retry_num > 0:
-            response = handler.inference(query, documents)
-            print(f"{Colors.OKGREEN}response: {response}{Colors.ENDC}\n\n")
-            res = [call for call in call_extractor.extract(response)]
-            if res and all([check_format(ans) for ans in res]):
-                break
-            retry_num -= 1
-            if arg.temperature <= 0:
-                break
+        results = solve_batch(handler, call_extractor, queries, documents)
             
-        output_file.write(json.dumps({"query": query, "response": res, "answers": instruction["answers"]}, ensure_ascii=False) + "\n")
-        output_file.flush()
+        for i, res in zip(batch, results):
+            rows[i] = {"query": all_instructions[i]["query"], "response": res, "answers": all_instructions[i]["answers"]}
+        # a crash can only cut the last row short, load_checkpoint drops it
+        output.write("".join(json.dumps(rows[i], ensure_ascii=False) + "\n" for i in batch))
+        output.flush()
+        os.fsync(output.fileno())
+        progress.update(len(batch))
         
-    output_file.close()
-    if isinstance(handler, HFCausalLMHandler):
+    progress.close()
+    output.close()
+    # back in the order of the instructions
+    write_atomic(output_path, "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows))
+    write_atomic(manifest_path, json.dumps(dict(manifest, finished=True), indent=2, ensure_ascii=False))
+    if cache is not None:
+        print(cache.stats())
+        cache.close()
+    if isinstance(retriever, (NumpyRetriever, HybridRetriever)):
+        print((retriever.dense if isinstance(retriever, HybridRetriever) else retriever).emb_func.stats())
+    if isinstance(handler, HFCausalLMHandler) and handler.prefix_cache is not None:
+        print(handler.prefix_cache.stats())
+    if isinstance(handler, ServingCausalLMHandler):
+        handler.close()
+    if isinstance(handler, HFCausalLMHandler) and handler.inference_count > 0:
         print(f"Average tokens: {handler.total_tokens / handler.inference_count}")
         print(f"Average input tokens: {handler.input_tokens / handler.inference_count}")
+        if handler.early_stops > 0:
+            print(f"Early stopped: {handler.early_stops}/{handler.inference_count}, "
+                  f"average decode steps saved (bound, up to max_tokens): {handler.saved_tokens / handler.inference_count:.1f}, "
+                  f"average latency saved (estimated): {handler.saved_seconds / handler.inference_count:.3f}s")
+        if handler.speculative_stats is not None and handler.speculative_stats.forwards > 0:
+            stats = handler.speculative_stats.stats()
+            print(f"Speculative decoding: acceptance rate {stats['acceptance_rate']:.3f}, "
+                  f"tokens per forward pass {stats['tokens_per_forward']:.2f}")
 
 
 if __name__ == '__main__':
@@ -1,11 +1,13 @@
 import os
 os.sys.path.append(os.path.dirname(os.path.abspath(__file__))+"/../")
-from utils.retriever import ChromaDBRetriever, LLMRetriever
+from utils.retriever import ChromaDBRetriever, LLMRetriever, NumpyRetriever, HybridRetriever, ClassifierRetriever, GTEEmbedding
 from utils.planner import Planner
 from utils.executor import Executor
-from utils import HuggingfaceGenerateResponse, OpenAiGenerateResponse
+from utils import HuggingfaceGenerateResponse, OpenAiGenerateResponse, ServingGenerateResponse
 from transformers import AutoTokenizer, AutoModelForCausalLM
 from utils.prompt import SYSTEM_PROMPT_FOR_FUNCTION_CALLING, SHORT_SYSTEM_PROMPT_FOR_FUNCTION_CALLING
+from utils.speculative import NgramDraft, ModelDraft, call_corpus
+from utils.formatter import CodeFunctionCallingFormatter
 from openai import OpenAI
 
 path = "path/to/model"
@@ -14,12 +16,27 @@ if __name__ == "__main__":
     tokenizer = AutoTokenizer.from_pretrained(path)
     model = AutoModelForCausalLM.from_pretrained(path, device_map="auto", trust_remote_code=True)
     llm = HuggingfaceGenerateResponse(tokenizer, model, SHORT_SYSTEM_PROMPT_FOR_FUNCTION_CALLING)
+    # speculative decoding, the draft proposes tokens from the prompt and the training calls (or a smaller model)
+    # corpus = call_corpus(tokenizer, "data/DroidCall_train.jsonl", CodeFunctionCallingFormatter("$", "$"))
+    # llm = HuggingfaceGenerateResponse(tokenizer, model, SHORT_SYSTEM_PROMPT_FOR_FUNCTION_CALLING, draft=NgramDraft(corpus))
+    # llm = HuggingfaceGenerateResponse(tokenizer, model, SHORT_SYSTEM_PROMPT_FOR_FUNCTION_CALLING,
+    #                                   draft=ModelDraft(AutoModelForCausalLM.from_pretrained("path/to/draft_model", device_map="auto")))
+    # batch the requests of concurrent callers on a continuous batching engine
+    # llm = ServingGenerateResponse(tokenizer, model, SHORT_SYSTEM_PROMPT_FOR_FUNCTION_CALLING, max_batch_size=8)
     
     # client = OpenAI()
     # llm = OpenAiGenerateResponse(client, "gpt-4o-mini", SYSTEM_PROMPT_FOR_FUNCTION_CALLING)
     
     retriever = ChromaDBRetriever("./chromaDB")
+    # exact search in memory over the embeddings written by scripts/create_chromaDB.py, without a database client
+    # retriever = NumpyRetriever("api_vec.jsonl", GTEEmbedding("/data/share/gte-small"))
+    # a repeated command is embedded once, the model quantized to int8 for the cpu
+    # retriever = NumpyRetriever("api_vec.jsonl", GTEEmbedding("/data/share/gte-small", backend="int8"))
+    # BM25 over the api docs fused with the embeddings, the names tell similar intents apart
+    # retriever = HybridRetriever(NumpyRetriever("api_vec.jsonl", GTEEmbedding("/data/share/gte-small")))
     # retriever = LLMRetriever("data/api.jsonl", llm)
+    # a linear classifier over the query words instead of a generation, trained by scripts/train_classifier.py
+    # retriever = ClassifierRetriever("data/intent_classifier.npz")
     
     executor = Executor("", verbose=True)
     planner = Planner(llm, executor, retriever, 4, verbose=True, format_type="code_short")
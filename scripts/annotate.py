@@ -9,8 +9,10 @@ PROMPT = Template(ANNOTATION_PROMPT)
 
 API_FILE = "data/api.jsonl"
 OUTPUT_FILE = "data/annotated_api.jsonl"
+CACHE_FILE = "data/annotate_cache.sqlite"
 
-from utils import JsonlSampler, JsonExtractor, OpenAiGenerateResponse, LLMDataCollector
+from utils import JsonlSampler, JsonExtractor, OpenAiGenerateResponse, CachedGenerateResponse, LLMDataCollector
+from utils.cache import ResponseCache
 from typing import List, Dict
 
 class JsonFormatSampler(JsonlSampler):
@@ -24,6 +26,8 @@ if __name__ == "__main__":
     
     client = OpenAI()
     generate_response = OpenAiGenerateResponse(client=client, model="gpt-4-turbo", system_prompt="")
+    # a re-run after a crash replays the annotations that were already paid for
+    generate_response = CachedGenerateResponse(generate_response, ResponseCache(CACHE_FILE))
     
     collector = LLMDataCollector(PROMPT, sampler, [extractor], generate_response)
     
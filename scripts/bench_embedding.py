@@ -0,0 +1,63 @@
+import os
+os.sys.path.append(os.path.dirname(os.path.abspath(__file__))+"/../")
+import json
+import time
+import argparse
+import numpy as np
+
+from utils.retriever import GTEEmbedding
+
+parser = argparse.ArgumentParser(description="embedding time of the test queries, one padded batch with autograd before against length sorted micro batches, int8 and the query cache")
+parser.add_argument("--embedding_path", type=str, default="/data/share/gte-small")
+parser.add_argument("--input", type=str, default="data/DroidCall_test.jsonl")
+parser.add_argument("--num_queries", type=int, default=200)
+parser.add_argument("--batch_size", type=int, default=32)
+parser.add_argument("--repeat", type=int, default=3, help="times each query is asked, as the same instruction in several runs or a repeated command")
+args = parser.parse_args()
+
+
+def legacy_embed(emb: GTEEmbedding, texts):
+    # GTEEmbedding.__call__ before, every text padded to the longest and the graph kept for backward
+    batch_dict = emb.tokenizer(texts, max_length=512, padding=True, truncation=True, return_tensors='pt')
+    outputs = emb.model(**batch_dict.to(emb.model.device))
+    return GTEEmbedding.average_pool(outputs.last_hidden_state, batch_dict['attention_mask']).tolist()
+
+
+def timed(embed, texts):
+    start = time.perf_counter()
+    embeddings = embed(texts)
+    return time.perf_counter() - start, np.asarray(embeddings, dtype=np.float32)
+
+
+def min_cosine(a, b) -> float:
+    return float(((a * b).sum(1) / np.linalg.norm(a, axis=1) / np.linalg.norm(b, axis=1)).min())
+
+
+if __name__ == "__main__":
+    with open(args.input) as f:
+        queries = [json.loads(line)["query"] for line in f][:args.num_queries]
+    reference = GTEEmbedding(args.embedding_path, cache_size=0)
+    legacy_embed(reference, queries[:4])  # warm up
+
+    batched_before, before = timed(lambda t: sum([legacy_embed(reference, t[i:i + args.batch_size])
+                                              for i in range(0, len(t), args.batch_size)], []), queries)
+    single_before, _ = timed(lambda t: [legacy_embed(reference, [q]) for q in t], queries)
+    print(f"{len(queries)} queries, batch size {args.batch_size}, each asked {args.repeat} times")
+    print(f"{'':>22} {'ms/query batched':>17} {'ms/query one by one':>20} {'min cosine':>11}")
+    print(f"{'before':>22} {batched_before / len(queries) * 1e3:>17.3f} {single_before / len(queries) * 1e3:>20.3f} {1.0:>11.6f}")
+    for backend in ["torch", "int8"]:
+        emb = GTEEmbedding(args.embedding_path, batch_size=args.batch_size, backend=backend, cache_size=0)
+        emb(queries[:4])
+        batched, after = timed(emb, queries)
+        single, _ = timed(lambda t: [emb([q]) for q in t], queries)
+        print(f"{backend:>22} {batched / len(queries) * 1e3:>17.3f} {single / len(queries) * 1e3:>20.3f} "
+              f"{min_cosine(before, after):>11.6f}")
+
+    # the retrievers embed one query at a time, a repeated one comes from the cache
+    emb = GTEEmbedding(args.embedding_path, batch_size=args.batch_size)
+    emb(queries[:4])
+    emb._cache.clear()
+    asked = [q for _ in range(args.repeat) for q in queries]
+    cached, _ = timed(lambda t: [emb([q]) for q in t], asked)
+    print(f"{'torch, cached':>22} {'':>17} {cached / len(asked) * 1e3:>20.3f}")
+    print(emb.stats())
@@ -0,0 +1,243 @@
+import os
+os.sys.path.append(os.path.dirname(os.path.abspath(__file__))+"/../")
+import io
+import json
+import time
+import random
+import argparse
+import contextlib
+
+import re
+
+from utils.extract import extract_and_parse_jsons, get_json_obj, extract_calls, convert_value, CallExtractor
+from utils.formatter import CodeFunctionCallingFormatter, JsonFunctionCallingFormatter
+
+parser = argparse.ArgumentParser(description="equivalence and speed of the json scanner and of the code call parser of utils/extract.py against the implementations they replaced, and of their incremental use (CallExtractor.feed) against extract")
+parser.add_argument("--input", type=str, default="data/instructions.jsonl", help="answers to build the responses from")
+parser.add_argument("--num_fuzz", type=int, default=20000, help="number of random texts to compare on")
+parser.add_argument("--repeat", type=int, default=3)
+parser.add_argument("--seed", type=int, default=0)
+args = parser.parse_args()
+
+
+def pyparsing_scan(text):
+    # the implementation before the scanner, kept here as the reference
+    import pyparsing as pp
+    from pyparsing import pyparsing_common as ppc
+
+    def make_keyword(kwd_str, kwd_value):
+        return pp.Keyword(kwd_str).setParseAction(pp.replaceWith(kwd_value))
+
+    if not hasattr(pyparsing_scan, "jsonDoc"):
+        RETURN_PYTHON_COLLECTIONS = True
+
+        TRUE = make_keyword("true", True)
+        FALSE = make_keyword("false", False)
+        NULL = make_keyword("null", None)
+
+        LBRACK, RBRACK, LBRACE, RBRACE, COLON = map(pp.Suppress, "[]{}:")
+
+        jsonString = pp.dblQuotedString().setParseAction(pp.removeQuotes)
+        jsonNumber = ppc.number().setName("jsonNumber")
+
+        jsonObject = pp.Forward().setName("jsonObject")
+        jsonValue = pp.Forward().setName("jsonValue")
+
+        jsonElements = pp.delimitedList(jsonValue).setName(None)
+
+        jsonArray = pp.Group(
+            LBRACK + pp.Optional(jsonElements) + RBRACK, aslist=RETURN_PYTHON_COLLECTIONS
+        ).setName("jsonArray")
+
+        jsonValue << (jsonString | jsonNumber | jsonObject | jsonArray | TRUE | FALSE | NULL)
+
+        memberDef = pp.Group(
+            jsonString + COLON + jsonValue, aslist=RETURN_PYTHON_COLLECTIONS
+        ).setName("jsonMember")
+
+        jsonMembers = pp.delimitedList(memberDef).setName(None)
+        jsonObject << pp.Dict(
+            LBRACE + pp.Optional(jsonMembers) + RBRACE, asdict=RETURN_PYTHON_COLLECTIONS
+        )
+
+        jsonComment = pp.cppStyleComment
+        jsonObject.ignore(jsonComment)
+        jsonDoc = jsonObject | jsonArray
+        pyparsing_scan.jsonDoc = jsonDoc
+    for _, l, r in pyparsing_scan.jsonDoc.scanString(text):
+        json_string = text[l:r]
+        try:
+            yield json.loads(json_string)
+        except json.JSONDecodeError as e:
+            print(f"JSON decoding error: {e}")
+        except Exception as e:
+            print(f"An error occurred: {e}")
+
+
+def pyparsing_extract_and_parse_jsons(text):
+    for parsed_data in pyparsing_scan(text):
+        if isinstance(parsed_data, list):
+            for item in parsed_data:
+                yield item
+        else:
+            yield parsed_data
+
+
+def pyparsing_get_json_obj(text):
+    for parsed_data in pyparsing_scan(text):
+        return parsed_data
+
+
+def regex_extract_calls(calls_str):
+    # the code format parser before parse_calls, kept here as the reference
+    pattern = r'result(\d+) = (\w+)\((.*?)\)'
+    for match in re.finditer(pattern, calls_str):
+        call_id, function_name, arguments_str = match.groups()
+        args_pattern = r'(\w+)=((?:\[.*?\]|{.*?}|".*?"|[^,]+))'
+        arguments = {}
+        for arg_name, arg_val in re.findall(args_pattern, arguments_str):
+            arg_val = arg_val.strip()
+            if arg_val.endswith(','):
+                arg_val = arg_val[:-1].strip()
+            arguments[arg_name] = convert_value(arg_val)
+        yield {"id": int(call_id), "name": function_name, "arguments": arguments}
+
+
+def run(extract, text):
+    # the yielded items and what was printed
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        items = list(extract(text))
+    return items, out.getvalue()
+
+
+PIECES = ["{", "}", "[", "]", ",", ":", " ", "\n", "\t", '"', '""', "\\", "\\x41", "\\u0041", "/*", "*/", "//",
+          "true", "false", "null", "NaN", "Infinity", "1", "-2", "+3", "01", ".5", "1.", "1e5", "2.5E-3", "a", "name",
+          "'", "result0", "$", "```json", "```", "{}", "[]", '{"a": 1}', "[1, 2]", '"x"']
+
+
+def random_value(rng: random.Random, depth: int = 0):
+    kind = rng.randrange(7 if depth < 3 else 4)
+    if kind == 0:
+        return rng.choice(["", "abc", "a \"q\" b", "路径/x", "tab\tin", "x\\y", "{[", "http://x.y/z"])
+    if kind == 1:
+        return rng.choice([0, -1, 12, 3.5, -0.25, 1e20, 2.5e-7])
+    if kind == 2:
+        return rng.choice([True, False, None])
+    if kind == 3:
+        return rng.choice(["#0", "ok"])
+    if kind == 4:
+        return [random_value(rng, depth + 1) for _ in range(rng.randrange(4))]
+    return {rng.choice(["id", "name", "arguments", "A", "k"]) + str(i): random_value(rng, depth + 1)
+            for i in range(rng.randrange(4))}
+
+
+def random_text(rng: random.Random) -> str:
+    parts = []
+    for _ in range(rng.randrange(1, 8)):
+        kind = rng.randrange(4)
+        if kind == 0:
+            parts.append(json.dumps(random_value(rng, 1 if rng.random() < 0.5 else 4), ensure_ascii=rng.random() < 0.5,
+                                    indent=rng.choice([None, 2])))
+        elif kind == 1:
+            # broken json: valid json with random edits
+            s = list(json.dumps([random_value(rng)], indent=rng.choice([None, 2])))
+            for _ in range(rng.randrange(1, 4)):
+                i = rng.randrange(len(s) + 1)
+                if rng.random() < 0.5 and i < len(s):
+                    del s[i]
+                else:
+                    s.insert(i, rng.choice(PIECES))
+            parts.append("".join(s))
+        elif kind == 2:
+            parts.append("".join(rng.choice(PIECES) for _ in range(rng.randrange(1, 12))))
+        else:
+            parts.append(rng.choice(["Sure, here are the calls:", "I will call the function.", "\n", " ", "$"]))
+    return rng.choice(["", " ", "\n"]).join(parts)
+
+
+def responses(path: str):
+    # responses the way chat models write them: some text, the calls in a code block, some more text
+    texts = []
+    with open(path) as f:
+        for i, line in enumerate(f):
+            answers = json.loads(line)["answers"]
+            calls = json.dumps(answers, indent=2, ensure_ascii=False)
+            texts.append(f"Sure! To do this I will call {answers[0]['name'] if answers else 'nothing'}.\n"
+                         f"```json\n{calls}\n```\n" + "Let me know if you need anything else. " * (i % 5))
+    return texts
+
+
+if __name__ == "__main__":
+    rng = random.Random(args.seed)
+    mismatches = 0
+    for k in range(args.num_fuzz):
+        # pyparsing matches on the text with its tabs expanded but the old code sliced the original text with
+        # the positions, which misaligned every match after a tab: compare on texts without tabs
+        text = random_text(rng).expandtabs()
+        expected = run(pyparsing_extract_and_parse_jsons, text)
+        got = run(extract_and_parse_jsons, text)
+        if expected != got or run(lambda t: [pyparsing_get_json_obj(t)], text) != run(lambda t: [get_json_obj(t)], text):
+            mismatches += 1
+            if mismatches <= 5:
+                print(f"mismatch on {text!r}:\n  pyparsing: {expected}\n  scanner:   {got}")
+    print(f"fuzz: {args.num_fuzz} texts, {mismatches} mismatches")
+
+    texts = responses(args.input)
+    assert all(run(pyparsing_extract_and_parse_jsons, t) == run(extract_and_parse_jsons, t) for t in texts)
+    total = sum(len(t) for t in texts)
+    print(f"corpus: {len(texts)} responses, {total / len(texts):.0f} chars on average, same results")
+    print(f"{'scanner':>10} {'ms total':>10} {'us/response':>12}")
+    for name, extract in [("pyparsing", pyparsing_extract_and_parse_jsons), ("raw_decode", extract_and_parse_jsons)]:
+        best = float("inf")
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            for text in texts:
+                for _ in extract(text):
+                    pass
+            best = min(best, time.perf_counter() - start)
+        print(f"{name:>10} {best * 1000:>10.1f} {best / len(texts) * 1e6:>12.1f}")
+
+    # code format: the gold answers as the formatter writes them, where both parsers should agree
+    formatter = CodeFunctionCallingFormatter("$", "$")
+    with open(args.input) as f:
+        answers = [json.loads(line)["answers"] for line in f]
+    calls = [formatter.format(calls=a) for a in answers]
+    differ = [text for text in calls if list(regex_extract_calls(text)) != list(extract_calls(text))]
+    print(f"\ncode calls: {len(calls)} answers, {len(differ)} parsed differently")
+    for text in differ[:5]:
+        print(f"  {text!r}\n    regex:  {list(regex_extract_calls(text))}\n    parser: {list(extract_calls(text))}")
+    for name, extract in [("regex", regex_extract_calls), ("parse", extract_calls)]:
+        exact = sum(list(extract(text)) == a for text, a in zip(calls, answers))
+        print(f"{name:>10} gives back the answers for {exact}/{len(calls)}")
+    print(f"{'parser':>10} {'ms total':>10} {'us/answer':>12}")
+    for name, extract in [("regex", regex_extract_calls), ("parse", extract_calls)]:
+        best = float("inf")
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            for text in calls:
+                for _ in extract(text):
+                    pass
+            best = min(best, time.perf_counter() - start)
+        print(f"{name:>10} {best * 1000:>10.1f} {best / len(calls) * 1e6:>12.1f}")
+
+    # incremental: the answers cut in random chunks as a model streams them, fed to the extractors
+    for kind, call_formatter in [("json", JsonFunctionCallingFormatter), ("code", CodeFunctionCallingFormatter)]:
+        call_formatter = call_formatter("```\n", "\n```")
+        extractor = CallExtractor.get_extractor(kind)
+        differ, fed = 0, 0.0
+        for a in answers:
+            text = "Sure.\n" + call_formatter.format(calls=a) + "\nAnything else?"
+            cuts = sorted(rng.sample(range(1, len(text)), min(len(text) - 1, len(text) // 4)))
+            extractor.reset()
+            streamed, first = [], None
+            for start, end in zip([0] + cuts, cuts + [len(text)]):
+                calls = extractor.feed(text[start:end])
+                if calls and first is None:
+                    first = end
+                streamed += calls
+            streamed += extractor.finish()
+            differ += streamed != list(extractor.extract(text))
+            fed += (first or len(text)) / len(text)
+        print(f"\nfed {kind}: {len(answers)} answers, {differ} differ from extract, "
+              f"the first call came after {fed / len(answers):.0%} of the text on average")
@@ -0,0 +1,40 @@
+import os
+os.sys.path.append(os.path.dirname(os.path.abspath(__file__))+"/../")
+import time
+import argparse
+from openai import OpenAI
+
+from utils import OpenAiGenerateResponse, ConcurrentOpenAiGenerateResponse
+from stub_openai_server import serve
+
+parser = argparse.ArgumentParser(description="throughput of the OpenAI response generators against a local stub server")
+parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+parser.add_argument("--num_requests", type=int, default=64)
+parser.add_argument("--latency", type=float, default=0.05, help="latency of the stub server in seconds")
+parser.add_argument("--rate_limit", type=float, default=0.0, help="fraction of requests the stub answers with 429, to exercise the backoff")
+args = parser.parse_args()
+
+if __name__ == "__main__":
+    server = serve(latency=args.latency, rate_limit=args.rate_limit, retry_after=0.05)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    client = OpenAI(api_key="stub", base_url=base_url)
+    queries = [f"query {i}" for i in range(args.num_requests)]
+
+    print(f"{'generator':>12} {'concurrency':>12} {'req/s':>10}")
+    # the sequential generator relies on the client's own retries for the 429s
+    sequential = OpenAiGenerateResponse(client.with_options(max_retries=10), "stub", "")
+    start = time.perf_counter()
+    sequential("", queries)
+    print(f"{'sequential':>12} {1:>12} {len(queries) / (time.perf_counter() - start):>10.1f}")
+
+    for concurrency in args.concurrency:
+        generate_response = ConcurrentOpenAiGenerateResponse(client, "stub", "", max_concurrency=concurrency,
+                                                             backoff=0.05)
+        start = time.perf_counter()
+        responses = generate_response("", queries)
+        elapsed = time.perf_counter() - start
+        assert [r["text"] for r in responses] == [f" {q}" for q in queries], "responses out of order"
+        print(f"{'concurrent':>12} {concurrency:>12} {len(queries) / elapsed:>10.1f}")
+        generate_response.close()
+
+    server.shutdown()
@@ -0,0 +1,88 @@
+import os
+os.sys.path.append(os.path.dirname(os.path.abspath(__file__))+"/../")
+import json
+import time
+import argparse
+import torch
+from transformers import AutoTokenizer
+
+from utils.formatter import CodeFunctionCallingFormatter, JsonFunctionCallingFormatter
+from utils.grammar import make_grammar, GrammarLogitsProcessor, TokenTable, END
+
+parser = argparse.ArgumentParser(description="per token CPU overhead of the grammar constrained decoding logits processor")
+parser.add_argument("--tokenizer_path", type=str, default="local_qwen2_tokenizer")
+parser.add_argument("--input", type=str, default="data/DroidCall_test.jsonl")
+parser.add_argument("--api_file", type=str, default="data/api.jsonl")
+parser.add_argument("--format_type", type=str, default="code_short", choices=["json", "code", "code_short", "json_short"])
+parser.add_argument("--retrieve_doc_num", type=int, default=4)
+parser.add_argument("--num_queries", type=int, default=100)
+parser.add_argument("--max_new_tokens", type=int, default=64, help="length of the random constrained outputs")
+args = parser.parse_args()
+
+
+if __name__ == "__main__":
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path)
+    apis = {}
+    with open(args.api_file) as f:
+        for line in f:
+            api = json.loads(line)
+            apis[api["name"]] = api
+    with open(args.input) as f:
+        instructions = [json.loads(line) for line in f][:args.num_queries]
+
+    start = time.perf_counter()
+    TokenTable.get(tokenizer)
+    print(f"token table: {time.perf_counter() - start:.2f}s (once per tokenizer)")
+
+    formatter = (CodeFunctionCallingFormatter if args.format_type.startswith("code") else JsonFunctionCallingFormatter)("$", "$")
+    vocab_size = len(tokenizer)
+    scores = torch.zeros(1, vocab_size)
+    # the gold answers are fed token by token as if the model generated them, which also checks that they are allowed
+    steps, allowed, seconds, cold_seconds = 0, 0, 0.0, 0.0
+    for instruction in instructions:
+        names = [answer["name"] for answer in instruction["answers"]]
+        names += [name for name in apis if name not in names][:max(0, args.retrieve_doc_num - len(names))]
+        grammar = make_grammar(args.format_type, [json.dumps(apis[name]) for name in names], "$", "$")
+        target = tokenizer(formatter.format(calls=instruction["answers"]), add_special_tokens=False)["input_ids"]
+        target.append(tokenizer.eos_token_id)
+        # the same query twice: the first pass builds the masks, the second one hits the caches
+        for rep in range(2):
+            processor = GrammarLogitsProcessor(tokenizer, [grammar], 0)
+            input_ids = torch.zeros(1, 0, dtype=torch.long)
+            for token in target:
+                start = time.perf_counter()
+                masked = processor(input_ids, scores)
+                elapsed = time.perf_counter() - start
+                if rep == 0:
+                    cold_seconds += elapsed
+                    steps += 1
+                    allowed += bool(masked[0, token] == 0)
+                else:
+                    seconds += elapsed
+                input_ids = torch.cat([input_ids, torch.tensor([[token]])], dim=1)
+
+    print(f"queries: {len(instructions)}, tokens: {steps}, gold tokens allowed: {allowed}/{steps}")
+    print(f"{'masks':>8} {'ms/token':>10}")
+    print(f"{'cold':>8} {cold_seconds / steps * 1000:>10.3f}")
+    print(f"{'cached':>8} {seconds / steps * 1000:>10.3f}")
+
+    # outputs sampled from random scores under the mask: they may only end with eos, never with a token whose
+    # text is the END sentinel of the grammar
+    generator = torch.Generator().manual_seed(0)
+    ended = 0
+    for instruction in instructions:
+        names = [answer["name"] for answer in instruction["answers"]]
+        names += [name for name in apis if name not in names][:max(0, args.retrieve_doc_num - len(names))]
+        grammar = make_grammar(args.format_type, [json.dumps(apis[name]) for name in names], "$", "$")
+        processor = GrammarLogitsProcessor(tokenizer, [grammar], 0)
+        output = []
+        for _ in range(args.max_new_tokens):
+            masked = processor(torch.tensor([output], dtype=torch.long), torch.rand(1, vocab_size, generator=generator))
+            token = int(masked[0].argmax())
+            if token in processor.eos_token_ids:
+                ended += 1
+                break
+            output.append(token)
+        text = tokenizer.decode(output)
+        assert END not in text, f"constrained output contains END: {text!r}"
+    print(f"random constrained outputs: {len(instructions)}, ended with eos: {ended}, none contains END")
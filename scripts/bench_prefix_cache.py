@@ -0,0 +1,93 @@
+import os
+os.sys.path.append(os.path.dirname(os.path.abspath(__file__))+"/../")
+import json
+import time
+import argparse
+import torch
+from transformers import AutoTokenizer, AutoModelForCausalLM, Qwen2Config, Qwen2ForCausalLM
+
+from utils.formatter import MessageTemplate
+from utils.serving import PrefixCache, prefix_token_lengths
+
+parser = argparse.ArgumentParser(description="time to first token of the hf handler prompts with and without the prefix cache")
+parser.add_argument("--path", type=str, default="", help="model to load, a tiny random Qwen2 is used if empty")
+parser.add_argument("--tokenizer_path", type=str, default="local_qwen2_tokenizer")
+parser.add_argument("--input", type=str, default="data/DroidCall_test.jsonl")
+parser.add_argument("--api_file", type=str, default="data/api.jsonl")
+parser.add_argument("--format_type", type=str, default="json", choices=["json", "code", "code_short", "json_short"])
+parser.add_argument("--retrieve_doc_num", type=int, default=4)
+parser.add_argument("--num_queries", type=int, default=50)
+parser.add_argument("--max_entries", type=int, default=16)
+parser.add_argument("--max_new_tokens", type=int, default=1, help="1 measures the time to first token")
+args = parser.parse_args()
+
+
+def tiny_model(tokenizer):
+    # big enough for the prefill to dominate, small enough for a CPU
+    torch.manual_seed(0)
+    config = Qwen2Config(vocab_size=len(tokenizer), hidden_size=256, intermediate_size=768, num_hidden_layers=4,
+                         num_attention_heads=4, num_key_value_heads=2, eos_token_id=tokenizer.eos_token_id,
+                         pad_token_id=tokenizer.pad_token_id)
+    return Qwen2ForCausalLM(config).eval()
+
+
+def build_prompts(tokenizer):
+    apis = {}
+    with open(args.api_file) as f:
+        for line in f:
+            api = json.loads(line)
+            apis[api["name"]] = api
+    with open(args.input) as f:
+        instructions = [json.loads(line) for line in f][:args.num_queries]
+
+    template = MessageTemplate.get_message_template(args.format_type)
+    template.set_function_call_sep("$", "$")
+    prompts = []
+    for instruction in instructions:
+        # a deterministic retriever: the answers and then the first other apis, so similar queries share tools
+        names = [answer["name"] for answer in instruction["answers"]]
+        names += [name for name in apis if name not in names][:max(0, args.retrieve_doc_num - len(names))]
+        message = template.format({"query": instruction["query"], "tools": [apis[name] for name in names]},
+                                  no_assistant=True)["message"]
+        text = tokenizer.apply_chat_template(message, tokenize=False, add_generation_prompt=True)
+        probe = tokenizer.apply_chat_template([message[0], {"role": "user", "content": "\x00"}], tokenize=False)
+        start = probe.find("\x00")
+        positions = [start, start + message[-1]["content"].rfind(instruction["query"])]
+        prompts.append(prefix_token_lengths(tokenizer, text, positions))
+    return prompts
+
+
+@torch.no_grad()
+def run(model, prompts, prefix_cache=None):
+    outputs = []
+    start = time.perf_counter()
+    for input_ids, prefix_lengths in prompts:
+        past_key_values = prefix_cache.get(input_ids, prefix_lengths) if prefix_cache is not None else None
+        out = model.generate(torch.tensor([input_ids]), past_key_values=past_key_values,
+                             max_new_tokens=args.max_new_tokens, do_sample=False)
+        outputs.append(out[0, len(input_ids):].tolist())
+    return (time.perf_counter() - start) / len(prompts), outputs
+
+
+if __name__ == "__main__":
+    if args.path:
+        tokenizer = AutoTokenizer.from_pretrained(args.path)
+        model = AutoModelForCausalLM.from_pretrained(args.path).eval()
+    else:
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path)
+        model = tiny_model(tokenizer)
+    prompts = build_prompts(tokenizer)
+    print(f"queries: {len(prompts)}, average prompt tokens: {sum(len(ids) for ids, _ in prompts) / len(prompts):.1f}, "
+          f"average prefix tokens: {sum(lengths[-1] for _, lengths in prompts) / len(prompts):.1f}")
+
+    run(model, prompts[:2])  # warm up
+    base_time, base_outputs = run(model, prompts)
+    prefix_cache = PrefixCache(model, args.max_entries)
+    cached_time, cached_outputs = run(model, prompts, prefix_cache)
+    same = sum(a == b for a, b in zip(base_outputs, cached_outputs))
+
+    print(f"{'mode':>14} {'ms/query':>10}")
+    print(f"{'no cache':>14} {base_time * 1000:>10.1f}")
+    print(f"{'prefix cache':>14} {cached_time * 1000:>10.1f}")
+    print(prefix_cache.stats())
+    print(f"identical outputs: {same}/{len(prompts)}")
@@ -0,0 +1,137 @@
+import os
+os.sys.path.append(os.path.dirname(os.path.abspath(__file__))+"/../")
+import sys
+import json
+import time
+import argparse
+
+parser = argparse.ArgumentParser(description="per query prompt build time of Handler.format_message, with the formatter trees, tool renderings and examples cached against building them for every query")
+parser.add_argument("--input", type=str, default="data/DroidCall_test.jsonl")
+parser.add_argument("--api_file", type=str, default="data/api.jsonl")
+parser.add_argument("--retrieve_doc_num", type=int, default=4)
+parser.add_argument("--num_queries", type=int, default=200)
+parser.add_argument("--sep_start", type=str, default="")
+parser.add_argument("--sep_end", type=str, default="")
+args = parser.parse_args()
+
+# gen_solution parses its own arguments when it is imported
+sys.argv = sys.argv[:1]
+from gen_solution import Handler
+from utils.formatter import *
+
+
+class LegacyGetFunctionExampleFormatter(Formatter):
+    # GetFunctionExampleFormatter before the ExampleStore: the file is read by every instance and every tool scans it
+    def __init__(self, examples_file: str, call_formatter: FunctionCallingFormatter) -> None:
+        super().__init__("")
+        self.examples = []
+        with open(examples_file) as f:
+            for line in f:
+                item = json.loads(line)
+                if len(item["answers"]) == 1:
+                    self.examples.append(item)
+        self.call_formatter = call_formatter
+
+    def format(self, **kwargs) -> str:
+        result_text = "Following are some examples:\n"
+        for tool in kwargs["tools"]:
+            for example in self.examples:
+                ok = False
+                for ans in example["answers"]:
+                    if ans["name"] == tool["name"]:
+                        ok = True
+                        break
+                if ok:
+                    result_text += f"query: {example['query']}\nanswers: \n{self.call_formatter.format(calls=example['answers'])}\n\n"
+                    break
+        return result_text
+
+
+def legacy_format_message(handler: Handler, user_query: str, documents: List[str], is_nested: bool = False,
+                          add_examples: bool = False):
+    # Handler.format_message before the caches and the example store, kept here as the reference
+    func_format_type = handler.format_type
+    if handler.format_type in ["code", "code_short"]:
+        func_format_type = "code"
+    if handler.format_type in ["json", "json_short"]:
+        func_format_type = "json"
+
+    user_formatter = Formatter(
+        Handler._CALL_PROMPT_MAP[handler.format_type],
+        functions=FunctionFormatter(func_format_type),
+        call_format=Handler._CALL_FORMAT_MAP[handler.format_type],
+        nest_prompt=Handler._NEST_CALL_MAP[handler.format_type] if is_nested else ConstantFormatter(""),
+        example=LegacyGetFunctionExampleFormatter("data/DroidCall_train.jsonl", Handler._FUNCTION_CALL_MAP[handler.format_type]) if add_examples else ConstantFormatter(""),
+        user_query=FieldFormatter("query"),
+    )
+    if isinstance(user_formatter.call_format, FunctionCallingFormatter):
+        user_formatter.call_format.set_sep(handler.sep_start, handler.sep_end)
+    if isinstance(user_formatter.example, LegacyGetFunctionExampleFormatter):
+        user_formatter.example.call_formatter.set_sep(handler.sep_start, handler.sep_end)
+
+    tools = [json.loads(doc) for doc in documents]
+    user_message = user_formatter.format(query=user_query, tools=tools)
+    return [
+        {"role": "system", "content": Handler._SYSTEM_PROMPT_MAP[handler.format_type]},
+        {"role": "user", "content": user_message},
+    ]
+
+
+def best_time(build, queries, repeat: int = 3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for query, docs in queries:
+            build(query, docs)
+        best = min(best, time.perf_counter() - start)
+    return best / len(queries)
+
+
+if __name__ == "__main__":
+    with open(args.api_file) as f:
+        docs = {}
+        for line in f:
+            api = json.loads(line)
+            docs[api["name"]] = json.dumps(api)
+    queries = []
+    with open(args.input) as f:
+        for line in list(f)[:args.num_queries]:
+            instruction = json.loads(line)
+            names = [answer["name"] for answer in instruction["answers"]]
+            names += [name for name in docs if name not in names][:max(0, args.retrieve_doc_num - len(names))]
+            # the retrievers return new strings for every query
+            queries.append((instruction["query"], [json.loads(json.dumps(docs[name])) for name in names]))
+
+    handler = Handler("bench", "", "")
+    handler.set_sep(args.sep_start, args.sep_end)
+    print(f"{len(queries)} queries, {args.retrieve_doc_num} tools each")
+    print(f"{'format':>11} {'examples':>9} {'before us':>10} {'after us':>10} {'speedup':>8}")
+    for format_type in ["json", "code", "code_short", "json_short"]:
+        handler.set_format_type(format_type)
+        for add_examples in [False, True]:
+            # the examples file is read for every query before, fewer queries are enough
+            sample = queries[:20] if add_examples else queries
+            for query, documents in sample:
+                assert legacy_format_message(handler, query, documents, False, add_examples) == \
+                    handler.format_message(query, documents, False, add_examples)
+            before = best_time(lambda q, d: legacy_format_message(handler, q, d, False, add_examples), sample)
+            after = best_time(lambda q, d: handler.format_message(q, d, False, add_examples), sample)
+            print(f"{format_type:>11} {str(add_examples):>9} {before * 1e6:>10.1f} {after * 1e6:>10.1f} "
+                  f"{before / after:>7.1f}x")
+
+    # the example selection alone, with the examples already in memory: a scan of the dataset per tool before
+    tools = load_tools(queries[0][1])
+    legacy = LegacyGetFunctionExampleFormatter("data/DroidCall_train.jsonl", CodeFunctionCallingFormatter())
+    indexed = GetFunctionExampleFormatter("data/DroidCall_train.jsonl", CodeFunctionCallingFormatter())
+    assert all(legacy.format(query=q, tools=load_tools(d)) == indexed.format(query=q, tools=load_tools(d)) for q, d in queries)
+    before = best_time(lambda q, d: legacy.format(query=q, tools=load_tools(d)), queries)
+    after = best_time(lambda q, d: indexed.format(query=q, tools=load_tools(d)), queries)
+    print(f"\nexample selection: scan {before * 1e6:.1f} us, index {after * 1e6:.1f} us per query")
+
+    # examples picked by the similarity of their query (BM25) instead of the first one of each tool
+    handler.set_similar_examples(True)
+    for format_type in ["json", "code"]:
+        handler.set_format_type(format_type)
+        handler.format_message(*queries[0], False, True)  # builds the index
+        similar = best_time(lambda q, d: handler.format_message(q, d, False, True), queries)
+        print(f"{format_type:>11} {'similar':>9} {'':>10} {similar * 1e6:>10.1f}")
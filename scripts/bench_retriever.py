@@ -0,0 +1,101 @@
+import os
+os.sys.path.append(os.path.dirname(os.path.abspath(__file__))+"/../")
+import json
+import time
+import zlib
+import argparse
+import tempfile
+import numpy as np
+import chromadb
+from chromadb import Documents, EmbeddingFunction, Embeddings
+
+from utils.retriever import ChromaDBRetriever, NumpyRetriever, GTEEmbedding
+from utils.formatter import FunctionFormatter
+
+parser = argparse.ArgumentParser(description="per query latency of the retrievers over the apis, with the same embedding model")
+parser.add_argument("--embedding_path", type=str, default="", help="GTE model, a sum of random word vectors is used if empty so that only the retrieval overhead is measured")
+parser.add_argument("--input", type=str, default="data/DroidCall_test.jsonl")
+parser.add_argument("--api_file", type=str, default="data/api.jsonl")
+parser.add_argument("--n_results", type=int, default=4)
+parser.add_argument("--num_queries", type=int, default=200)
+parser.add_argument("--distance_type", type=str, default="ip", choices=["ip", "l2", "cosine"])
+args = parser.parse_args()
+
+
+class HashingEmbedding(EmbeddingFunction):
+    # a deterministic stand-in for the model: the sum of a random vector per word, seeded by the word
+    def __init__(self):
+        self.vectors = {}
+
+    def __call__(self, input: Documents) -> Embeddings:
+        embeddings = np.zeros((len(input), 384), dtype=np.float32)
+        for i, text in enumerate(input):
+            for word in text.lower().split():
+                if word not in self.vectors:
+                    self.vectors[word] = np.random.RandomState(zlib.crc32(word.encode())).randn(384).astype(np.float32)
+                embeddings[i] += self.vectors[word]
+        return [embedding for embedding in embeddings]
+
+
+def per_query(retrieve, queries) -> float:
+    start = time.perf_counter()
+    results = [retrieve(query) for query in queries]
+    return (time.perf_counter() - start) / len(queries), results
+
+
+if __name__ == "__main__":
+    with open(args.api_file) as f:
+        apis = [json.loads(line) for line in f]
+    with open(args.input) as f:
+        queries = [json.loads(line)["query"] for line in f][:args.num_queries]
+    emb = GTEEmbedding(args.embedding_path) if args.embedding_path else HashingEmbedding()
+
+    # the same files as scripts/create_chromaDB.py, in a temporary directory
+    formatter = FunctionFormatter(format_type="code")
+    docs = [formatter.format(tools=[api]) for api in apis]
+    embeddings = [list(map(float, e)) for e in emb(docs)]
+    tmp = tempfile.mkdtemp()
+    with open(os.path.join(tmp, "api_vec.jsonl"), "w") as f:
+        for api, embedding in zip(apis, embeddings):
+            f.write(json.dumps({"embedding": embedding, "doc": json.dumps(api, ensure_ascii=False)}, ensure_ascii=False) + "\n")
+    collection = chromadb.PersistentClient(path=os.path.join(tmp, "chromaDB")).get_or_create_collection(
+        name="functions", metadata={"hnsw:space": args.distance_type}, embedding_function=emb)
+    collection.upsert(ids=[api["name"] for api in apis], documents=docs, embeddings=embeddings,
+                      metadatas=[{"json_str": json.dumps(api, ensure_ascii=False)} for api in apis])
+
+    start = time.perf_counter()
+    chroma = ChromaDBRetriever(os.path.join(tmp, "chromaDB"), distance_type=args.distance_type, emb_func=emb)
+    chroma_load = time.perf_counter() - start
+    start = time.perf_counter()
+    numpy_retriever = NumpyRetriever(os.path.join(tmp, "api_vec.jsonl"), emb, args.distance_type)
+    numpy_load = time.perf_counter() - start
+
+    for retriever in (chroma, numpy_retriever):
+        retriever.retrieve(queries[0], args.n_results)  # warm up
+    emb(queries)
+    embed_time, _ = per_query(lambda q: emb([q]), queries)
+    chroma_time, chroma_results = per_query(lambda q: chroma.retrieve(q, args.n_results), queries)
+    numpy_time, numpy_results = per_query(lambda q: numpy_retriever.retrieve(q, args.n_results), queries)
+    same = sum(a == b for a, b in zip(chroma_results, numpy_results))
+
+    # the whole list at once, with an empty embedding cache for both ways
+    bulk = {}
+    for name, retriever in [("chromadb", chroma), ("numpy", numpy_retriever)]:
+        for many in (False, True):
+            getattr(emb, "_cache", {}).clear()
+            start = time.perf_counter()
+            results = retriever.retrieve_many(queries, args.n_results) if many else \
+                [retriever.retrieve(query, args.n_results) for query in queries]
+            bulk[name, many] = (time.perf_counter() - start) / len(queries), results
+        assert bulk[name, True][1] == bulk[name, False][1]
+
+    print(f"{len(apis)} apis, {len(queries)} queries, top {args.n_results}, {args.distance_type}, "
+          f"embedding {'GTE' if args.embedding_path else 'random word vectors'} {embed_time * 1e3:.3f} ms/query")
+    print(f"same documents for {same}/{len(queries)} queries")
+    print(f"{'retriever':>10} {'load ms':>9} {'ms/query':>9} {'without embedding':>18}")
+    for name, load, t in [("chromadb", chroma_load, chroma_time), ("numpy", numpy_load, numpy_time)]:
+        print(f"{name:>10} {load * 1e3:>9.1f} {t * 1e3:>9.3f} {(t - embed_time) * 1e3:>18.3f}")
+    print(f"\nembedding and search of all the queries, ms/query")
+    print(f"{'retriever':>10} {'retrieve':>9} {'retrieve_many':>14}")
+    for name in ("chromadb", "numpy"):
+        print(f"{name:>10} {bulk[name, False][0] * 1e3:>9.3f} {bulk[name, True][0] * 1e3:>14.3f}")
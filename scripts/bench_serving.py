@@ -0,0 +1,64 @@
+import os
+os.sys.path.append(os.path.dirname(os.path.abspath(__file__))+"/../")
+import time
+import argparse
+import threading
+import torch
+from transformers import AutoTokenizer, AutoModelForCausalLM, Qwen2Config, Qwen2ForCausalLM
+
+from utils import HuggingfaceGenerateResponse, ServingGenerateResponse
+
+parser = argparse.ArgumentParser(description="throughput of the continuous batching engine against model.generate")
+parser.add_argument("--path", type=str, default="", help="model to load, a tiny random Qwen2 is used if empty")
+parser.add_argument("--tokenizer_path", type=str, default="local_qwen2_tokenizer")
+parser.add_argument("--num_requests", type=int, default=32)
+parser.add_argument("--num_callers", type=int, default=8, help="threads submitting to the engine at the same time")
+parser.add_argument("--max_batch_size", type=int, default=8)
+parser.add_argument("--max_new_tokens", type=int, default=32)
+args = parser.parse_args()
+
+
+def tiny_model(tokenizer):
+    torch.manual_seed(0)
+    config = Qwen2Config(vocab_size=len(tokenizer), hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+                         num_attention_heads=4, num_key_value_heads=2, eos_token_id=tokenizer.eos_token_id,
+                         pad_token_id=tokenizer.pad_token_id)
+    return Qwen2ForCausalLM(config).eval()
+
+
+if __name__ == "__main__":
+    if args.path:
+        tokenizer = AutoTokenizer.from_pretrained(args.path)
+        model = AutoModelForCausalLM.from_pretrained(args.path)
+    else:
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path)
+        model = tiny_model(tokenizer)
+    tokenizer.padding_side = "left"
+    # prompts of very different lengths, the case where padding a static batch hurts the most
+    queries = [" ".join(["turn on the flashlight"] * (1 + i % 8)) for i in range(args.num_requests)]
+    # a random model rarely emits eos, vary the budget so that sequences finish at different steps
+    budgets = [args.max_new_tokens // (1 + i % 4) for i in range(args.num_requests)]
+
+    static = HuggingfaceGenerateResponse(tokenizer, model, "")
+    start = time.perf_counter()
+    for i in range(0, len(queries), args.max_batch_size):
+        static("", queries[i:i + args.max_batch_size], max_new_tokens=max(budgets[i:i + args.max_batch_size]),
+               do_sample=False)
+    static_time = time.perf_counter() - start
+
+    serving = ServingGenerateResponse(tokenizer, model, "", max_batch_size=args.max_batch_size)
+    def caller(k):
+        for i in range(k, len(queries), args.num_callers):
+            serving("", [queries[i]], max_new_tokens=budgets[i], do_sample=False)
+    threads = [threading.Thread(target=caller, args=(k,)) for k in range(args.num_callers)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    serving_time = time.perf_counter() - start
+    serving.close()
+
+    print(f"{'generator':>12} {'req/s':>10}")
+    print(f"{'static':>12} {len(queries) / static_time:>10.2f}")
+    print(f"{'serving':>12} {len(queries) / serving_time:>10.2f}")
@@ -0,0 +1,84 @@
+import os
+os.sys.path.append(os.path.dirname(os.path.abspath(__file__))+"/../")
+os.environ["TOKENIZERS_PARALLELISM"] = "false"
+import json
+import time
+import random
+import argparse
+import multiprocessing as mp
+from functools import partial
+from rouge_score import rouge_scorer
+from transformers import AutoTokenizer
+
+from utils import SimilarityRecord, HuggingFaceTokenizer
+
+parser = argparse.ArgumentParser(description="benchmark per-update latency of SimilarityRecord as the record grows")
+parser.add_argument("--input", type=str, default="data/instructions.jsonl")
+parser.add_argument("--tokenizer_path", type=str, default="local_qwen2_tokenizer")
+parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 5000, 10000, 50000])
+parser.add_argument("--num_queries", type=int, default=20, help="timed updates at every size")
+parser.add_argument("--num_processes", type=int, default=mp.cpu_count())
+parser.add_argument("--bound", type=float, default=0.75, help="similarity threshold passed to update, accepted probes grow the record slightly")
+parser.add_argument("--legacy_max", type=int, default=5000, help="largest size to time the pool-per-call implementation at, 0 to skip")
+parser.add_argument("--seed", type=int, default=42)
+args = parser.parse_args()
+
+
+def _legacy_score(sentence, other_sentence):
+    return other_sentence, rouge_scorer._score_lcs(sentence, other_sentence).fmeasure
+
+
+def legacy_update(sentences, sentence, num_processes):
+    # what SimilarityRecord.update used to do: a fresh pool and the whole record pickled per call
+    with mp.Pool(num_processes) as pool:
+        scores = pool.map(partial(_legacy_score, sentence), sentences)
+    return max(scores, key=lambda x: x[1])
+
+
+def make_sentences(queries, num):
+    # splice random halves of real queries so the record grows past the size of the dataset
+    words = [q.split() for q in queries]
+    res = []
+    for _ in range(num):
+        a, b = random.choice(words), random.choice(words)
+        res.append(" ".join(a[:len(a)//2] + b[len(b)//2:]))
+    return res
+
+
+if __name__ == "__main__":
+    random.seed(args.seed)
+    with open(args.input) as f:
+        queries = [json.loads(line)["query"] for line in f]
+    tokenizer = HuggingFaceTokenizer(AutoTokenizer.from_pretrained(args.tokenizer_path))
+
+    sizes = sorted(args.sizes)
+    corpus = make_sentences(queries, sizes[-1])
+    probes = make_sentences(queries, args.num_queries)
+
+    record = SimilarityRecord(tokenizer, args.num_processes)
+    tokenized = []
+    print(f"{'size':>8} {'engine ms/update':>18} {'scored/update':>14} {'legacy ms/update':>18}")
+    for size in sizes:
+        while len(record.sentences) < size:
+            sentence = corpus[len(record.sentences)]
+            record.add(sentence)
+            tokenized.append(tokenizer.tokenize(sentence))
+
+        record.update(probes[0], bound=-1.0) # warm up, bound < 0 never adds to the record
+        num_scored = record.engine.num_scored
+        start = time.perf_counter()
+        for probe in probes:
+            record.update(probe, bound=args.bound)
+        engine_ms = (time.perf_counter() - start) * 1000 / len(probes)
+        scored = (record.engine.num_scored - num_scored) / len(probes)
+
+        legacy_ms = float("nan")
+        if size <= args.legacy_max:
+            start = time.perf_counter()
+            for probe in probes:
+                legacy_update(tokenized, tokenizer.tokenize(probe), args.num_processes)
+            legacy_ms = (time.perf_counter() - start) * 1000 / len(probes)
+
+        print(f"{size:>8} {engine_ms:>18.2f} {scored:>14.1f} {legacy_ms:>18.2f}")
+
+    record.close()
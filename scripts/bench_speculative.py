@@ -0,0 +1,123 @@
+import os
+os.sys.path.append(os.path.dirname(os.path.abspath(__file__))+"/../")
+import json
+import time
+import argparse
+import torch
+from transformers import AutoTokenizer, AutoModelForCausalLM, Qwen2Config, Qwen2ForCausalLM
+
+from utils.formatter import MessageTemplate, CodeFunctionCallingFormatter, JsonFunctionCallingFormatter
+from utils.speculative import NgramDraft, ModelDraft, SpeculativeStats, speculative_generate, call_corpus
+
+parser = argparse.ArgumentParser(description="acceptance rate and tokens/sec of speculative decoding on function calling prompts")
+parser.add_argument("--path", type=str, default="", help="target model, a tiny random Qwen2 is used if empty")
+parser.add_argument("--draft_path", type=str, default="", help="draft model sharing the tokenizer of the target")
+parser.add_argument("--tokenizer_path", type=str, default="local_qwen2_tokenizer")
+parser.add_argument("--input", type=str, default="data/DroidCall_test.jsonl")
+parser.add_argument("--corpus", type=str, default="data/DroidCall_train.jsonl")
+parser.add_argument("--api_file", type=str, default="data/api.jsonl")
+parser.add_argument("--format_type", type=str, default="code_short", choices=["json", "code", "code_short", "json_short"])
+parser.add_argument("--retrieve_doc_num", type=int, default=4)
+parser.add_argument("--num_queries", type=int, default=50)
+parser.add_argument("--num_draft_tokens", type=int, default=8)
+parser.add_argument("--max_new_tokens", type=int, default=100)
+args = parser.parse_args()
+
+
+def build_prompts(tokenizer, call_formatter):
+    apis = {}
+    with open(args.api_file) as f:
+        for line in f:
+            api = json.loads(line)
+            apis[api["name"]] = api
+    with open(args.input) as f:
+        instructions = [json.loads(line) for line in f][:args.num_queries]
+    template = MessageTemplate.get_message_template(args.format_type)
+    prompts = []
+    for instruction in instructions:
+        names = [answer["name"] for answer in instruction["answers"]]
+        names += [name for name in apis if name not in names][:max(0, args.retrieve_doc_num - len(names))]
+        message = template.format({"query": instruction["query"], "tools": [apis[name] for name in names]},
+                                  no_assistant=True)["message"]
+        text = tokenizer.apply_chat_template(message, tokenize=False, add_generation_prompt=True)
+        answer = call_formatter.format(calls=instruction["answers"]) + tokenizer.eos_token
+        prompts.append((tokenizer(text, add_special_tokens=False)["input_ids"],
+                        tokenizer(answer, add_special_tokens=False)["input_ids"]))
+    return prompts
+
+
+def oracle(prompts, draft):
+    # a target that always outputs the answer: how much of the answers the draft guesses, without a model
+    stats = SpeculativeStats()
+    for input_ids, answer in prompts:
+        draft.reset()
+        output = answer[:1]
+        stats.forwards += 1
+        while len(output) < len(answer):
+            proposal = draft.propose(input_ids + output, args.num_draft_tokens)
+            accepted = 0
+            while accepted < len(proposal) and len(output) + accepted < len(answer) \
+                    and proposal[accepted] == answer[len(output) + accepted]:
+                accepted += 1
+            output = answer[:len(output) + accepted + 1]
+            stats.forwards += 1
+            stats.proposed += len(proposal)
+            stats.accepted += accepted
+        stats.tokens += len(answer)
+    return stats.stats()
+
+
+@torch.no_grad()
+def run(model, tokenizer, prompts, draft=None):
+    stats = SpeculativeStats()
+    outputs, tokens = [], 0
+    start = time.perf_counter()
+    for input_ids, _ in prompts:
+        if draft is None:
+            out = model.generate(torch.tensor([input_ids], device=model.device), max_new_tokens=args.max_new_tokens,
+                                 do_sample=False)[0, len(input_ids):].tolist()
+        else:
+            out = speculative_generate(model, input_ids, draft, args.max_new_tokens, tokenizer.eos_token_id,
+                                       args.num_draft_tokens, stats=stats)
+        outputs.append(out)
+        tokens += len(out)
+    return tokens / (time.perf_counter() - start), outputs, stats.stats()
+
+
+if __name__ == "__main__":
+    tokenizer = AutoTokenizer.from_pretrained(args.path or args.tokenizer_path)
+    call_formatter = (JsonFunctionCallingFormatter if args.format_type.startswith("json")
+                      else CodeFunctionCallingFormatter)("", "")
+    prompts = build_prompts(tokenizer, call_formatter)
+    corpus = call_corpus(tokenizer, args.corpus, call_formatter) if args.corpus else []
+    drafts = [("ngram prompt", NgramDraft()), ("ngram prompt+corpus", NgramDraft(corpus))]
+
+    print(f"oracle target (outputs the gold answers), {len(prompts)} queries")
+    print(f"{'draft':>22} {'acceptance':>11} {'tokens/forward':>15}")
+    for name, draft in drafts:
+        stats = oracle(prompts, draft)
+        print(f"{name:>22} {stats['acceptance_rate']:>11.3f} {stats['tokens_per_forward']:>15.2f}")
+
+    if args.path:
+        model = AutoModelForCausalLM.from_pretrained(args.path, device_map="auto", torch_dtype=torch.bfloat16).eval()
+    else:
+        # a random model does not copy anything, only the overhead of the drafts can be seen
+        torch.manual_seed(0)
+        config = Qwen2Config(vocab_size=len(tokenizer), hidden_size=256, intermediate_size=768, num_hidden_layers=4,
+                             num_attention_heads=4, num_key_value_heads=2, eos_token_id=tokenizer.eos_token_id,
+                             pad_token_id=tokenizer.pad_token_id)
+        model = Qwen2ForCausalLM(config).eval()
+    if args.draft_path:
+        drafts.append(("draft model", ModelDraft(AutoModelForCausalLM.from_pretrained(
+            args.draft_path, device_map="auto", torch_dtype=torch.bfloat16).eval())))
+
+    run(model, tokenizer, prompts[:2])  # warm up
+    base_speed, base_outputs, _ = run(model, tokenizer, prompts)
+    print(f"\ntarget model, {len(prompts)} queries, greedy, max_new_tokens {args.max_new_tokens}")
+    print(f"{'draft':>22} {'tokens/s':>9} {'acceptance':>11} {'tokens/forward':>15} {'identical':>10}")
+    print(f"{'none (generate)':>22} {base_speed:>9.1f} {'':>11} {1.0:>15.2f} {'':>10}")
+    for name, draft in drafts:
+        speed, outputs, stats = run(model, tokenizer, prompts, draft)
+        same = sum(a == b for a, b in zip(base_outputs, outputs))
+        print(f"{name:>22} {speed:>9.1f} {stats['acceptance_rate']:>11.3f} {stats['tokens_per_forward']:>15.2f} "
+              f"{f'{same}/{len(prompts)}':>10}")
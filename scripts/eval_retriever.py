@@ -0,0 +1,94 @@
+import os
+os.sys.path.append(os.path.dirname(os.path.abspath(__file__))+"/../")
+import json
+import time
+import argparse
+from typing import Dict, List
+import numpy as np
+
+from utils.formatter import FunctionFormatter
+from utils.similarity import BM25Index
+from utils.retriever import ChromaDBRetriever, NumpyRetriever, HybridRetriever, ClassifierRetriever, LLMRetriever, GTEEmbedding
+
+parser = argparse.ArgumentParser(description="retrieval quality against the answers of the test file, recall@k, all answers in the top k and MRR, and the time of a query")
+parser.add_argument("--input", type=str, default="data/DroidCall_test.jsonl")
+parser.add_argument("--api_file", type=str, default="data/api.jsonl")
+parser.add_argument("--retrievers", type=str, nargs="+", default=["bm25", "dense", "hybrid", "classifier"],
+                    choices=["bm25", "dense", "hybrid", "classifier", "chromadb", "llm"])
+parser.add_argument("--vec_path", type=str, default="api_vec.jsonl", help="api embeddings written by scripts/create_chromaDB.py")
+parser.add_argument("--embedding_path", type=str, default="/data/share/gte-small")
+parser.add_argument("--chroma_path", type=str, default="./chromaDB", help="collection of the chromadb retriever")
+parser.add_argument("--classifier_path", type=str, default="data/intent_classifier.npz", help="written by scripts/train_classifier.py")
+parser.add_argument("--llm_path", type=str, default="/data/share/Qwen2-1.5B-Instruct", help="model of the llm retriever")
+parser.add_argument("--distance_type", type=str, default="ip", choices=["ip", "l2", "cosine"])
+parser.add_argument("--ks", type=int, nargs="+", default=[1, 2, 3, 4])
+args = parser.parse_args()
+
+
+def metrics(rankings: List[List[str]], answers: List[List[str]], ks: List[int]) -> Dict[str, float]:
+    result = {}
+    for k in ks:
+        result[f"recall@{k}"] = np.mean([len(set(r[:k]) & set(a)) / len(set(a)) for r, a in zip(rankings, answers)])
+        result[f"all@{k}"] = np.mean([set(a) <= set(r[:k]) for r, a in zip(rankings, answers)])
+    ranks = [next((i + 1 for i, name in enumerate(r) if name in a), None) for r, a in zip(rankings, answers)]
+    result["MRR"] = np.mean([1 / rank if rank else 0.0 for rank in ranks])
+    return result
+
+
+def names(documents: List[List[str]]) -> List[List[str]]:
+    return [[json.loads(doc)["name"] for doc in docs] for docs in documents]
+
+
+if __name__ == "__main__":
+    with open(args.input) as f:
+        instructions = [json.loads(line) for line in f]
+    queries = [instruction["query"] for instruction in instructions]
+    answers = [[answer["name"] for answer in instruction["answers"]] for instruction in instructions]
+
+    n = max(args.ks)
+    retrievers = {}
+    emb = None
+    if {"dense", "hybrid", "chromadb"} & set(args.retrievers):
+        emb = GTEEmbedding(args.embedding_path)
+    if {"dense", "hybrid"} & set(args.retrievers):
+        dense = NumpyRetriever(args.vec_path, emb, args.distance_type)
+        hybrid = HybridRetriever(dense)
+    if "bm25" in args.retrievers:
+        # the index of HybridRetriever, over the apis of api_file so that it runs without a model
+        with open(args.api_file) as f:
+            apis = [json.loads(line) for line in f]
+        formatter = FunctionFormatter(format_type="code")
+        bm25 = BM25Index([formatter.format(tools=[api]) for api in apis])
+        api_documents = [json.dumps(api, indent=2, ensure_ascii=False) for api in apis]
+        retrievers["bm25"] = lambda query: [api_documents[i] for i in bm25.top(query, n)]
+    if "dense" in args.retrievers:
+        retrievers["dense"] = lambda query: dense.retrieve(query, n)
+    if "hybrid" in args.retrievers:
+        retrievers["hybrid"] = lambda query: hybrid.retrieve(query, n)
+    if "classifier" in args.retrievers:
+        classifier = ClassifierRetriever(args.classifier_path, args.api_file)
+        retrievers["classifier"] = lambda query: classifier.retrieve(query, n)
+    if "chromadb" in args.retrievers:
+        chroma = ChromaDBRetriever(args.chroma_path, distance_type=args.distance_type, emb_func=emb)
+        retrievers["chromadb"] = lambda query: chroma.retrieve(query, n)
+    if "llm" in args.retrievers:
+        from transformers import AutoTokenizer, AutoModelForCausalLM
+        from utils import HuggingfaceGenerateResponse
+        tokenizer = AutoTokenizer.from_pretrained(args.llm_path)
+        model = AutoModelForCausalLM.from_pretrained(args.llm_path, device_map="auto")
+        llm = LLMRetriever(args.api_file, HuggingfaceGenerateResponse(tokenizer, model, ""))
+        retrievers["llm"] = lambda query: llm.retrieve(query, n)
+
+    print(f"{len(queries)} queries, top {n}")
+    columns = [f"{metric}@{k}" for k in args.ks for metric in ("recall", "all")] + ["MRR"]
+    print(f"{'retriever':>10} " + " ".join(f"{c:>9}" for c in columns) + f" {'ms/query':>9}")
+    for name, retrieve in retrievers.items():
+        retrieve(queries[0])  # warm up
+        if emb is not None:
+            emb._cache.clear()  # every retriever embeds the queries itself
+        # one query at a time, as the agent retrieves
+        start = time.perf_counter()
+        ranking = names([retrieve(query) for query in queries])
+        elapsed = (time.perf_counter() - start) / len(queries)
+        result = metrics(ranking, answers, args.ks)
+        print(f"{name:>10} " + " ".join(f"{result[c]:>9.4f}" for c in columns) + f" {elapsed * 1e3:>9.3f}")
@@ -0,0 +1,73 @@
+import os
+os.sys.path.append(os.path.dirname(os.path.abspath(__file__))+"/../")
+os.environ["TOKENIZERS_PARALLELISM"] = "false"
+import json
+import time
+import argparse
+from transformers import AutoTokenizer
+
+from utils import HuggingFaceTokenizer, create_similarity_record
+
+parser = argparse.ArgumentParser(description="measure the recall of the approximate similarity backends against exact ROUGE-L dedup")
+parser.add_argument("--input", type=str, default="data/instructions.jsonl")
+parser.add_argument("--tokenizer_path", type=str, default="local_qwen2_tokenizer")
+# data/instructions.jsonl was generated with a 0.75 threshold so it has no duplicates at 0.75, use a lower one
+parser.add_argument("--similarity_threshold", type=float, default=0.5)
+parser.add_argument("--backends", type=str, nargs="+", default=["lsh", "lsh_verify"], choices=["lsh", "lsh_verify"])
+parser.add_argument("--num_perm", type=int, default=128)
+parser.add_argument("--bands", type=int, default=0, help="0 picks them for the threshold")
+parser.add_argument("--shingle_size", type=int, default=1)
+args = parser.parse_args()
+
+if __name__ == "__main__":
+    # replay the queries function by function like gen_instructions.py does, one record per function
+    func2queries = {}
+    with open(args.input) as f:
+        for line in f:
+            d = json.loads(line)
+            func2queries.setdefault(d["answers"][0]["name"], []).append(d["query"])
+
+    tokenizer = HuggingFaceTokenizer(AutoTokenizer.from_pretrained(args.tokenizer_path))
+    bound = args.similarity_threshold
+
+    exact = create_similarity_record("exact", tokenizer, num_processes=1)
+    records = {
+        backend: create_similarity_record(backend, tokenizer, bound, num_perm=args.num_perm, bands=args.bands,
+                                          shingle_size=args.shingle_size)
+        for backend in args.backends
+    }
+    exact_time = 0.0
+    stats = {backend: {"time": 0.0, "hit": 0, "false_reject": 0} for backend in args.backends}
+    num_queries = 0
+    num_duplicates = 0
+
+    for queries in func2queries.values():
+        exact.clear()
+        for record in records.values():
+            record.clear()
+        for query in queries:
+            num_queries += 1
+            start = time.perf_counter()
+            _, score = exact.update(query, bound)
+            exact_time += time.perf_counter() - start
+            is_duplicate = score > bound
+            num_duplicates += is_duplicate
+
+            for backend, record in records.items():
+                # bound < 0 never adds, the record only grows with what the exact record accepted
+                start = time.perf_counter()
+                _, approx_score = record.update(query, -1.0)
+                stats[backend]["time"] += time.perf_counter() - start
+                if approx_score > bound:
+                    stats[backend]["hit" if is_duplicate else "false_reject"] += 1
+                if not is_duplicate:
+                    record.add(query)
+
+    print(f"queries: {num_queries}, duplicates under exact ROUGE-L > {bound}: {num_duplicates}")
+    print(f"{'backend':>12} {'recall':>8} {'false rejects':>14} {'ms/update':>10}")
+    print(f"{'exact':>12} {1.0:>8.3f} {0:>14} {exact_time * 1000 / num_queries:>10.3f}")
+    for backend, stat in stats.items():
+        recall = stat["hit"] / num_duplicates if num_duplicates else 1.0
+        print(f"{backend:>12} {recall:>8.3f} {stat['false_reject']:>14} {stat['time'] * 1000 / num_queries:>10.3f}")
+
+    exact.close()
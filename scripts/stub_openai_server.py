@@ -0,0 +1,81 @@
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# a minimal OpenAI-compatible server for testing and benchmarking the clients in utils
+# POST /v1/chat/completions answers with the last user message after `latency` seconds,
+# and answers 429 with a Retry-After header for a `rate_limit` fraction of the requests.
+
+
+def make_handler(latency: float, rate_limit: float, retry_after: float):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, code: int, body: dict, headers: dict = None):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            if not self.path.endswith("/chat/completions"):
+                self._send(404, {"error": {"message": f"unknown path {self.path}"}})
+                return
+            if random.random() < rate_limit:
+                self._send(429, {"error": {"message": "rate limited", "type": "rate_limit_error"}},
+                           {"Retry-After": str(retry_after)})
+                return
+            time.sleep(latency)
+            content = request["messages"][-1]["content"] if request.get("messages") else ""
+            self._send(200, {
+                "id": "chatcmpl-stub",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model", "stub"),
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop",
+                }],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            })
+
+    return StubHandler
+
+
+def serve(port: int = 0, latency: float = 0.05, rate_limit: float = 0.0, retry_after: float = 0.1,
+          background: bool = True) -> ThreadingHTTPServer:
+    """
+    start the stub server, port 0 picks a free port (see server.server_address).
+    with background=True the server runs in a daemon thread and is returned right away.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(latency, rate_limit, retry_after))
+    server.daemon_threads = True
+    if background:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    else:
+        server.serve_forever()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="stub OpenAI-compatible chat completions server")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds to wait before answering")
+    parser.add_argument("--rate_limit", type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument("--retry_after", type=float, default=0.1, help="Retry-After of the 429 answers")
+    args = parser.parse_args()
+    print(f"serving on http://127.0.0.1:{args.port}/v1")
+    serve(args.port, args.latency, args.rate_limit, args.retry_after, background=False)
@@ -0,0 +1,45 @@
+import os
+os.sys.path.append(os.path.dirname(os.path.abspath(__file__))+"/../")
+import json
+import time
+import argparse
+import numpy as np
+
+from utils.retriever import ClassifierRetriever
+
+parser = argparse.ArgumentParser(description="train the intent classifier of ClassifierRetriever, TF-IDF of the query words and pairs to one logistic output per api")
+parser.add_argument("--input", type=str, default="data/instructions.jsonl")
+parser.add_argument("--exclude", type=str, default="data/DroidCall_test.jsonl", help="queries of this file are left out of the training, empty to use them all")
+parser.add_argument("--api_file", type=str, default="data/api.jsonl")
+parser.add_argument("--output", type=str, default="data/intent_classifier.npz")
+parser.add_argument("--min_df", type=int, default=2, help="terms in fewer queries are dropped")
+parser.add_argument("--l2", type=float, default=1e-4)
+parser.add_argument("--epochs", type=int, default=300)
+parser.add_argument("--lr", type=float, default=0.05)
+args = parser.parse_args()
+
+
+if __name__ == "__main__":
+    excluded = set()
+    if args.exclude:
+        with open(args.exclude) as f:
+            excluded = {json.loads(line)["query"] for line in f}
+    with open(args.input) as f:
+        instructions = [json.loads(line) for line in f]
+    instructions = [instruction for instruction in instructions if instruction["query"] not in excluded]
+    with open(args.api_file) as f:
+        labels = [json.loads(line)["name"] for line in f]
+
+    start = time.perf_counter()
+    model = ClassifierRetriever.train(instructions, labels, args.min_df, args.l2, args.epochs, args.lr)
+    print(f"trained on {len(instructions)} queries, {len(model['terms'])} terms, {len(labels)} apis "
+          f"in {time.perf_counter() - start:.1f} s")
+    np.savez_compressed(args.output, **model)
+
+    retriever = ClassifierRetriever(args.output, args.api_file)
+    correct = sum(
+        {answer["name"] for answer in instruction["answers"]} <= set(
+            retriever.labels[i] for i in np.argsort(-retriever.scores(instruction["query"]))[:len(instruction["answers"])])
+        for instruction in instructions
+    )
+    print(f"training accuracy {correct / len(instructions):.4f}, saved to {args.output}")
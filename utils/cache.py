@@ -0,0 +1,96 @@
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import Any, Optional
+
+
+class ResponseCache:
+    """
+    a content-addressed on-disk cache of LLM responses backed by SQLite.
+    path: the sqlite file, created if it does not exist.
+    max_entries: when the cache grows past it, the least recently used entries are evicted.
+
+    make_key(**parts)-> str: a stable hash of the parts of a request (model, prompts, sampling kwargs...).
+    get(key: str)-> Any: the cached value or None, counts a hit or a miss.
+    put(key: str, value: Any): store a json serializable value.
+    """
+    def __init__(self, path: str, max_entries: int = 100000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS responses "
+                           "(key TEXT PRIMARY KEY, value TEXT NOT NULL, last_access REAL NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self._conn.commit()
+        # entries counted by put, refreshed from the table when evicting (another process may share the file)
+        self._count = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(**parts) -> str:
+        text = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            return json.loads(row[0])
+
+    def put(self, key: str, value: Any):
+        with self._lock:
+            value, now = json.dumps(value, ensure_ascii=False), time.time()
+            inserted = self._conn.execute("INSERT OR IGNORE INTO responses (key, value, last_access) VALUES (?, ?, ?)",
+                                          (key, value, now)).rowcount
+            if inserted:
+                self._count += 1
+            else:
+                self._conn.execute("UPDATE responses SET value = ?, last_access = ? WHERE key = ?", (value, now, key))
+            if self._count > self.max_entries:
+                self._count = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+                if self._count > self.max_entries:
+                    self._conn.execute("DELETE FROM responses WHERE key IN "
+                                       "(SELECT key FROM responses ORDER BY last_access ASC LIMIT ?)",
+                                       (self._count - self.max_entries,))
+                    self._count = self.max_entries
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0.0
+        return f"cache hits: {self.hits}, misses: {self.misses}, hit rate: {rate:.2%}, entries: {len(self)}"
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class OccurrenceCounter:
+    """
+    counts how many times the same request has been made in this process.
+    sampled (non-deterministic) calls put the count into their cache key, so a re-run replays the
+    1st, 2nd, ... response of a repeated prompt instead of returning the first one over and over
+    (e.g. the retry loop of gen_solution.py or a prompt that the data collector samples twice).
+    """
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def next(self, key: str) -> int:
+        with self._lock:
+            n = self._counts.get(key, 0)
+            self._counts[key] = n + 1
+            return n
@@ -1,8 +1,7 @@
+import ast
 import json
 import re
 
-import pyparsing as pp
-from pyparsing import pyparsing_common as ppc
 
 def convert_value(val):
     match = re.match(r'^result(\d+)$', val)
@@ -27,142 +26,353 @@ def convert_value(val):
         except ValueError:
             return val
 
-def extract_calls(calls_str):
-    pattern = r'result(\d+) = (\w+)\((.*?)\)'
-    matches = re.finditer(pattern, calls_str)
-    
-    for match in matches:
-        call_id, function_name, arguments_str = match.groups()
-        
-        args_pattern = r'(\w+)=((?:\[.*?\]|{.*?}|".*?"|[^,]+))'
-        arguments = {}
-
-        for arg_name, arg_val in re.findall(args_pattern, arguments_str):
-            arg_val = arg_val.strip()
-            if arg_val.endswith(','):  
-                arg_val = arg_val[:-1].strip()
-            arguments[arg_name] = convert_value(arg_val)
-        
-        yield {
-            "id": int(call_id),
-            "name": function_name,
-            "arguments": arguments
-        }
-
-
-def get_json_obj(text: str):
-    def make_keyword(kwd_str, kwd_value):
-        return pp.Keyword(kwd_str).setParseAction(pp.replaceWith(kwd_value))
-
-    if not hasattr(get_json_obj, "jsonDoc"):
-        # set to False to return ParseResults
-        RETURN_PYTHON_COLLECTIONS = True
-
-        TRUE = make_keyword("true", True)
-        FALSE = make_keyword("false", False)
-        NULL = make_keyword("null", None)
+class CallParseError:
+    """a part of a code format output that could not be read as intended, text[start:end] is the culprit"""
+    def __init__(self, message: str, start: int, end: int):
+        self.message = message
+        self.start = start
+        self.end = end
 
-        LBRACK, RBRACK, LBRACE, RBRACE, COLON = map(pp.Suppress, "[]{}:")
+    def __repr__(self) -> str:
+        return f"CallParseError({self.message!r}, {self.start}, {self.end})"
 
-        jsonString = pp.dblQuotedString().setParseAction(pp.removeQuotes)
-        jsonNumber = ppc.number().setName("jsonNumber")
 
-        jsonObject = pp.Forward().setName("jsonObject")
-        jsonValue = pp.Forward().setName("jsonValue")
+_CALL_START = re.compile(r'result(\d+)\s*=\s*(\w+)\s*\(')
+_NEXT_CALL = re.compile(r'\n\s*result\d+\s*=\s*\w+\s*\(')
+# the chars the scan of the arguments stops at, outside and inside strings
+_SPECIAL = re.compile(r'["\'()\[\]{},\n]')
+_STRING_END = {'"': re.compile(r'["\\\n]'), "'": re.compile(r"['\\\n]")}
+_CLOSING = {"(": ")", "[": "]", "{": "}"}
+_ARGUMENT = re.compile(r'\s*(\w+)\s*=(.*)', re.S)
 
-        jsonElements = pp.delimitedList(jsonValue).setName(None)
 
-        jsonArray = pp.Group(
-            LBRACK + pp.Optional(jsonElements) + RBRACK, aslist=RETURN_PYTHON_COLLECTIONS
-        ).setName("jsonArray")
-
-        jsonValue << (jsonString | jsonNumber | jsonObject | jsonArray | TRUE | FALSE | NULL)
-
-        memberDef = pp.Group(
-            jsonString + COLON + jsonValue, aslist=RETURN_PYTHON_COLLECTIONS
-        ).setName("jsonMember")
-
-        jsonMembers = pp.delimitedList(memberDef).setName(None)
-        jsonObject << pp.Dict(
-            LBRACE + pp.Optional(jsonMembers) + RBRACE, asdict=RETURN_PYTHON_COLLECTIONS
-        )
-
-        jsonComment = pp.cppStyleComment
-        jsonObject.ignore(jsonComment)
-        jsonDoc = jsonObject | jsonArray
-        get_json_obj.jsonDoc = jsonDoc
-    for _, l, r in get_json_obj.jsonDoc.scanString(text):
-        json_string = text[l:r]
+def _scan_arguments(text: str, start: int, errors: list, final: bool = True):
+    """
+    from after the '(' of a call, the position of its ')' and of the commas between its arguments. strings and
+    brackets are skipped and a quote whose string would cross a line is taken as a plain char.
+    the position is -1 if the call is not closed because a new call starts on a next line, None is returned if the
+    text ends first. final=False when more text may follow: a string open at the end is not taken as unterminated.
+    """
+    stack, commas = [], []
+    literal_quotes = set()
+    quote, quote_start, saved = None, 0, None
+    i = start
+    while True:
+        if quote:
+            m = _STRING_END[quote].search(text, i)
+            if m is None and not final:
+                return None
+            if m is None or m.group() == "\n":
+                # scan again from the quote as if it was a plain char
+                errors.append(CallParseError("unterminated string", quote_start, len(text) if m is None else m.start()))
+                literal_quotes.add(quote_start)
+                quote, (stack, commas) = None, saved
+                i = quote_start + 1
+            elif m.group() == "\\":
+                i = m.start() + 2
+            else:
+                quote, i = None, m.end()
+            continue
+        m = _SPECIAL.search(text, i)
+        if m is None:
+            return None
+        i, c = m.start(), m.group()
+        if c in "\"'" and i not in literal_quotes:
+            quote, quote_start, saved = c, i, (list(stack), list(commas))
+        elif c in "([{":
+            stack.append(i)
+        elif c in ")]}":
+            if not stack and c == ")":
+                return i, commas
+            if stack and _CLOSING[text[stack[-1]]] == c:
+                stack.pop()
+            elif c == ")" and all(text[j] != "(" for j in stack):
+                for j in stack:
+                    errors.append(CallParseError(f"unclosed '{text[j]}'", j, i))
+                return i, commas
+            else:
+                errors.append(CallParseError(f"unexpected '{c}'", i, i + 1))
+        elif c == "," and not stack:
+            commas.append(i)
+        elif c == "\n" and not stack and _NEXT_CALL.match(text, i):
+            return -1, commas
+        i += 1
+
+
+def _ast_value(node, source: str):
+    if isinstance(node, ast.Constant) and isinstance(node.value, (str, int, float, bool, type(None))):
+        return node.value
+    if isinstance(node, ast.Name):
+        return convert_value(node.id)
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)) \
+            and isinstance(node.operand, ast.Constant) and isinstance(node.operand.value, (int, float)):
+        return -node.operand.value if isinstance(node.op, ast.USub) else node.operand.value
+    if isinstance(node, (ast.List, ast.Tuple, ast.Set)):
+        return [_ast_value(e, source) for e in node.elts]
+    if isinstance(node, ast.Dict) and all(k is not None for k in node.keys):
+        keys = [_ast_value(k, source) for k in node.keys]
+        if all(isinstance(k, (str, int, float, bool, type(None))) for k in keys):
+            return {k: _ast_value(v, source) for k, v in zip(keys, node.values)}
+    return _loose_value(ast.get_source_segment(source, node))
+
+
+def _loose_value(val: str):
+    # a double quoted value that is not valid json is most likely a string with unescaped quotes in it
+    if len(val) >= 2 and val[0] == val[-1] == '"':
         try:
-            parsed_data = json.loads(json_string)
-            return parsed_data
-        except json.JSONDecodeError as e:
-            print(f"JSON decoding error: {e}")
-        except Exception as e:
-            print(f"An error occurred: {e}")
+            return json.loads(val)
+        except json.JSONDecodeError:
+            return val[1:-1]
+    return convert_value(val)
 
 
-def extract_and_parse_jsons(text):
-    def make_keyword(kwd_str, kwd_value):
-        return pp.Keyword(kwd_str).setParseAction(pp.replaceWith(kwd_value))
+def _parse_arguments(text: str, start: int, end: int, commas: list, errors: list) -> dict:
+    # the newline keeps a trailing comment from hiding the ')'
+    source = "f(" + text[start:end] + "\n)"
+    try:
+        call = ast.parse(source, mode="eval").body
+    except (SyntaxError, ValueError, RecursionError):
+        call = None
+    if isinstance(call, ast.Call) and all(keyword.arg is not None for keyword in call.keywords):
+        for arg in call.args:
+            offset = start + _source_offset(source, arg.lineno, arg.col_offset) - 2
+            errors.append(CallParseError("positional argument", offset,
+                                         offset + len(ast.get_source_segment(source, arg))))
+        return {keyword.arg: _ast_value(keyword.value, source) for keyword in call.keywords}
+
+    # not python, e.g. unquoted or badly quoted strings: split at the top level commas
+    arguments = {}
+    for piece_start, piece_end in zip([start] + [c + 1 for c in commas], commas + [end]):
+        piece = text[piece_start:piece_end]
+        if not piece.strip():
+            continue
+        m = _ARGUMENT.match(piece)
+        if m is None:
+            lead = len(piece) - len(piece.lstrip())
+            errors.append(CallParseError("expected NAME=value", piece_start + lead, piece_start + len(piece.rstrip())))
+            continue
+        arguments[m.group(1)] = _loose_value(m.group(2).strip())
+    return arguments
+
+
+def _source_offset(source: str, lineno: int, col_offset: int) -> int:
+    # the char offset of an ast position (1-based line, utf-8 byte column)
+    lines = source.split("\n")
+    return sum(len(line) + 1 for line in lines[:lineno - 1]) + len(lines[lineno - 1].encode()[:col_offset].decode())
+
+
+def parse_calls(calls_str: str):
+    """
+    the calls of a code format output, `resultN = FUNC(ARG=value, ...)`, in one pass over the text.
+    arguments may be nested lists/dicts, strings with commas or parentheses, resultN references, and span lines.
+    returns (calls, errors): the calls as {"id": N, "name": FUNC, "arguments": {...}} and a CallParseError for every
+    part that could not be read as intended (unclosed calls, unterminated strings, arguments without a name...).
+    """
+    calls, errors = [], []
+    _parse_calls(calls_str, 0, calls, errors)
+    return calls, errors
+
+
+def _parse_calls(text: str, pos: int, calls: list, errors: list, final: bool = True) -> int:
+    # adds the calls from pos on to calls, returns the position to go on from. final=False when more text may
+    # follow: it stops before the first call that is not closed yet
+    while True:
+        match = _CALL_START.search(text, pos)
+        if match is None:
+            return pos
+        call_errors = []
+        scanned = _scan_arguments(text, match.end(), call_errors, final)
+        if scanned is None and not final:
+            return match.start()
+        errors.extend(call_errors)
+        if scanned is None or scanned[0] < 0:
+            line_end = text.find("\n", match.end())
+            errors.append(CallParseError("call is not closed", match.start(), len(text) if line_end < 0 else line_end))
+            pos = match.end()
+            continue
+        end, commas = scanned
+        calls.append({
+            "id": int(match.group(1)),
+            "name": match.group(2),
+            "arguments": _parse_arguments(text, match.end(), end, commas, errors),
+        })
+        pos = end + 1
 
-    if not hasattr(extract_and_parse_jsons, "jsonDoc"):
-        # set to False to return ParseResults
-        RETURN_PYTHON_COLLECTIONS = True
 
-        TRUE = make_keyword("true", True)
-        FALSE = make_keyword("false", False)
-        NULL = make_keyword("null", None)
+def extract_calls(calls_str):
+    calls, _ = parse_calls(calls_str)
+    yield from calls
+
+
+# the json scanner below finds the same json as the pyparsing grammar it replaced (jsonObject | jsonArray with
+# scanString): every '{' or '[' is tried with json's raw_decode, and when that fails, a matcher of the old grammar
+# tells whether it would have matched a span there anyway (lenient strings and numbers, C++ comments), which is
+# then reported as a decoding error and skipped as before.
+_CANDIDATE = re.compile(r'[\[{/]')
+_SKIP = re.compile(r'(?:[ \n\t\r]+|/\*(?:[^*]|\*(?!/))*\*/|//(?:\\\n|[^\n])*)*')
+_STRING_BODY = re.compile(r'"(?:[^"\n\r\\]|(?:"")|(?:\\(?:[^x]|x[0-9a-fA-F]+)))*')
+_NUMBERS = [
+    re.compile(r'[+-]?(?:\d+(?:[eE][+-]?\d+)|(?:\d+\.\d*|\.\d+)(?:[eE][+-]?\d+)?)'),
+    re.compile(r'[+-]?(?:\d+\.\d*|\.\d+)'),
+    re.compile(r'[+-]?\d+'),
+]
+_KEYWORD_CHARS = set("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_$")
+
+
+def _reject_constant(name):
+    # NaN and Infinity were never matched
+    raise ValueError(f"unexpected {name}")
+
+
+_DECODER = json.JSONDecoder(parse_constant=_reject_constant)
+
+
+def _match_string(text: str, pos: int) -> int:
+    if not text.startswith('"', pos):
+        return -1
+    end = _STRING_BODY.match(text, pos).end()
+    return end + 1 if text.startswith('"', end) else -1
+
+
+def _match_value(text: str, pos: int) -> int:
+    # the end of the value at pos (comments and whitespace first), -1 if there is none
+    pos = _SKIP.match(text, pos).end()
+    c = text[pos:pos + 1]
+    if c == '"':
+        return _match_string(text, pos)
+    for number in _NUMBERS:
+        m = number.match(text, pos)
+        if m:
+            return m.end()
+    if c in ("{", "["):
+        return _match_container(text, pos)
+    for keyword in ("true", "false", "null"):
+        end = pos + len(keyword)
+        if text.startswith(keyword, pos) and (end >= len(text) or text[end] not in _KEYWORD_CHARS) \
+                and (pos == 0 or text[pos - 1] not in _KEYWORD_CHARS):
+            return end
+    return -1
+
+
+def _match_member(text: str, pos: int) -> int:
+    pos = _match_string(text, _SKIP.match(text, pos).end())
+    if pos < 0:
+        return -1
+    pos = _SKIP.match(text, pos).end()
+    return _match_value(text, pos + 1) if text.startswith(":", pos) else -1
+
+
+def _match_container(text: str, pos: int) -> int:
+    # an object or an array at pos, the elements are optional and a trailing comma is not allowed
+    pos = _SKIP.match(text, pos).end()
+    if text.startswith("{", pos):
+        match_element, close = _match_member, "}"
+    elif text.startswith("[", pos):
+        match_element, close = _match_value, "]"
+    else:
+        return -1
+    end = match_element(text, pos + 1)
+    if end < 0:
+        end = pos + 1
+    else:
+        while True:
+            sep = _SKIP.match(text, end).end()
+            if not text.startswith(",", sep):
+                break
+            element_end = match_element(text, sep + 1)
+            if element_end < 0:
+                break
+            end = element_end
+    end = _SKIP.match(text, end).end()
+    return end + 1 if text.startswith(close, end) else -1
+
+
+def _scan_jsons(text: str):
+    # yields the json objects and arrays of text in order, prints the matches that can not be decoded
+    m = _CANDIDATE.search(text)
+    while m:
+        start = m.start()
+        if text[start] != "/":
+            try:
+                obj, end = _DECODER.raw_decode(text, start)
+                yield obj
+                m = _CANDIDATE.search(text, end)
+                continue
+            except ValueError:
+                pass
+        elif not text.startswith(("/*", "//"), start):
+            m = _CANDIDATE.search(text, start + 1)
+            continue
+        end = _match_container(text, start)
+        if end < 0:
+            m = _CANDIDATE.search(text, start + 1)
+            continue
+        yield from _loads_or_print(text[start:end])
+        m = _CANDIDATE.search(text, end)
+
+
+def _loads_or_print(json_string: str) -> list:
+    try:
+        return [json.loads(json_string)]
+    except json.JSONDecodeError as e:
+        print(f"JSON decoding error: {e}")
+    except Exception as e:
+        print(f"An error occurred: {e}")
+    return []
 
-        LBRACK, RBRACK, LBRACE, RBRACE, COLON = map(pp.Suppress, "[]{}:")
 
-        jsonString = pp.dblQuotedString().setParseAction(pp.removeQuotes)
-        jsonNumber = ppc.number().setName("jsonNumber")
+def get_json_obj(text: str):
+    for parsed_data in _scan_jsons(text):
+        return parsed_data
 
-        jsonObject = pp.Forward().setName("jsonObject")
-        jsonValue = pp.Forward().setName("jsonValue")
 
-        jsonElements = pp.delimitedList(jsonValue).setName(None)
+def extract_and_parse_jsons(text):
+    for parsed_data in _scan_jsons(text):
+        if isinstance(parsed_data, list):
+            for item in parsed_data:
+                yield item
+        else:
+            yield parsed_data
+      
+from abc import ABC, abstractmethod
 
-        jsonArray = pp.Group(
-            LBRACK + pp.Optional(jsonElements) + RBRACK, aslist=RETURN_PYTHON_COLLECTIONS
-        ).setName("jsonArray")
+class CallExtractor(ABC):
+    """
+    extract(text) gives the calls of a whole output. to have them while the output is streamed (e.g. to execute the
+    first call while the model still writes the next ones), feed(chunk) the pieces as they come, it returns the calls
+    that got complete, and finish() once the output ended for the remaining ones. reset() before the next output.
+    usage:
+        extractor = CallExtractor.get_extractor("code")
+        for call in extractor.stream(handler.inference_stream(query, docs)):
+            executor.execute(Call(call["name"], call["arguments"]))
+    """
+    def __init__(self):
+        self.reset()
 
-        jsonValue << (jsonString | jsonNumber | jsonObject | jsonArray | TRUE | FALSE | NULL)
+    @abstractmethod
+    def extract(self, text: str):
+        pass
 
-        memberDef = pp.Group(
-            jsonString + COLON + jsonValue, aslist=RETURN_PYTHON_COLLECTIONS
-        ).setName("jsonMember")
+    def reset(self):
+        self.buffer = ""
+        self.pos = 0
 
-        jsonMembers = pp.delimitedList(memberDef).setName(None)
-        jsonObject << pp.Dict(
-            LBRACE + pp.Optional(jsonMembers) + RBRACE, asdict=RETURN_PYTHON_COLLECTIONS
-        )
+    def feed(self, chunk: str) -> list:
+        self.buffer += chunk
+        return self._take(final=False)
 
-        jsonComment = pp.cppStyleComment
-        jsonObject.ignore(jsonComment)
-        jsonDoc = jsonObject | jsonArray
-        extract_and_parse_jsons.jsonDoc = jsonDoc
-    for _, l, r in extract_and_parse_jsons.jsonDoc.scanString(text):
-        json_string = text[l:r]
-        try:
-            parsed_data = json.loads(json_string)
+    def finish(self) -> list:
+        return self._take(final=True)
 
-            if isinstance(parsed_data, list):
-                for item in parsed_data:
-                    yield item
-            else:
-                yield parsed_data
-        except json.JSONDecodeError as e:
-            print(f"JSON decoding error: {e}")
-        except Exception as e:
-            print(f"An error occurred: {e}")
-      
-from abc import ABC, abstractmethod
+    def stream(self, chunks):
+        self.reset()
+        for chunk in chunks:
+            yield from self.feed(chunk)
+        yield from self.finish()
 
-class CallExtractor(ABC):
     @abstractmethod
-    def extract(self, text: str):
+    def _take(self, final: bool) -> list:
+        # the calls of self.buffer from self.pos on that are complete, final=True when the output ended
         pass
     
     @staticmethod
@@ -174,13 +384,90 @@ class CallExtractor(ABC):
         else:
             raise ValueError(f"Unsupported extractor type {extractor_type}")
     
+_JSON_CANDIDATE = re.compile(r'[\[{]')
+_JSON_WS = re.compile(r'[ \t\n\r]*')
+
+
 class JsonCallExtractor(CallExtractor):
+    """
+    when fed, an object is given once it is closed and the elements of an array one by one. the json is only
+    decoded up to the last newline so that a value cut between two chunks (a number, true...) is not taken for an
+    error; the calls are written with indent=2, so every element ends its line.
+    """
     def extract(self, text: str):
         return extract_and_parse_jsons(text)
+
+    def reset(self):
+        super().reset()
+        # None outside of an array, "first" before its first element and "next" after an element
+        self._array = None
+
+    def _take(self, final: bool) -> list:
+        text = self.buffer if final else self.buffer[:self.buffer.rfind("\n") + 1]
+        calls = []
+        while True:
+            if self._array is not None:
+                pos = _JSON_WS.match(text, self.pos).end()
+                if text.startswith("]", pos):
+                    self._array, self.pos = None, pos + 1
+                    continue
+                if self._array == "next":
+                    if text.startswith(",", pos):
+                        pos = _JSON_WS.match(text, pos + 1).end()
+                    elif pos == len(text) and not final:
+                        return calls
+                    else:
+                        self._array, self.pos = None, pos
+                        continue
+                try:
+                    obj, self.pos = _DECODER.raw_decode(text, pos)
+                    calls.append(obj)
+                    self._array = "next"
+                except ValueError as e:
+                    if not final and getattr(e, "pos", 0) >= len(text):
+                        return calls
+                    # not json after all, go on from the element like extract would from the '['
+                    self._array, self.pos = None, pos
+                continue
+            m = _JSON_CANDIDATE.search(text, self.pos)
+            if m is None:
+                self.pos = len(text)
+                return calls
+            start = m.start()
+            if text[start] == "[":
+                self._array, self.pos = "first", start + 1
+                continue
+            try:
+                obj, self.pos = _DECODER.raw_decode(text, start)
+                calls.append(obj)
+            except ValueError as e:
+                if not final and getattr(e, "pos", 0) >= len(text):
+                    self.pos = start
+                    return calls
+                end = _match_container(text, start)
+                if end < 0:
+                    self.pos = start + 1
+                else:
+                    calls += _loads_or_print(text[start:end])
+                    self.pos = end
+
     
 class CodeCallExtractor(CallExtractor):
+    """
+    when fed, a call is given as soon as its ')' is there, the parse errors of the output are kept in
+    self.errors.
+    """
     def extract(self, text: str):
         return extract_calls(text)
+
+    def reset(self):
+        super().reset()
+        self.errors = []
+
+    def _take(self, final: bool) -> list:
+        calls = []
+        self.pos = _parse_calls(self.buffer, self.pos, calls, self.errors, final)
+        return calls
             
             
 if __name__ == "__main__":
@@ -1,6 +1,8 @@
-from typing import Dict
+from typing import Dict, List
 from string import Template
+import hashlib
 import json
+import os
 from .prompt import *
 
 class Formatter:
@@ -19,8 +21,10 @@ class Formatter:
         return result
 
     def __getattr__(self, name):
-        if name in self.sub_formatters:
-            return self.sub_formatters[name]
+        # through __dict__, an instance being copied has no sub_formatters yet
+        sub_formatters = self.__dict__.get("sub_formatters", {})
+        if name in sub_formatters:
+            return sub_formatters[name]
         raise AttributeError(f"'Formatter' object has no attribute '{name}'")
     
     def format(self, **kwargs)->str:
@@ -106,34 +110,123 @@ class CodeFunctionCallingFormatter(FunctionCallingFormatter):
         return self.sep_start + '\n'.join(self._format_call(call) for call in calls) + self.sep_end
         
 
-class GetFunctionExampleFormatter(Formatter):
-    def __init__(self, examples_file:str, call_formatter: FunctionCallingFormatter) -> None:
-        super().__init__("")
+class ExampleStore:
+    """
+    the examples (query and answers) of a jsonl dataset such as data/DroidCall_train.jsonl, read once per file and
+    shared by the example formatters of the Planner, gen_solution's Handler and MessageTemplate (ExampleStore.get).
+    index: function name -> ids of the examples that call it, in file order.
+    single_index: the same, for the examples with a single call.
+    scores(query): the BM25 similarity of the query of every example to query.
+    similar(query, k, ids=None): the ids of the k examples whose query is the closest to query, among ids if given.
+    """
+    _stores: Dict[str, "ExampleStore"] = {}
+
+    def __init__(self, path: str) -> None:
+        self.path = path
         self.examples = []
-        with open(examples_file) as f:
+        self.index: Dict[str, List[int]] = {}
+        self.single_index: Dict[str, List[int]] = {}
+        with open(path) as f:
             for line in f:
                 item = json.loads(line)
-                if len(item["answers"]) == 1:
-                    self.examples.append(item)
-        
+                i = len(self.examples)
+                self.examples.append(item)
+                for name in dict.fromkeys(ans["name"] for ans in item["answers"]):
+                    self.index.setdefault(name, []).append(i)
+                    if len(item["answers"]) == 1:
+                        self.single_index.setdefault(name, []).append(i)
+        self._bm25 = None
+
+    @staticmethod
+    def get(path: str) -> "ExampleStore":
+        key = os.path.abspath(path)
+        store = ExampleStore._stores.get(key)
+        if store is None:
+            store = ExampleStore._stores[key] = ExampleStore(path)
+        return store
+
+    def scores(self, query: str):
+        if self._bm25 is None:
+            from .similarity import BM25Index
+            self._bm25 = BM25Index([example["query"] for example in self.examples])
+        return self._bm25.scores(query)
+
+    def similar(self, query: str, k: int, ids: List[int] = None) -> List[int]:
+        import numpy as np
+        scores = self.scores(query)
+        if ids is None:
+            return np.argsort(-scores, kind="stable")[:k].tolist()
+        return [ids[i] for i in np.argsort(-scores[ids], kind="stable")[:k]]
+
+
+class GetFunctionExampleFormatter(Formatter):
+    """
+    an example for each tool of the prompt: the first example of examples_file with a single call to it, or the one
+    whose query is the closest to the query of the prompt if similar is set (see ExampleStore).
+    """
+    def __init__(self, examples_file:str, call_formatter: FunctionCallingFormatter, similar: bool = False) -> None:
+        super().__init__("")
+        self.examples_file = examples_file
         self.call_formatter = call_formatter
+        self.similar = similar
+
+    @property
+    def store(self) -> ExampleStore:
+        # read on first use, so that the templates of MessageTemplate do not read their examples at import
+        return ExampleStore.get(self.examples_file)
+
+    @property
+    def examples(self) -> list:
+        store = self.store
+        return [example for example in store.examples if len(example["answers"]) == 1]
     
     def format(self, **kwargs)->str:
         result_text = "Following are some examples:\n"
-        
+        store = self.store
+        scores = store.scores(kwargs.get("query", "")) if self.similar else None
         for tool in kwargs["tools"]:
-            for example in self.examples:
-                ok = False
-                for ans in example["answers"]:
-                    if ans["name"] == tool["name"]:
-                        ok = True
-                        break
-                if ok:
-                    result_text += f"query: {example['query']}\nanswers: \n{self.call_formatter.format(calls=example['answers'])}\n\n"
-                    break
+            ids = store.single_index.get(tool["name"])
+            if not ids:
+                continue
+            # the first of the best, like a stable sort
+            example = store.examples[ids[int(scores[ids].argmax())] if self.similar else ids[0]]
+            result_text += f"query: {example['query']}\nanswers: \n{self.call_formatter.format(calls=example['answers'])}\n\n"
         return result_text
     
+class _Tool(dict):
+    # a tool of load_tools, schema_key = (name, hash of its document) identifies its renderings
+    schema_key: tuple = None
+
+
+_LOADED_TOOLS: Dict[str, _Tool] = {}
+_MAX_LOADED_TOOLS = 4096
+
+
+def load_tools(documents: List[str]) -> List[dict]:
+    """
+    the tools of json documents (as the retrievers return them), parsed once per document.
+    FunctionFormatter renders each of them once, the dicts are shared so they must not be modified.
+    """
+    tools = []
+    for doc in documents:
+        tool = _LOADED_TOOLS.get(doc)
+        if tool is None:
+            tool = _Tool(json.loads(doc))
+            tool.schema_key = (tool.get("name"), hashlib.sha1(doc.encode()).hexdigest())
+            if len(_LOADED_TOOLS) >= _MAX_LOADED_TOOLS:
+                _LOADED_TOOLS.clear()
+            _LOADED_TOOLS[doc] = tool
+        tools.append(tool)
+    return tools
+
+
 class FunctionFormatter(Formatter):
+    """
+    renders the tools of the prompt. the renderings of the tools of load_tools are cached by
+    (format_type, name, schema hash), other dicts are rendered every time.
+    """
+    _rendered: Dict[tuple, str] = {}
+
     def __init__(self, format_type: str = "json"):
         super().__init__("")
         self.format_type = format_type
@@ -144,6 +237,11 @@ class FunctionFormatter(Formatter):
     def _format_json(tools: dict) -> str:
         return json.dumps(tools, ensure_ascii=False, indent=2)
 
+    @staticmethod
+    def _format_json_single_tool(tool) -> str:
+        # the tool as an element of the list of _format_json
+        return "  " + json.dumps(tool, ensure_ascii=False, indent=2).replace("\n", "\n  ")
+
     @staticmethod
     def _format_code_single_tool(tool) -> str:
         # Initialize an empty list to hold each line of the formatted description
@@ -201,9 +299,29 @@ class FunctionFormatter(Formatter):
         'code': _format_code
     }
 
+    # how _format_methods join the tools
+    _single_tool_methods = {
+        'json': (_format_json_single_tool, "[\n", ",\n", "\n]"),
+        'code': (_format_code_single_tool, "", "\n" + "="*50 + "\n", ""),
+    }
+
+    def _render(self, tool) -> str:
+        format_single_tool = self._single_tool_methods[self.format_type][0]
+        key = getattr(tool, "schema_key", None)
+        if key is None:
+            return format_single_tool(tool)
+        key = (self.format_type,) + key
+        rendered = FunctionFormatter._rendered.get(key)
+        if rendered is None:
+            rendered = FunctionFormatter._rendered[key] = format_single_tool(tool)
+        return rendered
+
     def format(self, **kwargs) -> str:
-        formatter = self._format_methods[self.format_type]
-        return formatter(kwargs.get("tools", {}))
+        tools = kwargs.get("tools", {})
+        if not tools:
+            return self._format_methods[self.format_type](tools)
+        _, start, sep, end = self._single_tool_methods[self.format_type]
+        return start + sep.join(self._render(tool) for tool in tools) + end
         
 
 
@@ -0,0 +1,434 @@
+import json
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from typing import List, Dict, Tuple, Optional, Iterable
+
+import torch
+from transformers import LogitsProcessor
+
+# a grammar state is a stack of frames (tuples), the top is the last one.
+# advance() consumes one char, a frame that is done pops itself and lets the frame below see the same char.
+# END is fed to tell if the text can stop here, only ("end",) accepts it.
+END = "\x03"
+# json.dumps only writes spaces and newlines, other whitespace trips the extractors
+WS = " \n"
+MAX_WS = 16
+# digits of the call ids (resultN, "id": N)
+MAX_ID_DIGITS = 4
+_DIGITS = "0123456789"
+
+
+def _lit(s: str):
+    return ("lit", s, 0)
+
+
+def _choice(options: Iterable[str], tag: str = ""):
+    return ("choice", tuple(sorted(options)), "", tag)
+
+
+def _ws():
+    return ("ws", 0)
+
+
+def _push(stack: tuple, *frames) -> tuple:
+    # frames are given in the order they are matched
+    return stack + tuple(reversed(frames))
+
+
+class CallGrammar(ABC):
+    """
+    a character level recognizer of the function calls an extractor can parse, the functions and their
+    arguments are restricted to the given tools.
+    tools: the tool schemas, e.g. [json.loads(doc) for doc in documents].
+    state = initial(), then state = advance(state, char) for every char of the output, None if it is not allowed.
+    accepts(state): the output can end here.
+    """
+    def __init__(self, tools: List[Dict], sep_start: str = "", sep_end: str = ""):
+        self.functions = {tool["name"]: tuple(tool.get("arguments", {}) or {}) for tool in tools}
+        self.sep_start = sep_start
+        self.sep_end = sep_end
+        self._memo: Dict[Tuple[tuple, str], Optional[tuple]] = {}
+        # token masks of the states, filled by GrammarLogitsProcessor
+        self.masks: Dict[tuple, torch.Tensor] = {}
+
+    @abstractmethod
+    def initial(self) -> tuple:
+        pass
+
+    def accepts(self, state: tuple) -> bool:
+        return self.advance(state, END) == ("accept",)
+
+    def advance(self, state: tuple, c: str) -> Optional[tuple]:
+        key = (state, c)
+        if key not in self._memo:
+            self._memo[key] = self._advance(state, c)
+        return self._memo[key]
+
+    def advance_text(self, state: Optional[tuple], text: str) -> Optional[tuple]:
+        for c in text:
+            if state is None:
+                return None
+            state = self.advance(state, c)
+        return state
+
+    def matches(self, text: str) -> bool:
+        state = self.advance_text(self.initial(), text)
+        return state is not None and self.accepts(state)
+
+    @staticmethod
+    def in_string(state: tuple) -> bool:
+        # inside a string any char but quotes, backslashes and control chars is allowed
+        return bool(state) and state[-1] == ("jstring", False)
+
+    def _frame(self, stack: tuple, frame: tuple, c: str) -> Optional[tuple]:
+        # returns the new stack, or None if c is not allowed. subclasses handle their own frames
+        return None
+
+    def _advance(self, stack: tuple, c: str) -> Optional[tuple]:
+        while stack:
+            frame, rest = stack[-1], stack[:-1]
+            kind = frame[0]
+            if kind == "end":
+                return ("accept",) if c == END else None
+            if kind == "lit":
+                s, i = frame[1], frame[2]
+                if c != s[i]:
+                    return None
+                return rest if i + 1 == len(s) else rest + (("lit", s, i + 1),)
+            if kind == "choice":
+                typed = frame[2] + c
+                options = tuple(o for o in frame[1] if o.startswith(typed))
+                if not options:
+                    return None
+                if typed in options:
+                    return self._chosen(rest, frame[3], typed)
+                return rest + (("choice", options, typed, frame[3]),)
+            if kind == "ws":
+                if c in WS:
+                    return rest + (("ws", frame[1] + 1),) if frame[1] < MAX_WS else None
+                stack = rest
+                continue
+            if kind == "digits":
+                if c in _DIGITS:
+                    return rest + (("digits", frame[1] + 1),) if frame[1] < MAX_ID_DIGITS else None
+                if frame[1] == 0:
+                    return None
+                stack = rest
+                continue
+            if kind == "jvalue":
+                if c == '"':
+                    return rest + (("jstring", False),)
+                if c == "-" or c in _DIGITS:
+                    stack = rest + (("jnumber", "start"),)
+                    continue
+                if c == "[":
+                    return _push(rest, _ws(), ("jarray", "first"))
+                if c == "{":
+                    return _push(rest, _ws(), ("jobject", "first"))
+                stack = rest + (_choice(["true", "false", "null"]),)
+                continue
+            if kind == "jstring":
+                if c == END or (c < " " and not frame[1]):
+                    return None
+                if frame[1]:
+                    return rest + (("jstring", False),) if c in '"\\/bfnrtu' else None
+                if c == "\\":
+                    return rest + (("jstring", True),)
+                if c == '"':
+                    return rest
+                return stack
+            if kind == "jnumber":
+                stage = _number_stage(frame[1], c)
+                if stage is not None:
+                    return rest + (("jnumber", stage),)
+                if frame[1] not in ("int0", "int", "frac", "exp"):
+                    return None
+                stack = rest
+                continue
+            if kind == "jarray":
+                stage = frame[1]
+                if stage == "first":
+                    if c == "]":
+                        return rest
+                    stack = _push(rest, ("jvalue",), _ws(), ("jarray", "after"))
+                    continue
+                if stage == "after":
+                    if c == ",":
+                        return _push(rest, _ws(), ("jvalue",), _ws(), ("jarray", "after"))
+                    if c == "]":
+                        return rest
+                    return None
+            if kind == "jobject":
+                stage = frame[1]
+                if stage in ("first", "key"):
+                    if c == "}" and stage == "first":
+                        return rest
+                    if c != '"':
+                        return None
+                    return _push(rest, ("jstring", False), _ws(), _lit(":"), _ws(), ("jvalue",), _ws(),
+                                 ("jobject", "after"))
+                if stage == "after":
+                    if c == ",":
+                        return _push(rest, _ws(), ("jobject", "key"))
+                    if c == "}":
+                        return rest
+                    return None
+            return self._frame(rest, frame, c)
+        return None
+
+    def _chosen(self, stack: tuple, tag: str, option: str) -> Optional[tuple]:
+        # called when a choice is complete
+        return stack
+
+
+def _number_stage(stage: str, c: str) -> Optional[str]:
+    # the state machine of a json number: -?(0|[1-9]\d*)(\.\d+)?([eE][+-]?\d+)?
+    digit = c in _DIGITS
+    if stage == "start":
+        return "sign" if c == "-" else ("int0" if c == "0" else ("int" if digit else None))
+    if stage == "sign":
+        return "int0" if c == "0" else ("int" if digit else None)
+    if stage in ("int0", "int"):
+        if digit and stage == "int":
+            return "int"
+        return "frac_start" if c == "." else ("exp_start" if c in "eE" else None)
+    if stage in ("frac_start", "frac"):
+        if digit:
+            return "frac"
+        return "exp_start" if c in "eE" and stage == "frac" else None
+    if stage == "exp_start":
+        return "exp_sign" if c in "+-" else ("exp" if digit else None)
+    if stage in ("exp_sign", "exp"):
+        return "exp" if digit else None
+    return None
+
+
+class CodeCallGrammar(CallGrammar):
+    """
+    the code format parsed by extract_calls, one call per line:
+        sep_start result0 = FUNC(ARG="value", ARG2=result0, ARG3=[1, 2]) \\n result1 = ... sep_end
+    values are double quoted strings, numbers, resultN references, json lists/dicts, True/False/None.
+    each argument is given at most once.
+    """
+    def initial(self) -> tuple:
+        stack = (("end",),)
+        if self.sep_end:
+            stack += (_lit(self.sep_end),)
+        stack += (("calls", "first"),)
+        if self.sep_start:
+            stack += (_lit(self.sep_start),)
+        return stack
+
+    def _frame(self, rest: tuple, frame: tuple, c: str) -> Optional[tuple]:
+        kind = frame[0]
+        if kind == "calls":
+            if frame[1] == "first":
+                stack = _push(rest, _lit("result"), ("digits", 0), _lit(" = "),
+                              _choice([name + "(" for name in self.functions], "func"), ("calls", "more"))
+                return self._advance(stack, c)
+            if c == "\n":
+                return rest + (("calls", "first"),)
+            return self._advance(rest, c)
+        if kind == "args":
+            name, used, stage = frame[1], frame[2], frame[3]
+            if stage == "after":
+                if c == ",":
+                    return rest + (("args", name, used, "space"),)
+                return rest if c == ")" else None
+            if stage == "start" and c == ")":
+                return rest
+            if stage == "space" and c == " ":
+                return rest + (("args", name, used, "arg"),)
+            options = [arg + "=" for arg in self.functions[name] if arg not in used]
+            if not options:
+                return None
+            return self._advance(rest + (("args", name, used, "value"), _choice(options, "arg")), c)
+        if kind == "cvalue":
+            if c == "r":
+                return self._advance(_push(rest, _lit("result"), ("digits", 0)), c)
+            if c in '"-[{' or c in _DIGITS:
+                return self._advance(rest + (("jvalue",),), c)
+            return self._advance(rest + (_choice(["True", "False", "None", "true", "false", "null"]),), c)
+        return None
+
+    def _chosen(self, stack: tuple, tag: str, option: str) -> Optional[tuple]:
+        if tag == "func":
+            return stack + (("args", option[:-1], (), "start"),)
+        if tag == "arg":
+            _, name, used, _ = stack[-1]
+            return stack[:-1] + (("args", name, used + (option[:-1],), "after"), ("cvalue",))
+        return stack
+
+
+class JsonCallGrammar(CallGrammar):
+    """
+    the json format of JsonFunctionCallingFormatter, with any whitespace between the tokens:
+        sep_start [{"id": 0, "name": "FUNC", "arguments": {"ARG": value, ...}}, ...] sep_end
+    """
+    def initial(self) -> tuple:
+        stack = (("end",),)
+        if self.sep_end:
+            stack += (_lit(self.sep_end),)
+        stack += (_ws(), ("jcalls", "first"), _ws(), _lit("["), _ws())
+        if self.sep_start:
+            stack += (_lit(self.sep_start),)
+        return stack
+
+    def _call(self, stack: tuple) -> tuple:
+        return _push(stack, _lit("{"), _ws(), _lit('"id"'), _ws(), _lit(":"), _ws(), ("digits", 0), _ws(), _lit(","),
+                     _ws(), _lit('"name"'), _ws(), _lit(":"), _ws(), _lit('"'),
+                     _choice([name + '"' for name in self.functions], "func"))
+
+    def _frame(self, rest: tuple, frame: tuple, c: str) -> Optional[tuple]:
+        kind = frame[0]
+        if kind == "jcalls":
+            if frame[1] == "first":
+                return self._advance(self._call(rest + (("jcalls", "after"),)), c)
+            if c == ",":
+                return _push(rest, _ws(), ("jcalls", "first"))
+            return rest if c == "]" else None
+        if kind == "jargs":
+            name, used, stage = frame[1], frame[2], frame[3]
+            if stage == "after":
+                if c == ",":
+                    return _push(rest, _ws(), ("jargs", name, used, "key"))
+                return rest if c == "}" else None
+            if c == "}" and stage == "first":
+                return rest
+            options = [arg + '"' for arg in self.functions[name] if arg not in used]
+            if c != '"' or not options:
+                return None
+            return rest + (("jargs", name, used, "value"), _choice(options, "arg"))
+        return None
+
+    def _chosen(self, stack: tuple, tag: str, option: str) -> Optional[tuple]:
+        if tag == "func":
+            return _push(stack, _ws(), _lit(","), _ws(), _lit('"arguments"'), _ws(), _lit(":"), _ws(), _lit("{"), _ws(),
+                         ("jargs", option[:-1], (), "first"), _ws(), _lit("}"), _ws())
+        if tag == "arg":
+            _, name, used, _ = stack[-1]
+            return _push(stack[:-1], _ws(), _lit(":"), _ws(), ("jvalue",), _ws(),
+                         ("jargs", name, used + (option[:-1],), "after"))
+        return stack
+
+
+def make_grammar(format_type: str, documents: List[str], sep_start: str = "", sep_end: str = "") -> CallGrammar:
+    tools = [json.loads(doc) for doc in documents]
+    if format_type in ["code", "code_short"]:
+        return CodeCallGrammar(tools, sep_start, sep_end)
+    if format_type in ["json", "json_short"]:
+        return JsonCallGrammar(tools, sep_start, sep_end)
+    raise ValueError(f"no grammar for format {format_type}")
+
+
+class TokenTable:
+    """
+    the text of every token of a tokenizer, sorted so that the tokens starting with a prefix are a contiguous range.
+    tokens are decoded after an anchor token so that tokenizers that drop a leading space keep it.
+    """
+    _tables: Dict[Tuple[str, int], "TokenTable"] = {}
+
+    def __init__(self, tokenizer):
+        anchor = tokenizer.convert_tokens_to_ids(tokenizer.tokenize("a"))[:1]
+        anchor_text = tokenizer.decode(anchor)
+        special = set(tokenizer.all_special_ids)
+        texts = tokenizer.batch_decode([anchor + [i] for i in range(len(tokenizer))])
+        # a token whose text holds END (e.g. the byte token "\x03") would read as the end of the output, the
+        # grammar never needs it, so eos stays the only way to end
+        pairs = sorted((text[len(anchor_text):], i) for i, text in enumerate(texts)
+                       if i not in special and text.startswith(anchor_text) and len(text) > len(anchor_text)
+                       and END not in text)
+        self.texts = [text for text, _ in pairs]
+        self.ids = [i for _, i in pairs]
+        self.text_of = dict((i, text) for text, i in pairs)
+        self.size = len(tokenizer)
+        # tokens that may appear anywhere inside a string, and the others that have to be checked one by one
+        plain = [all(c >= " " and c not in '"\\' for c in text) for text in self.texts]
+        self.plain_ids = torch.tensor([i for i, p in zip(self.ids, plain) if p], dtype=torch.long)
+        self.special_positions = [k for k, p in enumerate(plain) if not p]
+
+    @classmethod
+    def get(cls, tokenizer) -> "TokenTable":
+        key = (tokenizer.name_or_path, len(tokenizer))
+        if key not in cls._tables:
+            cls._tables[key] = TokenTable(tokenizer)
+        return cls._tables[key]
+
+    def allowed(self, grammar: CallGrammar, state: tuple) -> List[int]:
+        # ids of the tokens whose whole text is allowed from state
+        allowed = []
+        if grammar.in_string(state):
+            for k in self.special_positions:
+                if grammar.advance_text(state, self.texts[k]) is not None:
+                    allowed.append(self.ids[k])
+            return allowed
+        self._walk(grammar, state, 0, len(self.texts), 0, allowed)
+        return allowed
+
+    def _walk(self, grammar: CallGrammar, state: tuple, lo: int, hi: int, depth: int, allowed: List[int]):
+        # the tokens in [lo, hi) share their first depth chars, which lead to state
+        texts = self.texts
+        while lo < hi and len(texts[lo]) == depth:
+            allowed.append(self.ids[lo])
+            lo += 1
+        in_string = grammar.in_string(state)
+        while lo < hi:
+            c = texts[lo][depth]
+            # out of strings the grammar only allows ascii, and the rest of the range sorts after it
+            if c >= "\x80" and not in_string:
+                return
+            end = bisect_left(texts, texts[lo][:depth] + chr(ord(c) + 1), lo, hi)
+            next_state = grammar.advance(state, c)
+            if next_state is not None:
+                self._walk(grammar, next_state, lo, end, depth + 1, allowed)
+            lo = end
+
+
+class GrammarLogitsProcessor(LogitsProcessor):
+    """
+    masks the logits of the tokens that would make the output of a row leave its grammar, so that the output
+    always parses. eos is only allowed where the grammar can end.
+    grammars: one per row of the batch (e.g. each row has its own retrieved tools).
+    prompt_length: the (padded) length of the prompts, the output starts after it.
+    """
+    def __init__(self, tokenizer, grammars: List[CallGrammar], prompt_length: int, eos_token_id=None):
+        self.table = TokenTable.get(tokenizer)
+        self.grammars = grammars
+        self.prompt_length = prompt_length
+        if eos_token_id is None:
+            eos_token_id = tokenizer.eos_token_id
+        self.eos_token_ids = list(eos_token_id) if isinstance(eos_token_id, (list, tuple)) else [eos_token_id]
+        # generate pads the rows that are done
+        self.end_token_ids = self.eos_token_ids + (
+            [tokenizer.pad_token_id] if tokenizer.pad_token_id is not None else [])
+        self.states = [grammar.initial() for grammar in grammars]
+        self._consumed = prompt_length
+
+    def _mask(self, row: int, vocab_size: int, device) -> torch.Tensor:
+        grammar, state = self.grammars[row], self.states[row]
+        key = (id(self.table), vocab_size, state)
+        if key not in grammar.masks:
+            mask = torch.zeros(vocab_size, dtype=torch.bool)
+            if state is not None and state != ("accept",):
+                if grammar.in_string(state):
+                    mask[self.table.plain_ids] = True
+                allowed = self.table.allowed(grammar, state)
+                if allowed:
+                    mask[torch.tensor(allowed, dtype=torch.long)] = True
+                if grammar.accepts(state):
+                    mask[self.eos_token_ids] = True
+            else:
+                # the row emitted eos (("accept",)) or left the grammar after it, it only gets padding
+                mask[self.end_token_ids] = True
+            grammar.masks[key] = mask
+        return grammar.masks[key].to(device)
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        for row in range(input_ids.size(0)):
+            for token in input_ids[row, self._consumed:].tolist():
+                if self.states[row] is not None:
+                    self.states[row] = self.grammars[row].advance_text(self.states[row],
+                                                                        self.table.text_of.get(token, END))
+        self._consumed = input_ids.size(1)
+        masks = torch.stack([self._mask(row, scores.size(-1), scores.device) for row in range(input_ids.size(0))])
+        return scores.masked_fill(~masks, -float("inf"))
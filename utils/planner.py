@@ -1,7 +1,9 @@
-from .extract import extract_and_parse_jsons
-from .utils import GenerateResponse
+from .extract import CallExtractor
+from .utils import GenerateResponse, Colors
 from .executor import Executor, Call, Result
 import json
+import copy
+from typing import Dict
 from .prompt import JSON_NESTED_CALLING_PROMT, FUNCTION_CALLING_PROMPT_FOR_CHAT_MODEL, JSON_CALL_FORMAT
 from string import Template
 from .retriever import Retriever
@@ -11,7 +13,7 @@ from .formatter import *
 class Planner:
     def __init__(self, llm: GenerateResponse, executor: Executor, retriever: Retriever, retriever_num: int = 2,
                  fewshot: bool = False, examples_file: str = None, is_nested: bool = False, format_type: str="code_short",
-                 verbose: bool = False):
+                 verbose: bool = False, similar_examples: bool = False):
         self.calls = []
         self.llm = llm
         self.executor = executor
@@ -25,10 +27,11 @@ class Planner:
         self.sep_start = ""
         self.sep_end = ""
         
+        self.examples_file = examples_file
+        self.similar_examples = similar_examples
         if fewshot:
             assert examples_file is not None
-            with open(examples_file) as f:
-                self.examples = [json.loads(line) for line in f]
+            self.examples = ExampleStore.get(examples_file).examples
                 
     _SYSTEM_PROMPT_MAP = {
         "json": SYSTEM_PROMPT_FOR_FUNCTION_CALLING,
@@ -64,17 +67,27 @@ class Planner:
         self.sep_start = sep_start
         self.sep_end = sep_end
                 
-    def format_user_message(self, query: str, docs: list[str], is_nested: bool = False):
+    # prompt formatter trees, built once per configuration
+    _USER_FORMATTERS: Dict[tuple, Formatter] = {}
+    
+    def _user_formatter(self, is_nested: bool) -> Formatter:
+        key = (type(self), self.format_type, self.sep_start, self.sep_end, is_nested, self.fewshot, self.examples_file,
+               self.similar_examples)
+        user_formatter = Planner._USER_FORMATTERS.get(key)
+        if user_formatter is not None:
+            return user_formatter
         func_format_type = self.format_type
         if self.format_type in ["code", "code_short"]:
             func_format_type = "code"
         
+        # copies, set_sep must not change the formatters of the other configurations
         user_formatter= Formatter(
             Planner._CALL_PROMPT_MAP[self.format_type],
             functions=FunctionFormatter(func_format_type),
-            call_format=Planner._CALL_FORMAT_MAP[self.format_type],
+            call_format=copy.copy(Planner._CALL_FORMAT_MAP[self.format_type]),
             nest_prompt=Planner._NEST_CALL_MAP[self.format_type] if is_nested else ConstantFormatter(""),
-            example=GetFunctionExampleFormatter("data/DroidCall_train.jsonl", Planner._FUNCTION_CALL_MAP[self.format_type]) if self.fewshot else ConstantFormatter(""),
+            example=GetFunctionExampleFormatter(self.examples_file, copy.copy(Planner._FUNCTION_CALL_MAP[self.format_type]),
+                                                self.similar_examples) if self.fewshot else ConstantFormatter(""),
             user_query=FieldFormatter("query"),
         )
         
@@ -82,11 +95,13 @@ class Planner:
             user_formatter.call_format.set_sep(self.sep_start, self.sep_end)
         if isinstance(user_formatter.example, GetFunctionExampleFormatter):
             user_formatter.example.call_formatter.set_sep(self.sep_start, self.sep_end)
-            
-        tools = [json.loads(doc) for doc in docs]
-        user_message = user_formatter.format(
+        Planner._USER_FORMATTERS[key] = user_formatter
+        return user_formatter
+                
+    def format_user_message(self, query: str, docs: list[str], is_nested: bool = False):
+        user_message = self._user_formatter(is_nested).format(
             query=query,
-            tools=tools
+            tools=load_tools(docs)
         )
         
         return user_message
@@ -114,39 +129,59 @@ class Planner:
         # return self.PROMPT.substitute(user_query=query, functions="\n".join(docs), nest_prompt=nest_prompt, example=example_text, call_format=JSON_CALL_FORMAT)
     
     
-    def plan(self, query: str):
+    def _prompt(self, query: str):
         docs = self.retriever.retrieve(query, self.retriever_num)
         if self.verbose:
-            from utils import Colors
             for i, doc in enumerate(docs):
                 print(f"{Colors.FAIL}doc {i}: {doc}\n{Colors.ENDC}")
         user_message = self.format_user_message(query, docs, self.is_nested)
-        response = self.llm("", [user_message], max_new_tokens=200, do_sample=False)[0]["text"]
+        stop_at_call = dict(sep_start=self.sep_start, sep_end=self.sep_end, json_format=self.format_type == "json")
+        return user_message, stop_at_call
+    
+    def _extractor(self) -> CallExtractor:
+        return CallExtractor.get_extractor("json" if self.format_type == "json" else "code")
+    
+    @staticmethod
+    def _to_call(item):
+        if isinstance(item, dict) and "name" in item:
+            if "arguments" not in item or not isinstance(item["arguments"], dict):
+                item["arguments"] = {}
+            return Call(name=item["name"], arguments=item["arguments"])
+        return None
+    
+    def plan(self, query: str):
+        user_message, stop_at_call = self._prompt(query)
+        response = self.llm("", [user_message], max_new_tokens=200, do_sample=False, stop_at_call=stop_at_call)[0]["text"]
         print(f"{Colors.WARNING}user: {user_message}{Colors.ENDC}")
         print(f"{Colors.OKBLUE}response: {response}\n{Colors.ENDC}")
-        res = [call for call in extract_and_parse_jsons(response)]
-        
-        def filter(item):
-            if isinstance(item, dict) and "name" in item:
-                if "arguments" not in item or not isinstance(item["arguments"], dict):
-                    item["arguments"] = {}
-                return True
-            return False
+        res = list(self._extractor().extract(response))
         
         if self.verbose:
             for i, call in enumerate(res):
                 print(f"{Colors.BOLD}call {i}: {call}\n{Colors.ENDC}")
-        self.calls = [Call(name=call["name"], arguments=call["arguments"]) for call in res if filter(call)]
+        self.calls = [call for call in map(Planner._to_call, res) if call is not None]
         
     def plan_and_execute(self, query: str)->tuple[bool, str]:
-        self.plan(query)
-        
-        for call in self.calls:
+        """
+        the response is streamed (GenerateResponse.stream) and every call is executed as soon as it is complete,
+        while the model still writes the next ones. stops at the first call that fails.
+        """
+        user_message, stop_at_call = self._prompt(query)
+        if self.verbose:
+            print(f"{Colors.WARNING}user: {user_message}{Colors.ENDC}")
+        self.calls = []
+        chunks = self.llm.stream("", user_message, max_new_tokens=200, do_sample=False, stop_at_call=stop_at_call)
+        for i, item in enumerate(self._extractor().stream(chunks)):
+            if self.verbose:
+                print(f"{Colors.BOLD}call {i}: {item}\n{Colors.ENDC}")
+            call = Planner._to_call(item)
+            if call is None:
+                continue
+            self.calls.append(call)
             result = self.executor.execute(call)
             if result.state == "error":
                 return False, result.message
             if self.verbose:
-                from utils import Colors
                 print(f"{Colors.OKGREEN}result: {result}{Colors.ENDC}")
                 
         return True, "All calls executed successfully"
@@ -1,10 +1,14 @@
 import json
-from typing import List
+from collections import Counter, OrderedDict
+from typing import Dict, List
 import chromadb
 import random
+import numpy as np
 from utils import GenerateResponse
 from string import Template
 from utils.extract import get_json_obj
+from utils.formatter import FunctionFormatter
+from utils.similarity import BM25Index, words
 
 
 RETRIEVE_PROMPT = Template("""
@@ -26,6 +30,13 @@ ALSO REMEMBER YOU SHOULD GIVE $n_results APIs BASE ON THE RELEVANCE.
 class Retriever:
     def retrieve(self, query: str, n_results: int) -> List[str]:
         pass
+
+    def retrieve_many(self, queries: List[str], n_results: int) -> List[List[str]]:
+        """
+        the documents of every query, as retrieve would return them one by one. the retrievers override it to
+        embed (or prompt) the queries in batches and search them at once.
+        """
+        return [self.retrieve(query, n_results) for query in queries]
     
 class LLMRetriever(Retriever):
     def __init__(self, data_path: str, llm: GenerateResponse):
@@ -47,46 +58,152 @@ class LLMRetriever(Retriever):
     
         
     def retrieve(self, query: str, n_results: int) -> List[str]:
-        user_message = RETRIEVE_PROMPT.substitute(
-            apis=self.apis_text,
-            query=query,
-            n_results=n_results,
-        )
+        return self.retrieve_many([query], n_results)[0]
+
+    def retrieve_many(self, queries: List[str], n_results: int) -> List[List[str]]:
+        user_messages = [
+            RETRIEVE_PROMPT.substitute(
+                apis=self.apis_text,
+                query=query,
+                n_results=n_results,
+            )
+            for query in queries
+        ]
         
-        resp = self.llm('', [user_message], max_new_tokens=500)[0]
+        # one batched generation for all the queries
+        resps = self.llm('', user_messages, max_new_tokens=500)
         # print(f"response: {resp["text"]}\n")
-        apis = get_json_obj(resp["text"])
-        documents = [
-            json.dumps(self.apis[name]) for name in apis if name in self.apis
-        ]
-        return documents
+        results = []
+        for resp in resps:
+            apis = get_json_obj(resp["text"])
+            if not isinstance(apis, list):
+                # no json list in the response
+                apis = []
+            results.append([
+                json.dumps(self.apis[name]) for name in apis if name in self.apis
+            ])
+        return results
 
 from chromadb import Documents, EmbeddingFunction, Embeddings
 from transformers import AutoTokenizer, AutoModel
 from torch import Tensor
+import os
+import threading
+import torch
+
 
 class GTEEmbedding(EmbeddingFunction):
-    def __init__(self, path: str, device: str="cpu"):
+    """
+    average pooled embeddings of a GTE model, also the embedding function of the chroma collection.
+    the texts are sorted by token length and embedded in micro batches of batch_size, each padded to its own
+    longest text, under torch.inference_mode.
+    backend: "torch", "int8" (linear layers quantized to int8 with torch dynamic quantization, CPU only) or
+        "onnx" (onnxruntime on CPU, the model is exported to onnx_path once, default path/model.onnx).
+    cache_size: embeddings kept in an LRU keyed by the text with its whitespace collapsed, 0 disables it.
+        a query asked again (the same instruction in the evaluation, a repeated command in the agent)
+        runs the model only once.
+    """
+    def __init__(self, path: str, device: str="cpu", batch_size: int = 32, backend: str = "torch",
+                 cache_size: int = 4096, onnx_path: str = ""):
+        if backend not in ("torch", "int8", "onnx"):
+            raise ValueError(f"Unsupported backend {backend}")
+        if backend != "torch" and device != "cpu":
+            raise ValueError(f"backend {backend} runs on cpu only")
         self.tokenizer = AutoTokenizer.from_pretrained(path)
-        self.model = AutoModel.from_pretrained(path, device_map=device)
+        self.model = AutoModel.from_pretrained(path, device_map=device).eval()
+        self.batch_size = batch_size
+        self.backend = backend
+        self.session = None
+        if backend == "int8":
+            self.model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        elif backend == "onnx":
+            self.session = self._onnx_session(onnx_path or os.path.join(path, "model.onnx"))
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
     
     @staticmethod
     def average_pool(last_hidden_states: Tensor,
                  attention_mask: Tensor) -> Tensor:
         last_hidden = last_hidden_states.masked_fill(~attention_mask[..., None].bool(), 0.0)
         return last_hidden.sum(dim=1) / attention_mask.sum(dim=1)[..., None]
+
+    def _onnx_session(self, onnx_path: str):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError("backend onnx needs onnxruntime, pip install onnxruntime")
+        if not os.path.exists(onnx_path):
+            names = list(self.tokenizer(["a"], return_tensors="pt").keys())
+            model = self.model
+
+            class LastHiddenState(torch.nn.Module):
+                def __init__(self):
+                    super().__init__()
+                    self.model = model
+
+                def forward(self, *inputs):
+                    return self.model(**dict(zip(names, inputs))).last_hidden_state
+
+            example = self.tokenizer(["an example", "an example text"], padding=True, return_tensors="pt")
+            axes = {name: {0: "batch", 1: "sequence"} for name in names + ["last_hidden_state"]}
+            # the exporter needs the onnx package as well
+            torch.onnx.export(LastHiddenState(), tuple(example[name] for name in names), onnx_path,
+                              input_names=names, output_names=["last_hidden_state"], dynamic_axes=axes, dynamo=False)
+        return onnxruntime.InferenceSession(onnx_path, providers=["CPUExecutionProvider"])
+
+    @torch.inference_mode()
+    def _embed(self, texts: List[str]) -> List[List[float]]:
+        order = list(range(len(texts)))
+        if len(texts) > self.batch_size:
+            encoded = self.tokenizer(texts, max_length=512, truncation=True)["input_ids"]
+            order.sort(key=lambda i: len(encoded[i]))
+        embeddings = [None] * len(texts)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            batch_dict = self.tokenizer([texts[i] for i in batch], max_length=512, padding=True, truncation=True,
+                                        return_tensors='pt')
+            if self.session is not None:
+                inputs = {item.name: batch_dict[item.name].numpy() for item in self.session.get_inputs()}
+                last_hidden_state = torch.from_numpy(self.session.run(None, inputs)[0])
+            else:
+                last_hidden_state = self.model(**batch_dict.to(self.model.device)).last_hidden_state
+            pooled = GTEEmbedding.average_pool(last_hidden_state, batch_dict['attention_mask'].to(last_hidden_state.device))
+            for i, embedding in zip(batch, pooled.tolist()):
+                embeddings[i] = embedding
+        return embeddings
     
     def __call__(self, input_texts: Documents) -> Embeddings:
-        # Tokenize the input texts
-        batch_dict = self.tokenizer(input_texts, max_length=512, padding=True, truncation=True, return_tensors='pt')
-
-        outputs = self.model(**batch_dict.to(self.model.device))
-        # tokens = self.tokenizer.tokenize(input_texts[0])
-        # print(f"tokens: {tokens}\n\n")
-        # print(f"{batch_dict.input_ids.tolist()}\n\n")
-        embeddings = GTEEmbedding.average_pool(outputs.last_hidden_state, batch_dict['attention_mask'])
-        
-        return embeddings.tolist()
+        if not self.cache_size:
+            return self._embed(list(input_texts))
+        keys = [" ".join(text.split()) for text in input_texts]
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    found[key] = self._cache[key]
+            self.hits += sum(key in found for key in keys)
+            self.misses += sum(key not in found for key in keys)
+        # each text missing from the cache is embedded once, even if it is repeated in the input
+        missing = list(dict.fromkeys(key for key in keys if key not in found))
+        if missing:
+            found.update(zip(missing, self._embed(missing)))
+            with self._lock:
+                for key in missing:
+                    self._cache[key] = found[key]
+                    self._cache.move_to_end(key)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return [list(found[key]) for key in keys]
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0.0
+        return (f"embedding cache hits: {self.hits}, misses: {self.misses}, hit rate: {rate:.2%}, "
+                f"entries: {len(self._cache)}")
 
 class ChromaDBRetriever(Retriever):
     def __init__(self, data_path: str, name: str="functions", distance_type: str="l2", emb_func=None) -> None:
@@ -105,16 +222,213 @@ class ChromaDBRetriever(Retriever):
             )
     
     def retrieve(self, query: str, n_results: int) -> List[str]:
+        return self.retrieve_many([query], n_results)[0]
+
+    def retrieve_many(self, queries: List[str], n_results: int) -> List[List[str]]:
+        # the embedding function gets all the queries at once and the index is searched once
+        if not queries:
+            return []
         results = self.collection.query(
-            query_texts=query,
+            query_texts=list(queries),
             n_results=n_results,
         )
-        metas = results["metadatas"][0]
-        documents = [
-            json.dumps(json.loads(meta["json_str"]), indent=2, ensure_ascii=False)
-            for meta in metas
+        return [
+            [json.dumps(json.loads(meta["json_str"]), indent=2, ensure_ascii=False) for meta in metas]
+            for metas in results["metadatas"]
         ]
-        return documents
+
+
+class NumpyRetriever(Retriever):
+    """
+    exact nearest neighbours in memory over a precomputed embedding matrix, for catalogues small enough (the 16 apis
+    of data/api.jsonl) that a matrix-vector product beats an HNSW index behind a database client.
+    vec_path: jsonl with {"embedding": [...], "doc": json of the api} per line, the api_vec.jsonl written by
+        scripts/create_chromaDB.py.
+    emb_func: embeds the queries, the model the embeddings were computed with (e.g. GTEEmbedding).
+    distance_type: "ip", "l2" or "cosine", as the hnsw:space of ChromaDBRetriever.
+    the documents are serialized once, as ChromaDBRetriever returns them.
+    """
+    def __init__(self, vec_path: str, emb_func, distance_type: str = "ip") -> None:
+        super().__init__()
+        if distance_type not in ("ip", "l2", "cosine"):
+            raise ValueError(f"Unsupported distance_type {distance_type}")
+        self.emb_func = emb_func
+        self.distance_type = distance_type
+        embeddings, self.documents = [], []
+        with open(vec_path, "r") as f:
+            for line in f:
+                item = json.loads(line)
+                embeddings.append(item["embedding"])
+                self.documents.append(json.dumps(json.loads(item["doc"]), indent=2, ensure_ascii=False))
+        self.embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        if distance_type == "cosine":
+            self.embeddings /= np.maximum(np.linalg.norm(self.embeddings, axis=1, keepdims=True), 1e-12)
+        # |e|^2 of the l2 distance |e|^2 - 2 e.q + |q|^2, |q|^2 does not change the order
+        self.sq_norms = (self.embeddings ** 2).sum(axis=1)
+
+    def _scores(self, query_embeddings: np.ndarray) -> np.ndarray:
+        # higher is closer, one row per query
+        if self.distance_type == "cosine":
+            query_embeddings = query_embeddings / np.maximum(
+                np.linalg.norm(query_embeddings, axis=1, keepdims=True), 1e-12)
+        scores = query_embeddings @ self.embeddings.T
+        if self.distance_type == "l2":
+            scores = 2 * scores - self.sq_norms
+        return scores
+
+    @staticmethod
+    def _top(scores: np.ndarray, n_results: int) -> List[List[int]]:
+        # the best n_results columns of every row, best first
+        if n_results < scores.shape[1]:
+            top = np.argpartition(-scores, n_results - 1, axis=1)[:, :n_results]
+        else:
+            top = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+        order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1, kind="stable")
+        return np.take_along_axis(top, order, axis=1).tolist()
+
+    def retrieve(self, query: str, n_results: int) -> List[str]:
+        return self.retrieve_many([query], n_results)[0]
+
+    def retrieve_many(self, queries: List[str], n_results: int) -> List[List[str]]:
+        # one embedding call (batched by the embedding function) and one matrix product for all the queries
+        if not queries:
+            return []
+        query_embeddings = np.asarray(self.emb_func(list(queries)), dtype=np.float32).reshape(len(queries), -1)
+        return [[self.documents[i] for i in top] for top in self._top(self._scores(query_embeddings), n_results)]
+
+
+class HybridRetriever(Retriever):
+    """
+    reciprocal rank fusion of BM25 over the code format docs of the apis (the texts scripts/create_chromaDB.py
+    embeds) and a dense NumpyRetriever. the words of the names and arguments tell apart intents the small
+    embedding model mixes up, like START_CALL / MAKE_CALL or READ_EMAIL / WRITE_EMAIL.
+    dense: NumpyRetriever over the api embeddings, its documents are the candidates.
+    rrf_k: the constant of the fused score, sum of 1 / (rrf_k + rank) over both rankings.
+    only the documents sharing a word with the query get the BM25 term, ties go to the dense order.
+    """
+    def __init__(self, dense: NumpyRetriever, rrf_k: float = 60) -> None:
+        super().__init__()
+        self.dense = dense
+        self.rrf_k = rrf_k
+        self.documents = dense.documents
+        formatter = FunctionFormatter(format_type="code")
+        self.bm25 = BM25Index([formatter.format(tools=[json.loads(doc)]) for doc in self.documents])
+
+    @staticmethod
+    def _ranks(scores: np.ndarray) -> np.ndarray:
+        # 1 for the best, ties in the order of the documents
+        ranks = np.empty(len(scores), dtype=np.int64)
+        ranks[np.argsort(-scores, kind="stable")] = np.arange(1, len(scores) + 1)
+        return ranks
+
+    def _fuse(self, query: str, dense_scores: np.ndarray) -> List[int]:
+        bm25_scores = self.bm25.scores(query)
+        dense_ranks = self._ranks(dense_scores)
+        fused = 1 / (self.rrf_k + dense_ranks)
+        fused += np.where(bm25_scores > 0, 1 / (self.rrf_k + self._ranks(bm25_scores)), 0)
+        return np.lexsort((dense_ranks, -fused)).tolist()
+
+    def retrieve(self, query: str, n_results: int) -> List[str]:
+        return self.retrieve_many([query], n_results)[0]
+
+    def retrieve_many(self, queries: List[str], n_results: int) -> List[List[str]]:
+        if not queries:
+            return []
+        query_embeddings = np.asarray(self.dense.emb_func(list(queries)), dtype=np.float32).reshape(len(queries), -1)
+        return [
+            [self.documents[i] for i in self._fuse(query, dense_scores)[:n_results]]
+            for query, dense_scores in zip(queries, self.dense._scores(query_embeddings))
+        ]
+
+
+class ClassifierRetriever(Retriever):
+    """
+    the apis ranked by a linear model over the TF-IDF of the query words and word pairs, with one logistic
+    output per api so that a query with several intents scores each of them. no model call, a query costs a
+    few dictionary lookups and a product with the rows of its terms.
+    model_path: .npz written by scripts/train_classifier.py (the arrays of ClassifierRetriever.train).
+    api_file: the apis the documents come from.
+    """
+    def __init__(self, model_path: str, api_file: str = "data/api.jsonl") -> None:
+        super().__init__()
+        model = np.load(model_path)
+        self.terms = {term: i for i, term in enumerate(model["terms"].tolist())}
+        self.idf = model["idf"]
+        self.weights = model["weights"]
+        self.bias = model["bias"]
+        self.labels = model["labels"].tolist()
+        apis = {}
+        with open(api_file, "r") as f:
+            for line in f:
+                item = json.loads(line)
+                apis[item["name"]] = item
+        missing = [label for label in self.labels if label not in apis]
+        if missing:
+            raise ValueError(f"apis {missing} of the classifier are not in {api_file}")
+        self.documents = [json.dumps(apis[label], indent=2, ensure_ascii=False) for label in self.labels]
+
+    @staticmethod
+    def _terms(text: str) -> List[str]:
+        tokens = words(text)
+        return tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+
+    @staticmethod
+    def _tfidf(texts: List[str], terms: Dict[str, int], idf: np.ndarray) -> np.ndarray:
+        # sublinear term frequency times idf, rows of unit length
+        features = np.zeros((len(texts), len(terms)), dtype=np.float32)
+        for row, text in enumerate(texts):
+            counts = Counter(term for term in ClassifierRetriever._terms(text) if term in terms)
+            for term, count in counts.items():
+                features[row, terms[term]] = (1 + np.log(count)) * idf[terms[term]]
+        features /= np.maximum(np.linalg.norm(features, axis=1, keepdims=True), 1e-12)
+        return features
+
+    @staticmethod
+    def train(instructions: List[dict], labels: List[str], min_df: int = 2, l2: float = 1e-4, epochs: int = 300,
+              lr: float = 0.05) -> Dict[str, np.ndarray]:
+        """
+        fits the model on instructions with {"query": ..., "answers": [{"name": ...}, ...]}, the names of the
+        answers are the targets. full batch Adam on the mean binary cross entropy, deterministic.
+        returns the arrays to save with np.savez.
+        """
+        df = Counter(term for instruction in instructions for term in set(ClassifierRetriever._terms(instruction["query"])))
+        vocabulary = sorted(term for term, count in df.items() if count >= min_df)
+        terms = {term: i for i, term in enumerate(vocabulary)}
+        idf = np.array([np.log((1 + len(instructions)) / (1 + df[term])) + 1 for term in vocabulary], dtype=np.float32)
+        x = ClassifierRetriever._tfidf([instruction["query"] for instruction in instructions], terms, idf)
+        y = np.zeros((len(instructions), len(labels)), dtype=np.float32)
+        index = {label: i for i, label in enumerate(labels)}
+        for row, instruction in enumerate(instructions):
+            for answer in instruction["answers"]:
+                if answer["name"] in index:
+                    y[row, index[answer["name"]]] = 1
+
+        params = [np.zeros((len(vocabulary), len(labels)), dtype=np.float32), np.zeros(len(labels), dtype=np.float32)]
+        moments = [(np.zeros_like(p), np.zeros_like(p)) for p in params]
+        beta1, beta2 = 0.9, 0.999
+        for step in range(1, epochs + 1):
+            weights, bias = params
+            error = (1 / (1 + np.exp(-(x @ weights + bias))) - y) / len(x)
+            grads = [x.T @ error + l2 * weights, error.sum(axis=0)]
+            for p, g, (m, v) in zip(params, grads, moments):
+                m *= beta1
+                m += (1 - beta1) * g
+                v *= beta2
+                v += (1 - beta2) * g * g
+                p -= lr * (m / (1 - beta1 ** step)) / (np.sqrt(v / (1 - beta2 ** step)) + 1e-8)
+        return dict(terms=np.array(vocabulary), idf=idf, weights=params[0], bias=params[1], labels=np.array(labels))
+
+    def scores(self, query: str) -> np.ndarray:
+        # the logits of every api, a higher one is more likely
+        counts = Counter(term for term in self._terms(query) if term in self.terms)
+        if not counts:
+            return self.bias.copy()
+        ids = np.fromiter((self.terms[term] for term in counts), dtype=np.int64, count=len(counts))
+        values = (1 + np.log(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))) * self.idf[ids]
+        return values @ self.weights[ids] / np.linalg.norm(values) + self.bias
+
+    def retrieve(self, query: str, n_results: int) -> List[str]:
+        return [self.documents[i] for i in np.argsort(-self.scores(query), kind="stable")[:n_results]]
 
 
 class FakeRetriever(Retriever):
@@ -131,6 +445,9 @@ class FakeRetriever(Retriever):
             for line in f:
                 item = json.loads(line)
                 self.api_info[item["name"]] = item
+        self.documents = {
+            name: json.dumps(api, indent=2, ensure_ascii=False) for name, api in self.api_info.items()
+        }
     
     def retrieve(self, query: str, n_results: int) -> List[str]:
         # retrieve n actual intent and n_results - n fake intents
@@ -144,7 +461,7 @@ class FakeRetriever(Retriever):
         
         all_functions = actual_functions + fake_functions
         documents = [
-            json.dumps(self.api_info[func], indent=2, ensure_ascii=False)
+            self.documents[func]
             for func in all_functions
         ]
         
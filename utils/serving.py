@@ -0,0 +1,401 @@
+import time
+import queue
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Optional, Tuple
+
+import torch
+from transformers import DynamicCache
+
+
+def _cache_to_tensors(cache) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+    if hasattr(cache, "layers"):
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    if hasattr(cache, "key_cache"):
+        return list(zip(cache.key_cache, cache.value_cache))
+    return [(k, v) for k, v in cache]
+
+
+def _tensors_to_cache(tensors: List[Tuple[torch.Tensor, torch.Tensor]]):
+    try:
+        return DynamicCache(ddp_cache_data=tensors)
+    except TypeError:
+        return DynamicCache.from_legacy_cache(tuple(tensors))
+
+
+def _forward_last(model, **kwargs):
+    # only the logits of the last position are needed, computing them for a whole prompt costs more than the prefill
+    try:
+        return model(**kwargs, logits_to_keep=1)
+    except TypeError:
+        return model(**kwargs)
+
+
+def _left_pad(x: torch.Tensor, length: int, dim: int) -> torch.Tensor:
+    if x.size(dim) >= length:
+        return x
+    shape = list(x.shape)
+    shape[dim] = length - x.size(dim)
+    return torch.cat([x.new_zeros(shape), x], dim=dim)
+
+
+class GenerationHandle:
+    """
+    the handle of a request submitted to a ContinuousBatchingEngine.
+    iterate over it to stream the generated text piece by piece, or call result() to wait for
+    {'text': ..., 'finish_reason': 'stop' | 'length'}.
+    stop: an object with feed(text)-> bool (e.g. a CallBlockDetector) that is fed the generated text and
+        finishes the request when it returns True.
+    logits_processor: an hf LogitsProcessor applied to the logits of this request (e.g. a GrammarLogitsProcessor),
+        it is given the generated ids only, without the prompt.
+    """
+    def __init__(self, engine: "ContinuousBatchingEngine", prompt_ids: List[int], max_new_tokens: int,
+                 do_sample: bool, temperature: float, top_p: float, stop=None, logits_processor=None):
+        self.engine = engine
+        self.prompt_ids = prompt_ids
+        self.max_new_tokens = max_new_tokens
+        self.do_sample = do_sample
+        self.temperature = temperature
+        self.top_p = top_p
+        self.stop = stop
+        self.logits_processor = logits_processor
+        self.token_ids: List[int] = []
+        self.finish_reason: Optional[str] = None
+        self.error: Optional[BaseException] = None
+        self.submitted_at = time.perf_counter()
+        self.finished_at: Optional[float] = None
+        self._stop_text = ""
+        self._stream = queue.Queue()
+        self._done = threading.Event()
+
+    def _push(self, token_id: int) -> bool:
+        # return True if the stop condition is met
+        self.token_ids.append(token_id)
+        self._stream.put(token_id)
+        if self.stop is None:
+            return False
+        text = self.engine.tokenizer.decode(self.token_ids, skip_special_tokens=True)
+        if text.endswith("�"):
+            return False
+        stopped = self.stop.feed(text[len(self._stop_text):])
+        self._stop_text = text
+        return stopped
+
+    def _finish(self, finish_reason: str = None, error: BaseException = None):
+        self.finished_at = time.perf_counter()
+        self.finish_reason = finish_reason
+        self.error = error
+        self._done.set()
+        self._stream.put(None)
+
+    def __iter__(self):
+        tokenizer = self.engine.tokenizer
+        token_ids, emitted = [], ""
+        while True:
+            token_id = self._stream.get()
+            if token_id is None:
+                break
+            token_ids.append(token_id)
+            text = tokenizer.decode(token_ids, skip_special_tokens=True)
+            # hold back incomplete multi-byte characters
+            if text.endswith("�"):
+                continue
+            yield text[len(emitted):]
+            emitted = text
+        if self.error is not None:
+            raise self.error
+
+    def result(self, timeout: float = None) -> Dict[str, str]:
+        self._done.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        text = self.engine.tokenizer.decode(self.token_ids, skip_special_tokens=True)
+        return {"text": text, "finish_reason": self.finish_reason}
+
+
+class ContinuousBatchingEngine:
+    """
+    an in-process inference scheduler for a local causal LM, shared by many callers.
+    requests are queued by submit() and a background thread runs the batch:
+      - waiting requests are admitted as soon as there is room, grouped with the requests of the
+        closest prompt lengths so the prefill pads as little as possible;
+      - their KV caches are left-padded and merged into the running batch, which then decodes one token
+        per step for every sequence;
+      - finished sequences (eos or max_new_tokens) are evicted from the batch right away and their
+        callers are notified, the tokens are streamed to the handles as they are generated.
+    it runs on any device the model is on, including CPU.
+
+    max_batch_size: max number of sequences decoded together.
+    max_prefill_tokens: max number of (padded) prompt tokens prefilled in one forward pass.
+    """
+    def __init__(self, model, tokenizer, max_batch_size: int = 16, max_prefill_tokens: int = 8192,
+                 eos_token_id: List[int] = None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_prefill_tokens = max_prefill_tokens
+        if eos_token_id is None:
+            eos_token_id = getattr(model.generation_config, "eos_token_id", None) or tokenizer.eos_token_id
+        self.eos_token_ids = set(eos_token_id if isinstance(eos_token_id, (list, tuple)) else [eos_token_id])
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+
+        self._waiting: List[GenerationHandle] = []
+        self._cond = threading.Condition()
+        self._closed = False
+        # state of the running batch
+        self._active: List[GenerationHandle] = []
+        self._cache: List[Tuple[torch.Tensor, torch.Tensor]] = []
+        self._mask: Optional[torch.Tensor] = None
+        self._positions: Optional[torch.Tensor] = None
+        self._next_tokens: Optional[torch.Tensor] = None
+
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def submit(self, prompt_ids: List[int], max_new_tokens: int = 256, do_sample: bool = False,
+               temperature: float = 1.0, top_p: float = 1.0, stop=None, logits_processor=None) -> GenerationHandle:
+        handle = GenerationHandle(self, list(prompt_ids), max_new_tokens, do_sample, temperature, top_p, stop,
+                                  logits_processor)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("the engine is closed")
+            self._waiting.append(handle)
+            self._cond.notify()
+        return handle
+
+    def generate(self, prompts: List[List[int]], **kwargs) -> List[Dict[str, str]]:
+        handles = [self.submit(prompt, **kwargs) for prompt in prompts]
+        return [handle.result() for handle in handles]
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _admit(self) -> List[GenerationHandle]:
+        # the oldest waiting request is admitted first, with the ones closest to its length
+        with self._cond:
+            while not self._waiting and not self._active and not self._closed:
+                self._cond.wait()
+            room = self.max_batch_size - len(self._active)
+            if not self._waiting or room <= 0:
+                return []
+            first = self._waiting[0]
+            candidates = sorted(self._waiting, key=lambda h: abs(len(h.prompt_ids) - len(first.prompt_ids)))
+            group = []
+            for handle in candidates:
+                if len(group) >= room:
+                    break
+                max_len = max([len(h.prompt_ids) for h in group] + [len(handle.prompt_ids)])
+                if group and max_len * (len(group) + 1) > self.max_prefill_tokens:
+                    break
+                group.append(handle)
+            for handle in group:
+                self._waiting.remove(handle)
+            return group
+
+    def _sample(self, logits: torch.Tensor, handles: List[GenerationHandle]) -> torch.Tensor:
+        for i, handle in enumerate(handles):
+            if handle.logits_processor is not None:
+                generated = torch.tensor([handle.token_ids], dtype=torch.long, device=logits.device)
+                logits[i] = handle.logits_processor(generated, logits[i:i + 1])[0]
+        tokens = logits.argmax(dim=-1)
+        for i, handle in enumerate(handles):
+            if not handle.do_sample or handle.temperature <= 0:
+                continue
+            probs = torch.softmax(logits[i].float() / handle.temperature, dim=-1)
+            if handle.top_p < 1.0:
+                sorted_probs, sorted_idx = probs.sort(descending=True)
+                keep = sorted_probs.cumsum(-1) - sorted_probs < handle.top_p
+                probs = torch.zeros_like(probs).scatter(0, sorted_idx[keep], sorted_probs[keep])
+            tokens[i] = torch.multinomial(probs, 1)[0]
+        return tokens
+
+    @torch.no_grad()
+    def _prefill(self, group: List[GenerationHandle]):
+        device = self.model.device
+        max_len = max(len(h.prompt_ids) for h in group)
+        input_ids = torch.full((len(group), max_len), self.pad_token_id, dtype=torch.long)
+        mask = torch.zeros((len(group), max_len), dtype=torch.long)
+        for i, handle in enumerate(group):
+            input_ids[i, max_len - len(handle.prompt_ids):] = torch.tensor(handle.prompt_ids)
+            mask[i, max_len - len(handle.prompt_ids):] = 1
+        input_ids, mask = input_ids.to(device), mask.to(device)
+        positions = (mask.cumsum(-1) - 1).clamp(min=0)
+        out = _forward_last(self.model, input_ids=input_ids, attention_mask=mask, position_ids=positions,
+                            past_key_values=DynamicCache(), use_cache=True)
+        next_tokens = self._sample(out.logits[:, -1, :], group)
+        keep = self._emit(group, next_tokens)
+        if not keep:
+            return
+        index = torch.tensor(keep, device=mask.device)
+        cache = [(k.index_select(0, index), v.index_select(0, index))
+                 for k, v in _cache_to_tensors(out.past_key_values)]
+        self._merge([group[i] for i in keep], cache, mask.index_select(0, index),
+                    positions[:, -1].index_select(0, index) + 1, next_tokens.index_select(0, index))
+
+    def _merge(self, group, cache, mask, positions, next_tokens):
+        if not self._active:
+            self._active, self._cache, self._mask = list(group), cache, mask
+            self._positions, self._next_tokens = positions, next_tokens
+            return
+        length = max(self._mask.size(1), mask.size(1))
+        self._cache = [
+            (torch.cat([_left_pad(k0, length, 2), _left_pad(k1, length, 2)]),
+             torch.cat([_left_pad(v0, length, 2), _left_pad(v1, length, 2)]))
+            for (k0, v0), (k1, v1) in zip(self._cache, cache)
+        ]
+        self._mask = torch.cat([_left_pad(self._mask, length, 1), _left_pad(mask, length, 1)])
+        self._positions = torch.cat([self._positions, positions])
+        self._next_tokens = torch.cat([self._next_tokens, next_tokens])
+        self._active.extend(group)
+
+    def _emit(self, handles: List[GenerationHandle], tokens: torch.Tensor) -> List[int]:
+        # stream the new tokens and return the indices of the sequences that are not finished
+        keep = []
+        for i, handle in enumerate(handles):
+            token = int(tokens[i])
+            if token in self.eos_token_ids:
+                handle._finish("stop")
+                continue
+            if handle._push(token):
+                handle._finish("stop")
+                continue
+            if len(handle.token_ids) >= handle.max_new_tokens:
+                handle._finish("length")
+                continue
+            keep.append(i)
+        return keep
+
+    def _evict(self, keep: List[int]):
+        if len(keep) == len(self._active):
+            return
+        self._active = [self._active[i] for i in keep]
+        if not keep:
+            self._cache, self._mask, self._positions, self._next_tokens = [], None, None, None
+            return
+        index = torch.tensor(keep, device=self._mask.device)
+        mask = self._mask.index_select(0, index)
+        # drop the leading columns that only the evicted sequences used
+        start = int((mask.sum(0) > 0).nonzero()[0])
+        self._mask = mask[:, start:]
+        self._cache = [(k.index_select(0, index)[:, :, start:], v.index_select(0, index)[:, :, start:])
+                       for k, v in self._cache]
+        self._positions = self._positions.index_select(0, index)
+        self._next_tokens = self._next_tokens.index_select(0, index)
+
+    @torch.no_grad()
+    def _decode(self):
+        mask = torch.cat([self._mask, self._mask.new_ones((self._mask.size(0), 1))], dim=1)
+        out = self.model(input_ids=self._next_tokens[:, None], attention_mask=mask,
+                         position_ids=self._positions[:, None], past_key_values=_tensors_to_cache(self._cache),
+                         use_cache=True)
+        self._cache = _cache_to_tensors(out.past_key_values)
+        self._mask = mask
+        self._positions = self._positions + 1
+        self._next_tokens = self._sample(out.logits[:, -1, :], self._active)
+        self._evict(self._emit(self._active, self._next_tokens))
+
+    def _loop(self):
+        while True:
+            group = self._admit()
+            if self._closed and not self._active and not group:
+                with self._cond:
+                    for handle in self._waiting:
+                        handle._finish(error=RuntimeError("the engine is closed"))
+                    self._waiting = []
+                return
+            try:
+                if group:
+                    self._prefill(group)
+                if self._active:
+                    self._decode()
+            except Exception as e:
+                for handle in self._active + group:
+                    if not handle._done.is_set():
+                        handle._finish(error=e)
+                self._active, self._cache, self._mask, self._positions, self._next_tokens = [], [], None, None, None
+
+
+def prefix_token_lengths(tokenizer, text: str, char_positions: List[int]) -> Tuple[List[int], List[int]]:
+    """
+    tokenize text and map every char position to the number of leading tokens that end before it.
+    return: (input_ids, token_lengths)
+    """
+    enc = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+    ends = [end for _, end in enc["offset_mapping"]]
+    lengths = []
+    for pos in char_positions:
+        n = 0
+        while n < len(ends) and ends[n] <= pos:
+            n += 1
+        lengths.append(n)
+    return enc["input_ids"], lengths
+
+
+class PrefixCache:
+    """
+    an LRU of the past key/values of prompt prefixes, e.g. the system prompt, or the system prompt and the
+    documentation of a tool set, so that only the part of a prompt after a cached prefix is prefilled.
+    usage:
+        prefix_cache = PrefixCache(model, max_entries=16)
+        past_key_values = prefix_cache.get(input_ids, [system_len, tools_len])
+        model.generate(torch.tensor([input_ids]), past_key_values=past_key_values, ...)
+
+    get() returns a new cache for the longest of the given prefix lengths, computing the missing ones from
+    the longest cached one (a partial hit, e.g. same system prompt but other tools). the cached tensors are never modified, generate appends to copies of them.
+    """
+    def __init__(self, model, max_entries: int = 16):
+        self.model = model
+        self.max_entries = max_entries
+        self.hits = 0
+        self.partial_hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+        self._entries: "OrderedDict[bytes, List[Tuple[torch.Tensor, torch.Tensor]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(input_ids: List[int]) -> bytes:
+        return hashlib.blake2b(",".join(map(str, input_ids)).encode(), digest_size=16).digest()
+
+    @torch.no_grad()
+    def get(self, input_ids: List[int], prefix_lengths: List[int]):
+        # at least one token has to be left for generate to prefill
+        prefix_lengths = sorted({n for n in prefix_lengths if 0 < n < len(input_ids)})
+        if not prefix_lengths:
+            return None
+        with self._lock:
+            start, tensors = 0, None
+            for n in reversed(prefix_lengths):
+                key = self._key(input_ids[:n])
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    start, tensors = n, self._entries[key]
+                    break
+            if start == prefix_lengths[-1]:
+                self.hits += 1
+            elif start > 0:
+                self.partial_hits += 1
+            else:
+                self.misses += 1
+            self.reused_tokens += start
+            for n in prefix_lengths:
+                if n <= start:
+                    continue
+                cache = _tensors_to_cache(tensors) if tensors is not None else DynamicCache()
+                ids = torch.tensor([input_ids[start:n]], device=self.model.device)
+                out = _forward_last(self.model, input_ids=ids, past_key_values=cache, use_cache=True)
+                start, tensors = n, _cache_to_tensors(out.past_key_values)
+                self._entries[self._key(input_ids[:n])] = tensors
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            return _tensors_to_cache(tensors)
+
+    def stats(self) -> str:
+        total = self.hits + self.partial_hits + self.misses
+        rate = self.hits / total if total else 0.0
+        return (f"prefix cache hits: {self.hits}, partial hits: {self.partial_hits}, misses: {self.misses}, "
+                f"hit rate: {rate:.2%}, reused prefix tokens: {self.reused_tokens}")
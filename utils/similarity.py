@@ -0,0 +1,488 @@
+import multiprocessing as mp
+import re
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+
+_WORD_BITS = 64
+
+
+def _popcount(x: np.ndarray) -> np.ndarray:
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(x).sum(axis=-1).astype(np.int64)
+    bits = np.unpackbits(x.view(np.uint8).reshape(*x.shape[:-1], -1), axis=-1)
+    return bits.sum(axis=-1).astype(np.int64)
+
+
+def _add_words(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    # multi-word unsigned addition, word 0 is the lowest word, the final carry is dropped
+    out = np.empty_like(a)
+    carry = np.zeros(a.shape[0], dtype=np.uint64)
+    for w in range(a.shape[1]):
+        s = a[:, w] + b[:, w]
+        c1 = s < a[:, w]
+        s2 = s + carry
+        c2 = s2 < s
+        out[:, w] = s2
+        carry = (c1 | c2).astype(np.uint64)
+    return out
+
+
+def lcs_fmeasure(candidate: np.ndarray, tokens: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """
+    ROUGE-L f-measure between one candidate and many sentences, same value as
+    `rouge_scorer._score_lcs(candidate, sentence).fmeasure`.
+    candidate: 1-d array of token ids (ids start from 1).
+    tokens: 2-d array [num_sentences, max_len] of token ids, padded with 0.
+    lengths: 1-d array of sentence lengths.
+
+    The LCS length is computed with the bit-parallel algorithm of Hyyrö, every
+    row of `tokens` is processed at once so the python loop only runs over columns.
+    """
+    n = tokens.shape[0]
+    m = len(candidate)
+    if n == 0:
+        return np.zeros(0, dtype=np.float64)
+    if m == 0:
+        return np.zeros(n, dtype=np.float64)
+
+    num_words = (m + _WORD_BITS - 1) // _WORD_BITS
+    uniq, inverse = np.unique(candidate, return_inverse=True)
+    # row 0 is the empty mask, used for padding and tokens not in the candidate
+    masks = np.zeros((len(uniq) + 1, num_words), dtype=np.uint64)
+    pos = np.arange(m)
+    np.bitwise_or.at(masks, (inverse + 1, pos // _WORD_BITS),
+                     np.left_shift(np.uint64(1), (pos % _WORD_BITS).astype(np.uint64)))
+
+    lut = np.zeros(max(int(tokens.max()), int(uniq[-1])) + 1, dtype=np.int32)
+    lut[uniq] = np.arange(1, len(uniq) + 1, dtype=np.int32)
+    index = lut[tokens]
+
+    v = np.full((n, num_words), np.iinfo(np.uint64).max, dtype=np.uint64)
+    for j in range(tokens.shape[1]):
+        match = masks[index[:, j]]
+        u = v & match
+        if num_words == 1:
+            v = (v + u) | (v & ~match)
+        else:
+            v = _add_words(v, u) | (v & ~match)
+
+    tail = m % _WORD_BITS
+    if tail:
+        v[:, -1] &= np.uint64((1 << tail) - 1)
+    # the zero bits of v within the low m bits count the LCS length
+    lcs = (m - _popcount(v)).astype(np.float64)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precision = np.where(lengths > 0, lcs / np.maximum(lengths, 1), 0.0)
+        recall = lcs / m
+        total = precision + recall
+        fmeasure = np.where(total > 0, 2 * precision * recall / np.where(total > 0, total, 1.0), 0.0)
+    return fmeasure
+
+
+class _Postings:
+    """
+    a growable posting list of (row, count) pairs for one token.
+    """
+    def __init__(self, capacity: int = 8):
+        self.rows = np.zeros(capacity, dtype=np.int64)
+        self.counts = np.zeros(capacity, dtype=np.int64)
+        self.size = 0
+
+    def append(self, row: int, count: int):
+        if self.size == len(self.rows):
+            self.rows = np.concatenate([self.rows, np.zeros_like(self.rows)])
+            self.counts = np.concatenate([self.counts, np.zeros_like(self.counts)])
+        self.rows[self.size] = row
+        self.counts[self.size] = count
+        self.size += 1
+
+
+# slack for comparing the float upper bound with `bound`, the bound is never allowed to prune a real match
+_BOUND_EPS = 1e-9
+
+
+class LCSScorer:
+    """
+    a growable, array-backed store of tokenized sentences that can score a candidate
+    against all of them with `lcs_fmeasure`.
+    every sentence carries a global id, ties on the best score are broken by the smallest id.
+
+    an inverted index (token id -> rows, counts) gives the bag-of-tokens overlap of the
+    candidate with every sentence, and since LCS <= overlap the f-measure is bounded by
+    2 * overlap / (len(candidate) + len(sentence)). with a bound, best() only scores exactly
+    the sentences whose upper bound exceeds it (plus the one with the highest upper bound),
+    so whether the best score exceeds the bound is the same as with a full scan, and when
+    it does the returned sentence and score are exact too.
+    """
+    def __init__(self, capacity: int = 256, max_len: int = 64):
+        self.tokens = np.zeros((capacity, max_len), dtype=np.int32)
+        self.lengths = np.zeros(capacity, dtype=np.int64)
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.postings: Dict[int, _Postings] = {}
+        self.size = 0
+        self.max_len = 0
+        self.last_scored = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, global_id: int, sentence: np.ndarray):
+        length = len(sentence)
+        if self.size == self.tokens.shape[0]:
+            self._grow(self.size * 2, self.tokens.shape[1])
+        if length > self.tokens.shape[1]:
+            self._grow(self.tokens.shape[0], max(length, self.tokens.shape[1] * 2))
+        # the row may hold a sentence from before clear(), padding has to be 0
+        self.tokens[self.size] = 0
+        self.tokens[self.size, :length] = sentence
+        self.lengths[self.size] = length
+        self.ids[self.size] = global_id
+        for token, count in zip(*np.unique(sentence, return_counts=True)):
+            token = int(token)
+            if token not in self.postings:
+                self.postings[token] = _Postings()
+            self.postings[token].append(self.size, int(count))
+        self.size += 1
+        self.max_len = max(self.max_len, length)
+
+    def _grow(self, capacity: int, max_len: int):
+        tokens = np.zeros((capacity, max_len), dtype=np.int32)
+        tokens[:self.size, :self.tokens.shape[1]] = self.tokens[:self.size]
+        self.tokens = tokens
+        for name in ["lengths", "ids"]:
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def clear(self):
+        self.size = 0
+        self.max_len = 0
+        self.postings = {}
+
+    def overlap(self, sentence: np.ndarray) -> np.ndarray:
+        """
+        bag-of-tokens overlap sum_t min(count(sentence, t), count(row, t)) for every row.
+        """
+        rows, mins = [], []
+        for token, count in zip(*np.unique(sentence, return_counts=True)):
+            postings = self.postings.get(int(token))
+            if postings is None:
+                continue
+            rows.append(postings.rows[:postings.size])
+            mins.append(np.minimum(postings.counts[:postings.size], count))
+        if not rows:
+            return np.zeros(self.size, dtype=np.int64)
+        return np.bincount(np.concatenate(rows), weights=np.concatenate(mins),
+                           minlength=self.size).astype(np.int64)
+
+    def upper_bound(self, sentence: np.ndarray) -> np.ndarray:
+        total = len(sentence) + self.lengths[:self.size]
+        return np.where(total > 0, 2 * self.overlap(sentence) / np.maximum(total, 1), 0.0)
+
+    def score(self, sentence: np.ndarray, rows: np.ndarray = None) -> np.ndarray:
+        if rows is None:
+            return lcs_fmeasure(sentence, self.tokens[:self.size, :self.max_len], self.lengths[:self.size])
+        max_len = int(self.lengths[rows].max()) if len(rows) else 0
+        return lcs_fmeasure(sentence, self.tokens[rows, :max_len], self.lengths[rows])
+
+    def best(self, sentence: np.ndarray, bound: float = None) -> Tuple[int, float]:
+        if self.size == 0:
+            self.last_scored = 0
+            return -1, -1.0
+        if bound is None:
+            rows = np.arange(self.size)
+        else:
+            ub = self.upper_bound(sentence)
+            rows = np.nonzero(ub > bound - _BOUND_EPS)[0]
+            if len(rows) == 0:
+                rows = np.array([int(np.argmax(ub))])
+        scores = self.score(sentence, rows)
+        self.last_scored = len(rows)
+        i = int(np.argmax(scores))
+        return int(self.ids[rows[i]]), float(scores[i])
+
+
+def _lcs_worker(conn):
+    scorer = LCSScorer()
+    while True:
+        msg = conn.recv()
+        cmd = msg[0]
+        if cmd == "add":
+            scorer.add(msg[1], msg[2])
+        elif cmd == "best":
+            conn.send((*scorer.best(msg[1], msg[2]), scorer.last_scored))
+        elif cmd == "best_many":
+            results, scored = [], 0
+            for sentence in msg[1]:
+                results.append(scorer.best(sentence, msg[2]))
+                scored += scorer.last_scored
+            conn.send((results, scored))
+        elif cmd == "clear":
+            scorer.clear()
+        elif cmd == "close":
+            break
+    conn.close()
+
+
+class LCSEngine:
+    """
+    a long-lived ROUGE-L scoring engine.
+    with num_processes > 1 the corpus is sharded round-robin over worker processes,
+    each worker keeps its shard resident, so an `add` only ships the new sentence to
+    one worker and a `best` only ships the candidate to every worker.
+    with num_processes <= 1 everything runs in the current process.
+
+    add(sentence: np.ndarray)-> int: add a sentence of token ids, return its global id.
+    best(sentence: np.ndarray, bound: float = None)-> (int, float): global id and f-measure of the most similar sentence.
+        with a bound, sentences that cannot score above it are pruned (see `LCSScorer`).
+    best_many(sentences: List[np.ndarray], bound: float = None)-> List[(int, float)]: best() for a batch.
+    num_scored: number of sentences scored exactly so far.
+    """
+    def __init__(self, num_processes: int = 1):
+        self.num_processes = num_processes
+        self.size = 0
+        self.num_scored = 0
+        self.local = LCSScorer() if num_processes <= 1 else None
+        self.workers = []
+        self.conns = []
+
+    def __len__(self):
+        return self.size
+
+    def _start(self):
+        if self.local is not None or self.workers:
+            return
+        for _ in range(self.num_processes):
+            parent_conn, child_conn = mp.Pipe()
+            p = mp.Process(target=_lcs_worker, args=(child_conn,), daemon=True)
+            p.start()
+            child_conn.close()
+            self.workers.append(p)
+            self.conns.append(parent_conn)
+
+    def add(self, sentence: np.ndarray) -> int:
+        global_id = self.size
+        if self.local is not None:
+            self.local.add(global_id, sentence)
+        else:
+            self._start()
+            self.conns[global_id % len(self.conns)].send(("add", global_id, sentence))
+        self.size += 1
+        return global_id
+
+    def best(self, sentence: np.ndarray, bound: float = None) -> Tuple[int, float]:
+        if self.local is not None:
+            result = self.local.best(sentence, bound)
+            self.num_scored += self.local.last_scored
+            return result
+        self._start()
+        for conn in self.conns:
+            conn.send(("best", sentence, bound))
+        results = []
+        for conn in self.conns:
+            global_id, score, scored = conn.recv()
+            self.num_scored += scored
+            if global_id >= 0:
+                results.append((global_id, score))
+        if not results:
+            return -1, -1.0
+        # highest score first, then the earliest added sentence like `max` over the list would do
+        return min(results, key=lambda r: (-r[1], r[0]))
+
+    def best_many(self, sentences: List[np.ndarray], bound: float = None) -> List[Tuple[int, float]]:
+        """
+        best() for many sentences in one round trip to the workers, against the current record only.
+        """
+        if self.local is not None:
+            results = []
+            for sentence in sentences:
+                results.append(self.local.best(sentence, bound))
+                self.num_scored += self.local.last_scored
+            return results
+        self._start()
+        for conn in self.conns:
+            conn.send(("best_many", sentences, bound))
+        shard_results = []
+        for conn in self.conns:
+            results, scored = conn.recv()
+            self.num_scored += scored
+            shard_results.append(results)
+        merged = []
+        for i in range(len(sentences)):
+            results = [r[i] for r in shard_results if r[i][0] >= 0]
+            merged.append(min(results, key=lambda r: (-r[1], r[0])) if results else (-1, -1.0))
+        return merged
+
+    def clear(self):
+        self.size = 0
+        if self.local is not None:
+            self.local.clear()
+        for conn in self.conns:
+            conn.send(("clear",))
+
+    def close(self):
+        for conn in self.conns:
+            try:
+                conn.send(("close",))
+                conn.close()
+            except (BrokenPipeError, OSError):
+                pass
+        for p in self.workers:
+            p.join(timeout=1)
+            if p.is_alive():
+                p.terminate()
+        self.workers = []
+        self.conns = []
+
+    def __del__(self):
+        self.close()
+
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+
+
+class MinHashLSH:
+    """
+    MinHash signatures over token shingles with an LSH banding index.
+    num_perm: number of hash permutations, the length of a signature.
+    bands: number of bands, num_perm must be divisible by it. two sentences become candidates
+        when all the rows of at least one band agree, roughly when their jaccard similarity
+        exceeds (1 / bands) ** (1 / rows). the default 32 bands of 4 rows gives about 0.42 and makes a
+        pair at the jaccard 0.6 of a 0.75 dedup bound a candidate 98.8% of the time (see bands_for).
+    shingle_size: number of consecutive tokens in a shingle.
+
+    add(sentence: np.ndarray)-> int: index a sentence of token ids, return its id.
+    candidates(sentence: np.ndarray)-> (np.ndarray, np.ndarray): ids of the sentences sharing a band
+        with the sentence and their estimated jaccard similarity.
+    """
+    def __init__(self, num_perm: int = 128, bands: int = 32, shingle_size: int = 1, seed: int = 1):
+        if num_perm % bands != 0:
+            raise ValueError(f"num_perm {num_perm} is not divisible by bands {bands}")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        rng = np.random.RandomState(seed)
+        # (a * x + b) % p with a, b and the shingles x below 2^32 never wraps around in uint64
+        self.a = rng.randint(1, 1 << 32, size=num_perm, dtype=np.int64).astype(np.uint64)
+        self.b = rng.randint(0, 1 << 32, size=num_perm, dtype=np.int64).astype(np.uint64)
+        self.tables: List[Dict[bytes, List[int]]] = [{} for _ in range(bands)]
+        self.signatures = np.zeros((256, num_perm), dtype=np.uint32)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    @staticmethod
+    def bands_for(num_perm: int, jaccard: float, recall: float = 0.98) -> int:
+        """
+        the fewest bands (the most rows, the fewest candidates) that still make a pair at the jaccard similarity
+        a candidate with a probability of at least recall, 1 - (1 - jaccard ** rows) ** bands.
+        """
+        for bands in range(1, num_perm + 1):
+            if num_perm % bands == 0 and 1 - (1 - jaccard ** (num_perm // bands)) ** bands >= recall:
+                return bands
+        return num_perm
+
+    def _shingles(self, sentence: np.ndarray) -> np.ndarray:
+        ids = sentence.astype(np.uint64)
+        k = min(self.shingle_size, len(ids))
+        if k == 0:
+            return np.zeros(1, dtype=np.uint64)
+        values = np.zeros(len(ids) - k + 1, dtype=np.uint64)
+        for i in range(k):
+            # FNV-style mixing of the ids in a shingle
+            values = (values ^ ids[i:len(ids) - k + 1 + i]) * np.uint64(1099511628211)
+        return np.unique(values & _MAX_HASH)
+
+    def signature(self, sentence: np.ndarray) -> np.ndarray:
+        shingles = self._shingles(sentence)
+        # the shingles are masked to 32 bits by _shingles
+        hashes = (np.outer(shingles, self.a) + self.b) % _MERSENNE_PRIME & _MAX_HASH
+        return hashes.min(axis=0).astype(np.uint32)
+
+    def _band_keys(self, signature: np.ndarray) -> List[bytes]:
+        return [signature[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+
+    def add(self, sentence: np.ndarray) -> int:
+        signature = self.signature(sentence)
+        if self.size == len(self.signatures):
+            self.signatures = np.concatenate([self.signatures, np.zeros_like(self.signatures)])
+        self.signatures[self.size] = signature
+        for table, key in zip(self.tables, self._band_keys(signature)):
+            table.setdefault(key, []).append(self.size)
+        self.size += 1
+        return self.size - 1
+
+    def candidates(self, sentence: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        signature = self.signature(sentence)
+        ids = set()
+        for table, key in zip(self.tables, self._band_keys(signature)):
+            ids.update(table.get(key, ()))
+        ids = np.array(sorted(ids), dtype=np.int64)
+        jaccard = (self.signatures[ids] == signature).mean(axis=1) if len(ids) else np.zeros(0)
+        return ids, jaccard
+
+    def clear(self):
+        self.tables = [{} for _ in range(self.bands)]
+        self.size = 0
+
+
+_WORDS = re.compile(r"[^\W_]+")
+
+
+def words(text: str) -> List[str]:
+    # lowercase words, split at underscores too so that START_CALL matches "start a call"
+    return _WORDS.findall(text.lower())
+
+
+class BM25Index:
+    """
+    Okapi BM25 over the words of a fixed list of texts.
+    the weight of every (word, text) pair is computed once, scoring a query only sums the weights of its words.
+
+    scores(query: str)-> np.ndarray: the score of every text for the query.
+    top(query: str, k: int, ids=None)-> List[int]: the ids of the k best texts (only among ids if given), best
+        first, ties in the order of the texts.
+    """
+    def __init__(self, texts: List[str], k1: float = 1.5, b: float = 0.75):
+        self.size = len(texts)
+        tokenized = [words(text) for text in texts]
+        lengths = np.array([len(tokens) for tokens in tokenized], dtype=np.float32)
+        average = max(float(lengths.mean()) if self.size else 0.0, 1e-6)
+        counts: Dict[str, Dict[int, int]] = {}
+        for i, tokens in enumerate(tokenized):
+            for token in tokens:
+                postings = counts.setdefault(token, {})
+                postings[i] = postings.get(i, 0) + 1
+        # word -> (ids of the texts that have it, its weight in them)
+        self.postings: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        for token, postings in counts.items():
+            ids = np.fromiter(postings.keys(), dtype=np.int64, count=len(postings))
+            tf = np.fromiter(postings.values(), dtype=np.float32, count=len(postings))
+            idf = np.log(1 + (self.size - len(ids) + 0.5) / (len(ids) + 0.5))
+            norm = k1 * (1 - b + b * lengths[ids] / average)
+            self.postings[token] = ids, (idf * tf * (k1 + 1) / (tf + norm)).astype(np.float32)
+
+    def __len__(self):
+        return self.size
+
+    def scores(self, query: str) -> np.ndarray:
+        scores = np.zeros(self.size, dtype=np.float32)
+        for token in set(words(query)):
+            if token in self.postings:
+                ids, weights = self.postings[token]
+                scores[ids] += weights
+        return scores
+
+    def top(self, query: str, k: int, ids=None) -> List[int]:
+        scores = self.scores(query)
+        if ids is not None:
+            ids = np.asarray(ids, dtype=np.int64)
+            return ids[np.argsort(-scores[ids], kind="stable")[:k]].tolist()
+        return np.argsort(-scores, kind="stable")[:k].tolist()
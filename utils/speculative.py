@@ -0,0 +1,171 @@
+import json
+from typing import List, Dict, Tuple, Optional
+
+import torch
+from transformers import DynamicCache
+
+from utils.serving import _forward_last
+
+
+def _crop(cache: DynamicCache, length: int):
+    # a negative value removes tokens from the end, the meaning of positive values changed across versions
+    extra = cache.get_seq_length() - length
+    if extra > 0:
+        cache.crop(-extra)
+
+
+class NgramDraft:
+    """
+    proposes the tokens that followed the last n-gram of the text the latest time it was seen, in the text itself
+    (the prompt has the tool docs that calls copy names and argument keys from) or in a corpus (e.g. the calls of
+    the training set). the longest n-gram wins, the text is searched before the corpus.
+    corpus: token ids of texts the outputs are likely to copy from.
+    """
+    def __init__(self, corpus: List[List[int]] = (), max_ngram: int = 3):
+        self.max_ngram = max_ngram
+        self.sequences: List[List[int]] = []
+        # n-gram -> (sequence, position after the n-gram)
+        self.index: Dict[tuple, Tuple[int, int]] = {}
+        for ids in corpus:
+            self.add(ids)
+        self.reset()
+
+    def add(self, ids: List[int]):
+        self.sequences.append(list(ids))
+        self._index(self.index, len(self.sequences) - 1, self.sequences[-1], 1)
+
+    def _index(self, index: dict, seq: int, ids: List[int], start: int):
+        # only the n-grams that are followed by a token
+        for end in range(start, len(ids)):
+            for n in range(1, min(self.max_ngram, end) + 1):
+                index[tuple(ids[end - n:end])] = (seq, end)
+
+    def reset(self):
+        # called before each generation
+        self._context: Dict[tuple, Tuple[int, int]] = {}
+        self._indexed = 1
+
+    def propose(self, ids: List[int], k: int) -> List[int]:
+        self._index(self._context, -1, ids, self._indexed)
+        self._indexed = max(self._indexed, len(ids))
+        for n in range(min(self.max_ngram, len(ids)), 0, -1):
+            key = tuple(ids[-n:])
+            for index in (self._context, self.index):
+                if key in index:
+                    seq, pos = index[key]
+                    source = ids if seq < 0 else self.sequences[seq]
+                    return source[pos:pos + k]
+        return []
+
+
+class ModelDraft:
+    """
+    greedy proposals of a smaller model that shares the tokenizer of the target (e.g. Qwen2-0.5B for Qwen2-1.5B),
+    its KV cache is kept across the steps of a generation and cropped where the target rejected its tokens.
+    """
+    def __init__(self, model):
+        self.model = model
+        self.reset()
+
+    def reset(self):
+        self.cache = DynamicCache()
+        self.ids: List[int] = []
+
+    @torch.no_grad()
+    def propose(self, ids: List[int], k: int) -> List[int]:
+        # keep the cached tokens the target agreed with, at least one token has to be fed
+        common = 0
+        limit = min(len(self.ids), len(ids) - 1)
+        while common < limit and self.ids[common] == ids[common]:
+            common += 1
+        _crop(self.cache, common)
+        self.ids = list(ids[:common])
+        new = list(ids[common:])
+        proposal = []
+        for _ in range(k):
+            out = _forward_last(self.model, input_ids=torch.tensor([new], device=self.model.device),
+                                past_key_values=self.cache, use_cache=True)
+            self.ids += new
+            new = [int(out.logits[0, -1].argmax())]
+            proposal.append(new[0])
+        return proposal
+
+
+class SpeculativeStats:
+    def __init__(self):
+        self.proposed = 0
+        self.accepted = 0
+        self.forwards = 0
+        self.tokens = 0
+
+    def stats(self) -> Dict[str, float]:
+        return dict(proposed=self.proposed, accepted=self.accepted, forwards=self.forwards, tokens=self.tokens,
+                    acceptance_rate=self.accepted / max(1, self.proposed),
+                    tokens_per_forward=self.tokens / max(1, self.forwards))
+
+
+@torch.no_grad()
+def speculative_generate(model, input_ids: List[int], draft, max_new_tokens: int, eos_token_id=None,
+                         num_draft_tokens: int = 8, past_key_values=None, stopping_criteria=None,
+                         stats: Optional[SpeculativeStats] = None) -> List[int]:
+    """
+    greedy decoding of a single sequence where draft (NgramDraft, ModelDraft) proposes up to num_draft_tokens
+    tokens that the model checks in one forward pass, the longest prefix that matches its own argmax is kept plus
+    the token the model predicts after it. the output is the one of greedy model.generate.
+    past_key_values: a cache of a prefix of input_ids (e.g. from PrefixCache) to start from.
+    stopping_criteria: called as model.generate would with the prompt and the output, after each token.
+    returns the generated ids, ending with eos if it was generated.
+    """
+    if eos_token_id is None:
+        eos_token_id = model.generation_config.eos_token_id
+    eos = set(eos_token_id if isinstance(eos_token_id, (list, tuple)) else [eos_token_id])
+    stats = stats if stats is not None else SpeculativeStats()
+    device = model.device
+    cache = past_key_values if past_key_values is not None else DynamicCache()
+    # the last prompt token is fed again to get the logits of the first output token
+    cached = min(cache.get_seq_length(), len(input_ids) - 1)
+    _crop(cache, cached)
+    out = _forward_last(model, input_ids=torch.tensor([input_ids[cached:]], device=device),
+                        past_key_values=cache, use_cache=True)
+    stats.forwards += 1
+    draft.reset()
+    output: List[int] = []
+    pending = [int(out.logits[0, -1].argmax())]
+    while True:
+        for token in pending:
+            output.append(token)
+            stats.tokens += 1
+            if token in eos or len(output) >= max_new_tokens:
+                return output
+            if stopping_criteria is not None and bool(
+                    stopping_criteria(torch.tensor([input_ids + output], device=device), None)[0]):
+                return output
+        # drafts past max_new_tokens would be thrown away
+        proposal = draft.propose(input_ids + output, min(num_draft_tokens, max_new_tokens - len(output)))
+        # the cache has everything but the last output token
+        logits = model(input_ids=torch.tensor([output[-1:] + proposal], device=device),
+                       past_key_values=cache, use_cache=True).logits[0]
+        predicted = logits.argmax(dim=-1).tolist()
+        accepted = 0
+        while accepted < len(proposal) and proposal[accepted] == predicted[accepted]:
+            accepted += 1
+        _crop(cache, len(input_ids) + len(output) + accepted)
+        stats.forwards += 1
+        stats.proposed += len(proposal)
+        stats.accepted += accepted
+        pending = proposal[:accepted] + [predicted[accepted]]
+
+
+def call_corpus(tokenizer, path: str, call_formatter) -> List[List[int]]:
+    """
+    token ids of the answers of a jsonl dataset (e.g. data/DroidCall_train.jsonl) written by call_formatter
+    (e.g. CodeFunctionCallingFormatter("$", "$")), as a corpus for NgramDraft.
+    """
+    corpus = []
+    with open(path) as f:
+        for line in f:
+            answers = json.loads(line).get("answers", [])
+            if answers:
+                text = call_formatter.format(calls=answers)
+                corpus.append(tokenizer(text, add_special_tokens=False)["input_ids"])
+    return corpus
@@ -0,0 +1,138 @@
+from typing import List, Optional
+
+import torch
+from transformers import StoppingCriteria
+
+
+class CallBlockDetector:
+    """
+    tells when streamed model output contains a complete block of function calls, so generation can stop there.
+    feed(text) takes the new text and returns True once the block is complete:
+      - with a sep_end, the block is complete at the first sep_end after sep_start (or anywhere if sep_start
+        is empty) that is not inside a double quoted string, e.g. `$result0 = f(a="$5")$`;
+      - otherwise in json format, when the first top level json array or object is closed, brackets inside
+        strings are ignored;
+      - otherwise (code format without separators) the end of a block can not be told and it never stops.
+    end: the length of the text up to the end of the block once done.
+    """
+    def __init__(self, sep_start: str = "", sep_end: str = "", json_format: bool = False):
+        self.sep_start = sep_start
+        self.sep_end = sep_end
+        self.json_format = json_format
+        self.text = ""
+        self.done = False
+        self.end: Optional[int] = None
+        # position after sep_start, None until it is seen
+        self._block_start = None if sep_start else 0
+        # scanner state
+        self._scanned = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.sep_end) or self.json_format
+
+    def feed(self, text: str) -> bool:
+        if self.done or not text:
+            return self.done
+        self.text += text
+        if self.sep_end:
+            self._feed_sep()
+        elif self.json_format:
+            self._feed_json()
+        return self.done
+
+    def _feed_sep(self):
+        if self._block_start is None:
+            i = self.text.find(self.sep_start)
+            if i < 0:
+                return
+            self._block_start = self._scanned = i + len(self.sep_start)
+        i = max(self._scanned, self._block_start)
+        while i < len(self.text):
+            if not self._in_string:
+                if self.text.startswith(self.sep_end, i):
+                    self.done, self.end = True, i + len(self.sep_end)
+                    return
+                if self.sep_end.startswith(self.text[i:]):
+                    # the separator may be completed by the next piece
+                    break
+            self._scan_string(self.text[i])
+            i += 1
+        self._scanned = i
+
+    def _scan_string(self, c: str):
+        if self._in_string:
+            if self._escape:
+                self._escape = False
+            elif c == "\\":
+                self._escape = True
+            elif c == '"':
+                self._in_string = False
+        elif c == '"':
+            self._in_string = True
+
+    def _feed_json(self):
+        for i in range(self._scanned, len(self.text)):
+            c = self.text[i]
+            if self._in_string or c == '"':
+                # strings only matter inside the json, a quote in the text before it is just text
+                if self._depth > 0:
+                    self._scan_string(c)
+            elif c in "[{":
+                self._depth += 1
+            elif c in "]}" and self._depth > 0:
+                self._depth -= 1
+                if self._depth == 0:
+                    self.done, self.end = True, i + 1
+                    break
+        self._scanned = len(self.text)
+
+
+class CallBlockStoppingCriteria(StoppingCriteria):
+    """
+    stops the rows of model.generate whose output contains a complete function call block (see CallBlockDetector).
+    prompt_length: the (padded) length of the prompts, the output starts after it.
+    """
+    def __init__(self, tokenizer, prompt_length: int, sep_start: str = "", sep_end: str = "",
+                 json_format: bool = False):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.sep_start = sep_start
+        self.sep_end = sep_end
+        self.json_format = json_format
+        self.detectors: List[CallBlockDetector] = []
+        self._texts: List[str] = []
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        if not self.detectors:
+            self.detectors = [CallBlockDetector(self.sep_start, self.sep_end, self.json_format)
+                              for _ in range(input_ids.size(0))]
+            self._texts = [""] * input_ids.size(0)
+        done = []
+        for i, detector in enumerate(self.detectors):
+            if not detector.done:
+                text = self.tokenizer.decode(input_ids[i, self.prompt_length:], skip_special_tokens=True)
+                # hold back incomplete multi-byte characters
+                if not text.endswith("�"):
+                    detector.feed(text[len(self._texts[i]):])
+                    self._texts[i] = text
+            done.append(detector.done)
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+    @property
+    def stopped(self) -> List[bool]:
+        return [detector.done for detector in self.detectors]
+
+
+class EventStoppingCriteria(StoppingCriteria):
+    """
+    stops every row once the event is set, e.g. by the consumer of a stream that does not need the rest.
+    """
+    def __init__(self, event):
+        self.event = event
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        return torch.full((input_ids.size(0),), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
@@ -1,19 +1,27 @@
 import json
 import random
 from typing import List, Dict, Tuple, Optional, Union, Callable, Generator, Iterable
-from rouge_score import rouge_scorer
 import multiprocessing as mp
-from functools import partial
+import numpy as np
 from transformers import PreTrainedTokenizer, AutoTokenizer, AutoModelForCausalLM
 import os
+import logging
 from abc import ABC, abstractmethod
 
 from utils.extract import extract_and_parse_jsons
+from utils.similarity import LCSEngine, LCSScorer, MinHashLSH
        
 class GenerateResponse(ABC):
     @abstractmethod
     def __call__(self, prefix:str, queries: List[str], **kwargs)->List[Dict[str, str]]:
         pass
+
+    def stream(self, prefix: str, query: str, **kwargs) -> Iterable[str]:
+        """
+        the response to a single query piece by piece while it is generated, e.g. for CallExtractor.feed.
+        by default it comes in one piece once it is done.
+        """
+        yield self(prefix, [query], **kwargs)[0]["text"]
     
 
 from openai import OpenAI
@@ -29,23 +37,138 @@ class OpenAiGenerateResponse(GenerateResponse):
         self.model = model
         self.system_prompt = system_prompt
         
+    def _request(self, prefix: str, query: str, **kwargs)-> Dict[str, str]:
+        prompt = f"{prefix} {query}"
+        completion = self.client.chat.completions.create(
+            model = self.model,
+            messages = [
+                {"role": "system", "content": self.system_prompt},
+                {"role": "user", "content": prompt}
+            ],
+            **kwargs
+        )
+        return {'text': completion.choices[0].message.content, 'finish_reason': completion.choices[0].finish_reason}
+        
     def __call__(self, prefix:str, queries: List[str], **kwargs)->List[Dict[str, str]]:
         responses = []
         for query in queries:
-            prompt = f"{prefix} {query}"
-            completion = self.client.chat.completions.create(
-                model = self.model,
-                messages = [
-                    {"role": "system", "content": self.system_prompt},
-                    {"role": "user", "content": prompt}
-                ],
-                # **kwargs
-            )
-            resp = {'text': completion.choices[0].message.content, 'finish_reason': completion.choices[0].finish_reason}
+            resp = self._request(prefix, query)
             responses.append(resp)
         
         return responses
+    
+    
+import time
+import threading
+import openai
+from concurrent.futures import ThreadPoolExecutor
+
+class ConcurrentOpenAiGenerateResponse(OpenAiGenerateResponse):
+    """
+    an OpenAiGenerateResponse that sends all the queries of a call concurrently from a thread pool.
+    max_concurrency: max number of requests in flight, shared by all concurrent calls.
+    timeout: timeout in seconds of a single request.
+    max_retries: retries of a request that is rate limited (429), timed out or failed to connect.
+    backoff: base of the exponential backoff in seconds, a Retry-After header from the server takes precedence.
+    
+    the responses are returned in the order of the queries, an error that survives the retries is raised.
+    """
+    def __init__(self, client: OpenAI, model: str, system_prompt: str, max_concurrency: int = 8,
+                 timeout: float = 60, max_retries: int = 5, backoff: float = 1.0):
+        # retries are handled here, so that a 429 backs off the whole pool instead of each request alone
+        super().__init__(client.with_options(max_retries=0), model, system_prompt)
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self._lock = threading.Lock()
+        self._resume_at = 0.0
+        
+    def _retry_after(self, e: Exception, attempt: int)-> float:
+        response = getattr(e, "response", None)
+        if response is not None:
+            try:
+                return float(response.headers.get("retry-after"))
+            except (TypeError, ValueError):
+                pass
+        return self.backoff * (2 ** attempt) * (0.5 + random.random() / 2)
+        
+    def _request(self, prefix: str, query: str, **kwargs)-> Dict[str, str]:
+        for attempt in range(self.max_retries + 1):
+            # wait while another request of the pool has been told to back off
+            with self._lock:
+                wait = self._resume_at - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                return super()._request(prefix, query, timeout=self.timeout, **kwargs)
+            except (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError) as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self._retry_after(e, attempt)
+                logging.warning(f"request failed with {type(e).__name__}, retry in {delay:.2f}s")
+                if isinstance(e, openai.RateLimitError):
+                    with self._lock:
+                        self._resume_at = max(self._resume_at, time.monotonic() + delay)
+                else:
+                    time.sleep(delay)
+        
+    def __call__(self, prefix:str, queries: List[str], **kwargs)->List[Dict[str, str]]:
+        return list(self.executor.map(lambda query: self._request(prefix, query), queries))
+    
+    def close(self):
+        self.executor.shutdown(wait=True)
             
+
+from utils.cache import ResponseCache, OccurrenceCounter
+
+class CachedGenerateResponse(GenerateResponse):
+    """
+    wraps any GenerateResponse with a ResponseCache, keyed on (model, system prompt, prompt, sampling kwargs).
+    only the cache misses of a call are sent to the wrapped GenerateResponse, in one batch.
+    deterministic_only: only cache deterministic calls (temperature=0 or do_sample=False).
+    sampled calls also key on how many times the prompt was already requested in this run (see OccurrenceCounter).
+    """
+    def __init__(self, generate_response: GenerateResponse, cache: ResponseCache, deterministic_only: bool = False):
+        super().__init__()
+        self.generate_response = generate_response
+        self.cache = cache
+        self.deterministic_only = deterministic_only
+        self.occurrences = OccurrenceCounter()
+        
+    @property
+    def model_name(self)-> str:
+        model = getattr(self.generate_response, "model", None)
+        if isinstance(model, str) or model is None:
+            return model
+        return getattr(model, "name_or_path", type(model).__name__)
+    
+    @staticmethod
+    def is_deterministic(kwargs: Dict)-> bool:
+        return kwargs.get("temperature", None) == 0 or kwargs.get("do_sample", None) is False
+        
+    def __call__(self, prefix:str, queries: List[str], **kwargs)->List[Dict[str, str]]:
+        deterministic = self.is_deterministic(kwargs)
+        if self.deterministic_only and not deterministic:
+            return self.generate_response(prefix, queries, **kwargs)
+        
+        keys = []
+        for query in queries:
+            parts = dict(model=self.model_name, system_prompt=getattr(self.generate_response, "system_prompt", None),
+                         prompt=prefix + query, kwargs=kwargs)
+            if not deterministic:
+                parts["occurrence"] = self.occurrences.next(ResponseCache.make_key(**parts))
+            keys.append(ResponseCache.make_key(**parts))
+        
+        responses = [self.cache.get(key) for key in keys]
+        missing = [i for i, resp in enumerate(responses) if resp is None]
+        if missing:
+            generated = self.generate_response(prefix, [queries[i] for i in missing], **kwargs)
+            for i, resp in zip(missing, generated):
+                self.cache.put(keys[i], resp)
+                responses[i] = resp
+        return responses
     
 
 class HuggingfaceGenerateResponse(GenerateResponse):
@@ -65,16 +188,24 @@ class HuggingfaceGenerateResponse(GenerateResponse):
         e.g. [{'text': '我喜欢吃苹果。', 'finish_reason': 'stop'}, {'text': '我不喜欢吃苹果。', 'finish_reason': 'stop'}]
         finish_reason: 'stop' means the model stops generating response.
                           'length' means the model reach the max_new_tokens or max_length.
+    
+    kwargs are passed to model.generate, except stop_at_call=dict(sep_start=..., sep_end=..., json_format=...)
+    that stops a response as soon as it contains a complete function call block (see utils/stopping.py).
+    draft: a NgramDraft or ModelDraft (see utils/speculative.py) to decode greedy requests speculatively,
+    one query at a time.
     """
     tokenizer: PreTrainedTokenizer
     model: AutoModelForCausalLM
     
     
-    def __init__(self, tokenizer: PreTrainedTokenizer, model: AutoModelForCausalLM, system_prompt: str):
+    def __init__(self, tokenizer: PreTrainedTokenizer, model: AutoModelForCausalLM, system_prompt: str,
+                 draft=None, num_draft_tokens: int = 8):
         super().__init__()
         self.tokenizer = tokenizer
         self.model = model
         self.system_prompt = system_prompt
+        self.draft = draft
+        self.num_draft_tokens = num_draft_tokens
     
     def __call__(self, prefix:str, queries: List[str], **kwargs):
         sentences = [
@@ -87,8 +218,17 @@ class HuggingfaceGenerateResponse(GenerateResponse):
                 add_generation_prompt=True,
             ) for q in queries
         ]
+        stop_at_call = kwargs.pop("stop_at_call", None)
+        if self.draft is not None and not kwargs.get("do_sample", self.model.generation_config.do_sample):
+            return [self._speculative(sentence, stop_at_call, **kwargs) for sentence in sentences]
         inp = self.tokenizer(sentences, padding=True, return_tensors="pt").to(self.model.device)
         import torch
+        criteria = None
+        if stop_at_call is not None:
+            from transformers import StoppingCriteriaList
+            from utils.stopping import CallBlockStoppingCriteria
+            criteria = CallBlockStoppingCriteria(self.tokenizer, inp["input_ids"].size(1), **stop_at_call)
+            kwargs["stopping_criteria"] = StoppingCriteriaList([criteria])
         with torch.no_grad():
             out = self.model.generate(**inp, **kwargs)
         r = self.tokenizer.batch_decode(out)
@@ -100,10 +240,141 @@ class HuggingfaceGenerateResponse(GenerateResponse):
             resp = {'text': r[i][len(sentences[i]):], 'finish_reason': 'length'}
             if out[i][-1] == self.tokenizer.eos_token_id or out[i][-1] == self.tokenizer.pad_token_id:
                 resp['finish_reason'] = 'stop'
+            if criteria is not None and criteria.stopped[i]:
+                resp['finish_reason'] = 'stop'
             res[i] = resp
-        
+
         return res
     
+    def _speculative(self, sentence: str, stop_at_call=None, **kwargs) -> Dict[str, str]:
+        from utils.speculative import speculative_generate
+        input_ids = self.tokenizer(sentence, add_special_tokens=False)["input_ids"]
+        criteria = None
+        if stop_at_call is not None:
+            from utils.stopping import CallBlockStoppingCriteria
+            criteria = CallBlockStoppingCriteria(self.tokenizer, len(input_ids), **stop_at_call)
+        max_new_tokens = kwargs.get("max_new_tokens") or self.model.generation_config.max_new_tokens or 256
+        eos_token_id = self.model.generation_config.eos_token_id or self.tokenizer.eos_token_id
+        output = speculative_generate(self.model, input_ids, self.draft, max_new_tokens, eos_token_id,
+                                      self.num_draft_tokens, stopping_criteria=criteria)
+        eos = eos_token_id if isinstance(eos_token_id, (list, tuple)) else [eos_token_id]
+        stopped = output[-1] in eos or (criteria is not None and criteria.stopped[0])
+        return {'text': self.tokenizer.decode(output),
+                'finish_reason': 'stop' if stopped else 'length'}
+
+    def stream(self, prefix: str, query: str, **kwargs):
+        if self.draft is not None and not kwargs.get("do_sample", self.model.generation_config.do_sample):
+            yield from super().stream(prefix, query, **kwargs)
+            return
+        import threading
+        from transformers import TextIteratorStreamer
+        sentence = self.tokenizer.apply_chat_template(
+            [
+                {"role": "system", "content": self.system_prompt},
+                {"role": "user", "content": prefix + query}
+            ],
+            tokenize=False,
+            add_generation_prompt=True,
+        )
+        inp = self.tokenizer([sentence], return_tensors="pt").to(self.model.device)
+        from transformers import StoppingCriteriaList
+        from utils.stopping import CallBlockStoppingCriteria, EventStoppingCriteria
+        # generation stops once the consumer closes the stream (e.g. the Planner after a failed call)
+        closed = threading.Event()
+        criteria = StoppingCriteriaList([EventStoppingCriteria(closed)])
+        criteria.extend(kwargs.pop("stopping_criteria", None) or [])
+        stop_at_call = kwargs.pop("stop_at_call", None)
+        if stop_at_call is not None:
+            criteria.append(CallBlockStoppingCriteria(self.tokenizer, inp["input_ids"].size(1), **stop_at_call))
+        # seconds to wait for the next piece before queue.Empty is raised
+        timeout = kwargs.pop("timeout", 600.0)
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=timeout)
+        errors = []
+
+        def generate():
+            try:
+                self.model.generate(**inp, **kwargs, stopping_criteria=criteria, streamer=streamer)
+            except BaseException as e:
+                errors.append(e)
+                # the streamer would wait for its end forever
+                streamer.end()
+
+        thread = threading.Thread(target=generate, daemon=True)
+        thread.start()
+        try:
+            yield from streamer
+        finally:
+            closed.set()
+            thread.join()
+        if errors:
+            raise errors[0]
+
+
+class ServingGenerateResponse(GenerateResponse):
+    """
+    same interface as HuggingfaceGenerateResponse, but the queries are submitted to a shared
+    ContinuousBatchingEngine (see utils/serving.py) instead of running model.generate on them as one batch.
+    many callers (threads of the data collector, the Planner, LLMRetriever...) can use the same instance
+    at the same time and their requests are batched together by the engine.
+    engine: an existing engine to share, one is created from model and tokenizer if None.
+    usage:
+        generate_response = ServingGenerateResponse(tokenizer, model, system_prompt, max_batch_size=16)
+        r = generate_response(prefix, queries, max_new_tokens=200)
+        generate_response.close()
+
+    supported kwargs: max_new_tokens, do_sample, temperature, top_p and stop_at_call (see HuggingfaceGenerateResponse).
+    """
+    def __init__(self, tokenizer: PreTrainedTokenizer, model: AutoModelForCausalLM, system_prompt: str,
+                 engine=None, max_batch_size: int = 16, max_prefill_tokens: int = 8192):
+        super().__init__()
+        from utils.serving import ContinuousBatchingEngine
+        self.tokenizer = tokenizer
+        self.model = model
+        self.system_prompt = system_prompt
+        self.engine = engine or ContinuousBatchingEngine(model, tokenizer, max_batch_size, max_prefill_tokens)
+
+    def __call__(self, prefix: str, queries: List[str], **kwargs):
+        stop_at_call = kwargs.pop("stop_at_call", None)
+        kwargs = {k: v for k, v in kwargs.items() if k in ("max_new_tokens", "do_sample", "temperature", "top_p")
+                  and v is not None}
+        sentences = [
+            self.tokenizer.apply_chat_template(
+                [
+                    {"role": "system", "content": self.system_prompt},
+                    {"role": "user", "content": prefix + q}
+                ],
+                tokenize=False,
+                add_generation_prompt=True,
+            ) for q in queries
+        ]
+        prompts = self.tokenizer(sentences, add_special_tokens=False)["input_ids"]
+        if stop_at_call is None:
+            return self.engine.generate(prompts, **kwargs)
+        from utils.stopping import CallBlockDetector
+        handles = [self.engine.submit(prompt, stop=CallBlockDetector(**stop_at_call), **kwargs) for prompt in prompts]
+        return [handle.result() for handle in handles]
+
+    def stream(self, prefix: str, query: str, **kwargs):
+        stop_at_call = kwargs.pop("stop_at_call", None)
+        kwargs = {k: v for k, v in kwargs.items() if k in ("max_new_tokens", "do_sample", "temperature", "top_p")
+                  and v is not None}
+        sentence = self.tokenizer.apply_chat_template(
+            [
+                {"role": "system", "content": self.system_prompt},
+                {"role": "user", "content": prefix + query}
+            ],
+            tokenize=False,
+            add_generation_prompt=True,
+        )
+        prompt = self.tokenizer(sentence, add_special_tokens=False)["input_ids"]
+        if stop_at_call is not None:
+            from utils.stopping import CallBlockDetector
+            kwargs["stop"] = CallBlockDetector(**stop_at_call)
+        yield from self.engine.submit(prompt, **kwargs)
+
+    def close(self):
+        self.engine.close()
+
 
 class Tokenizer(ABC):
     """
@@ -111,6 +382,7 @@ class Tokenizer(ABC):
     
     tokenize(sentence: str)-> List[str]: tokenize the sentence to a list of tokens.
     detokenize(tokens: List[str])-> str: detokenize the tokens to a sentence.
+    tokenize_batch(sentences: List[str])-> List[List[str]]: tokenize many sentences at once.
     """
     @abstractmethod
     def tokenize(self, sentence: str)-> List[str]:
@@ -120,6 +392,9 @@ class Tokenizer(ABC):
     def detokenize(self, tokens: List[str])-> str:
         pass
     
+    def tokenize_batch(self, sentences: List[str])-> List[List[str]]:
+        return [self.tokenize(sentence) for sentence in sentences]
+    
     
 class HuggingFaceTokenizer(Tokenizer):
     """
@@ -137,12 +412,121 @@ class HuggingFaceTokenizer(Tokenizer):
     def detokenize(self, tokens: List[str])-> str:
         return self.tokenizer.convert_tokens_to_string(tokens)
     
+    def tokenize_batch(self, sentences: List[str])-> List[List[str]]:
+        if not sentences:
+            return []
+        if not self.tokenizer.is_fast:
+            return super().tokenize_batch(sentences)
+        # one call into the rust tokenizer for the whole batch
+        encodings = self.tokenizer(sentences, add_special_tokens=False)
+        return [encodings.tokens(i) for i in range(len(sentences))]
+    
+
+from collections import OrderedDict
+import hashlib
+
+class CachedTokenizer(Tokenizer):
+    """
+    a Tokenizer wrapper that memoizes tokenization results in a bounded LRU keyed by the hash of the text,
+    and sends the cache misses of tokenize_batch through the wrapped tokenizer in one batch.
+    tokenizer: the Tokenizer to wrap.
+    maxsize: max number of cached sentences.
+    
+    save(path: str): persist the cache as compact arrays (a .npz file), e.g. next to the output jsonl of a
+        generation run, so that a resumed run does not have to tokenize the old sentences again.
+    load(path: str): load a cache written by save, does nothing if the file does not exist.
+    """
+    tokenizer: Tokenizer
+    maxsize: int
+    cache: "OrderedDict[bytes, List[str]]"
+    
+    def __init__(self, tokenizer: Tokenizer, maxsize: int = 100000):
+        self.tokenizer = tokenizer
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        
+    @staticmethod
+    def _key(sentence: str)-> bytes:
+        return hashlib.blake2b(sentence.encode("utf-8"), digest_size=16).digest()
+    
+    def _get(self, key: bytes)-> Optional[List[str]]:
+        tokens = self.cache.get(key)
+        if tokens is not None:
+            self.cache.move_to_end(key)
+            self.hits += 1
+        return tokens
+    
+    def _put(self, key: bytes, tokens: List[str]):
+        self.cache[key] = tokens
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+    
+    def tokenize(self, sentence: str)-> List[str]:
+        key = self._key(sentence)
+        tokens = self._get(key)
+        if tokens is None:
+            self.misses += 1
+            tokens = self.tokenizer.tokenize(sentence)
+            self._put(key, tokens)
+        return list(tokens)
+    
+    def detokenize(self, tokens: List[str])-> str:
+        return self.tokenizer.detokenize(tokens)
+    
+    def tokenize_batch(self, sentences: List[str])-> List[List[str]]:
+        keys = [self._key(sentence) for sentence in sentences]
+        results = [self._get(key) for key in keys]
+        missing = {}
+        for i, tokens in enumerate(results):
+            if tokens is None:
+                missing.setdefault(keys[i], sentences[i])
+        if missing:
+            self.misses += len(missing)
+            tokenized = dict(zip(missing.keys(), self.tokenizer.tokenize_batch(list(missing.values()))))
+            for key, tokens in tokenized.items():
+                self._put(key, tokens)
+            # from the tokenizer, a batch with more misses than maxsize evicts some of them again
+            results = [tokenized[key] if tokens is None else tokens for key, tokens in zip(keys, results)]
+        return [list(tokens) for tokens in results]
+    
+    def save(self, path: str):
+        vocab = {}
+        offsets = [0]
+        ids = []
+        for tokens in self.cache.values():
+            for token in tokens:
+                ids.append(vocab.setdefault(token, len(vocab)))
+            offsets.append(len(ids))
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f,
+                     keys=np.frombuffer(b"".join(self.cache.keys()), dtype=np.uint8).reshape(-1, 16),
+                     offsets=np.array(offsets, dtype=np.int64),
+                     ids=np.array(ids, dtype=np.int32),
+                     vocab=np.array(list(vocab.keys()), dtype=str))
+        os.replace(tmp_path, path)
+        
+    def load(self, path: str):
+        if not os.path.exists(path):
+            return
+        with np.load(path) as data:
+            vocab = data["vocab"].tolist()
+            offsets = data["offsets"]
+            ids = data["ids"]
+            for i, key in enumerate(data["keys"]):
+                self._put(key.tobytes(), [vocab[j] for j in ids[offsets[i]:offsets[i + 1]]])
+    
         
 class SimilarityRecord:
     """
     a record to record the sentences that have been added, and filter out the similar sentences.
     tokenizer: a Tokenizer that can tokenize the sentence to help calculate similarity.
     num_processes: number of processes to calculate similarity.
+        the processes are started once and keep their share of the record resident,
+        call close() (or clear() to reuse the record) when the record is no longer needed.
     
     updata(sentence: str, bound: float = 0.7)-> (str, float): check if the sentence is similar to the sentences in the record.
         if its similarity is larger than bound, return the most similar sentence and its similarity but not add the sentence to the record.
@@ -151,37 +535,176 @@ class SimilarityRecord:
     tokenizer: Tokenizer
     num_processes: int
     sentences: List[List[str]] # List of tokenized sentences
+    vocab: Dict[str, int] # token -> integer id used by the LCS engine
+    engine: LCSEngine
     
     def __init__(self, tokenizer: Tokenizer, num_processes: int=mp.cpu_count()):
         self.tokenizer = tokenizer
         self.num_processes = num_processes
         self.sentences = []
+        self.vocab = {}
+        self.engine = LCSEngine(num_processes)
         
-    @staticmethod
-    def _score(sentence: List[str], other_sentence: List[str])-> tuple[List[str], float]:
-        scores = rouge_scorer._score_lcs(sentence, other_sentence)
-        return other_sentence, scores.fmeasure
+    def _encode(self, sentence: List[str])-> np.ndarray:
+        ids = []
+        for token in sentence:
+            if token not in self.vocab:
+                self.vocab[token] = len(self.vocab) + 1 # 0 is reserved for padding
+            ids.append(self.vocab[token])
+        return np.array(ids, dtype=np.int32)
+    
+    def _append(self, sentence: List[str]):
+        self.sentences.append(sentence)
+        self.engine.add(self._encode(sentence))
         
     def update(self, sentence: str, bound: float = 0.7)-> tuple[str, float]:
         sentence = self.tokenizer.tokenize(sentence)
 
         if len(self.sentences) == 0:
-            self.sentences.append(sentence)
+            self._append(sentence)
             return ''.join(sentence), 0.0
 
-        with mp.Pool(self.num_processes) as pool:
-            scores = pool.map(partial(self._score, sentence), self.sentences)
-        
-        most_similar, score = max(scores, key=lambda x: x[1])
+        # sentences that cannot score above bound are pruned, so when the sentence is accepted the
+        # returned score is only the best among those that had a chance, still <= bound
+        idx, score = self.engine.best(self._encode(sentence), bound)
+        most_similar = self.sentences[idx]
         
         if score <= bound:
-            self.sentences.append(sentence)
+            self._append(sentence)
         
         return self.tokenizer.detokenize(most_similar), score
     
+    def update_batch(self, sentences: List[str], bound: float = 0.7)-> List[tuple[str, float]]:
+        """
+        same results as calling update on every sentence in order, but the whole batch is scored
+        against the record in a single pass of the engine. duplicates inside the batch are then
+        resolved in order against the sentences of the batch that were accepted before.
+        """
+        tokenized = self.tokenizer.tokenize_batch(sentences)
+        ids = [self._encode(sentence) for sentence in tokenized]
+        if self.sentences:
+            record_best = self.engine.best_many(ids, bound)
+        else:
+            record_best = [(-1, -1.0)] * len(ids)
+        
+        accepted = []
+        batch_scorer = LCSScorer()
+        results = []
+        for i, sentence in enumerate(tokenized):
+            record_idx, score = record_best[i]
+            batch_idx, batch_score = batch_scorer.best(ids[i], bound)
+            if record_idx < 0 and batch_idx < 0:
+                results.append((''.join(sentence), 0.0))
+                score = 0.0
+            elif batch_idx >= 0 and (record_idx < 0 or batch_score > score):
+                # on a tie the record sentence wins, it was added earlier
+                score = batch_score
+                results.append((self.tokenizer.detokenize(tokenized[accepted[batch_idx]]), score))
+            else:
+                results.append((self.tokenizer.detokenize(self.sentences[record_idx]), score))
+            
+            if score <= bound:
+                batch_scorer.add(len(accepted), ids[i])
+                accepted.append(i)
+        
+        for i in accepted:
+            self._append(tokenized[i])
+        return results
+    
     def add(self, sentence: str):
         sentence = self.tokenizer.tokenize(sentence)
+        self._append(sentence)
+    
+    def add_batch(self, sentences: List[str]):
+        for sentence in self.tokenizer.tokenize_batch(sentences):
+            self._append(sentence)
+        
+    def clear(self):
+        self.sentences = []
+        self.engine.clear()
+        
+    def close(self):
+        self.engine.close()
+        
+
+class LSHSimilarityRecord(SimilarityRecord):
+    """
+    an approximate SimilarityRecord for very large generation runs, it keeps the same
+    update(sentence, bound) contract but only looks at the sentences that a MinHash LSH index
+    over token shingles reports as candidates.
+    verify: if True, the candidates are re-checked with the exact ROUGE-L f-measure, so the
+        returned score is a ROUGE-L score and the only error is a near-duplicate missed by LSH.
+        if False, the returned score is the dice coefficient 2J / (1 + J) of the estimated jaccard
+        similarity J of the shingle sets, which is on the same scale as the ROUGE-L f-measure.
+    num_perm, bands, shingle_size: see `MinHashLSH`, bands=0 picks them for threshold.
+    threshold: the ROUGE-L bound the record is used with, a pair at the bound has a dice coefficient of at
+        least the bound, so a jaccard similarity of at least threshold / (2 - threshold).
+    """
+    lsh: MinHashLSH
+    verify: bool
+    
+    def __init__(self, tokenizer: Tokenizer, verify: bool = True, num_perm: int = 128, bands: int = 0,
+                 shingle_size: int = 1, threshold: float = 0.75):
+        # the exact engine is only used to re-check candidates, a single process is enough
+        super().__init__(tokenizer, num_processes=1)
+        self.verify = verify
+        if not bands:
+            bands = MinHashLSH.bands_for(num_perm, threshold / (2 - threshold))
+        self.lsh = MinHashLSH(num_perm, bands, shingle_size)
+        
+    def _append(self, sentence: List[str]):
+        ids = self._encode(sentence)
         self.sentences.append(sentence)
+        self.engine.add(ids)
+        self.lsh.add(ids)
+        
+    def update(self, sentence: str, bound: float = 0.7)-> tuple[str, float]:
+        sentence = self.tokenizer.tokenize(sentence)
+        ids = self._encode(sentence)
+        
+        rows, jaccard = self.lsh.candidates(ids)
+        if len(rows) and self.verify:
+            scores = self.engine.local.score(ids, rows)
+        else:
+            # the dice coefficient is on the same scale as the ROUGE-L f-measure (f <= dice of the token bags)
+            scores = 2 * jaccard / (1 + jaccard)
+        
+        if len(rows) == 0:
+            most_similar, score = [], 0.0
+        else:
+            i = int(np.argmax(scores))
+            most_similar, score = self.sentences[rows[i]], float(scores[i])
+        
+        if score <= bound:
+            self._append(sentence)
+        
+        return self.tokenizer.detokenize(most_similar), score
+    
+    def update_batch(self, sentences: List[str], bound: float = 0.7)-> List[tuple[str, float]]:
+        # the LSH lookups are cheap, check the sentences one by one
+        return [self.update(sentence, bound) for sentence in sentences]
+    
+    def clear(self):
+        super().clear()
+        self.lsh.clear()
+        
+
+def create_similarity_record(backend: str, tokenizer: Tokenizer, threshold: float = 0.75, **kwargs)-> SimilarityRecord:
+    """
+    backend: one of
+        - exact: SimilarityRecord, exact ROUGE-L against every sentence that could exceed the bound.
+        - lsh: LSHSimilarityRecord scoring LSH candidates by estimated jaccard similarity.
+        - lsh_verify: LSHSimilarityRecord re-checking LSH candidates with exact ROUGE-L.
+    threshold: the bound the record is used with, sizes the LSH bands (the exact record does not need it).
+    kwargs are passed to the record.
+    """
+    if backend == "exact":
+        return SimilarityRecord(tokenizer, **kwargs)
+    if backend == "lsh":
+        return LSHSimilarityRecord(tokenizer, verify=False, threshold=threshold, **kwargs)
+    if backend == "lsh_verify":
+        return LSHSimilarityRecord(tokenizer, verify=True, threshold=threshold, **kwargs)
+    raise ValueError(f"Unsupported similarity backend {backend}")
         
 
 from string import Template
@@ -328,6 +851,18 @@ class SimilarityFilter(DataFilter):
             logging.warning(f"{data[self.key]} is too similar to {most_similar}, score: {score}")
             return False
         
+    def filter(self, data: Iterable[Dict[str, str]])->Iterable[Dict[str, str]]:
+        # check the whole batch at once, accepts exactly what validate would accept item by item
+        data = list(self.preprocess(data))
+        results = self.similarity_record.update_batch([d[self.key] for d in data], self.bound)
+        for d, (most_similar, score) in zip(data, results):
+            if score <= self.bound:
+                yield d
+            else:
+                logging.warning(f"{d[self.key]} is too similar to {most_similar}, score: {score}")
+                if self.fail_callback:
+                    self.fail_callback(d)
+        
     def change_record(self, similarity_record: SimilarityRecord, key: str=None, bound: float=None):
         self.similarity_record = similarity_record
         if key:
@@ -337,20 +872,31 @@ class SimilarityFilter(DataFilter):
         
 
 from tqdm import tqdm
+import queue
 
 class LLMDataCollector:
+    """
+    pipeline_depth: if > 0, collect runs in pipelined mode, sampling/prompt building runs in a background thread
+        and pipeline_depth worker threads send the LLM requests, so up to pipeline_depth batches are outstanding
+        while the previous batch goes through the filters. the batches are still filtered in the order they
+        were sampled. the sampler is then called ahead of time (from the sampling thread, a sampler that is
+        changed while collecting has to lock itself), before the data of the previous batches has been consumed.
+        0 keeps the sequential sample -> generate -> filter loop.
+    """
     def __init__(self, prompt: Template,
                  sampler: Sampler,
                  data_filters: List[DataFilter],
                  generate_response: GenerateResponse,
                  num_queries: int = 1,
-                 verbose: bool = False):
+                 verbose: bool = False,
+                 pipeline_depth: int = 0):
         self.prompt = prompt
         self.sampler = sampler
         self.data_filters = data_filters
         self.generate_response = generate_response
         self.num_queries = num_queries
         self.verbose = verbose
+        self.pipeline_depth = pipeline_depth
     
     def add_filter(self, data_filter: DataFilter):
         self.data_filters.append(data_filter)
@@ -366,53 +912,149 @@ class LLMDataCollector:
         if generate_response:
             self.generate_response = generate_response
             
+    def _make_prompts(self)->Optional[List[str]]:
+        samples = [self.sampler.sample() for _ in range(self.num_queries)]
+        samples = [sample for sample in samples if sample is not None]
+        if not samples:
+            return None
+        prompts = [self.prompt.substitute(sample) for sample in samples]
+        if self.verbose:
+            for prompt in prompts:
+                logging.info(f"{Colors.OKBLUE}prompt: {prompt}{Colors.ENDC}\n\n\n")
+        return prompts
+    
+    def _sequential_batches(self)->Generator[Tuple[List[str], List[Dict[str, str]]], None, None]:
+        while True:
+            prompts = self._make_prompts()
+            if prompts is None:
+                return
+            yield prompts, self.generate_response('', prompts)
+            
+    def _pipelined_batches(self)->Generator[Tuple[List[str], List[Dict[str, str]]], None, None]:
+        stop = threading.Event()
+        prompt_queue = queue.Queue(maxsize=self.pipeline_depth)
+        response_queue = queue.Queue(maxsize=self.pipeline_depth)
+        
+        def put(q: queue.Queue, item)->bool:
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        
+        def get(q: queue.Queue):
+            while not stop.is_set():
+                try:
+                    return q.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            return None
+        
+        # batches are numbered as they are sampled, (n, None) or (n, exception) ends the stream after n batches,
+        # an exception is raised in the collecting thread once the batches before it are done
+        def sample_stage():
+            seq = 0
+            end = None
+            try:
+                while True:
+                    prompts = self._make_prompts()
+                    if prompts is None:
+                        break
+                    if not put(prompt_queue, (seq, prompts)):
+                        return
+                    seq += 1
+            except Exception as e:
+                end = e
+            put(response_queue, (seq, end))
+            for _ in range(self.pipeline_depth):
+                put(prompt_queue, None)
+            
+        def generate_stage():
+            while True:
+                task = get(prompt_queue)
+                if task is None:
+                    return
+                seq, prompts = task
+                try:
+                    item = (prompts, self.generate_response('', prompts))
+                except Exception as e:
+                    item = e
+                if not put(response_queue, (seq, item)):
+                    return
+        
+        threads = [threading.Thread(target=sample_stage, daemon=True)] + \
+                  [threading.Thread(target=generate_stage, daemon=True) for _ in range(self.pipeline_depth)]
+        for t in threads:
+            t.start()
+        try:
+            # the workers finish out of order
+            pending = {}
+            next_seq = 0
+            while True:
+                while next_seq not in pending:
+                    seq, item = response_queue.get()
+                    pending[seq] = item
+                item = pending.pop(next_seq)
+                next_seq += 1
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # batches still in flight are dropped
+            stop.set()
+            for t in threads:
+                t.join(timeout=1)
         
     def collect(self, num_data: int, desc: str = "collecting data", num_generated: int = 0,
                 once: bool = False, retry_num: int = 2, lower_num: int = 5)->Iterable[Dict[str, str]]:
         process_bar = tqdm(total=num_data, desc=desc)
         process_bar.update(num_generated)
         retry = retry_num
-        while num_generated < num_data:
-            samples = [self.sampler.sample() for _ in range(self.num_queries)]
-            samples = [sample for sample in samples if sample is not None]
-            if not samples:
-                break
-            prompts = [self.prompt.substitute(sample) for sample in samples]
-            if self.verbose:
-                for prompt in prompts:
-                    logging.info(f"{Colors.OKBLUE}prompt: {prompt}{Colors.ENDC}\n\n\n")
-            
-            responses = self.generate_response('', prompts)
-            
-            if self.verbose:
-                for prompt, response in zip(prompts, responses):
-                    logging.info(f"\033[32m prompt: {prompt} finish_reason: {response['finish_reason']}\033[0m\n\033[31mresponse: {response['text']}\033[0m\n\n")
-            
-            for filter_idx, filter in enumerate(self.data_filters):
-                # if self.verbose:
-                    # print(f"started filter: {filter_idx}: {filter}")
-                responses = filter.filter(responses)
-                # if self.verbose:
-                    # print(f"end filter: {filter_idx}")
+        if num_generated >= num_data:
+            return
+        
+        if self.pipeline_depth > 0 and not once:
+            batches = self._pipelined_batches()
+        else:
+            batches = self._sequential_batches()
             
-            num_filtered = 0
-            for response in responses:
+        try:
+            for prompts, responses in batches:
                 if self.verbose:
-                    logging.info(f"\033[34mresponse: {response}\033[0m]")
-                yield response
-                num_filtered += 1
-                num_generated += 1
-                process_bar.update(1)
-            
-            if num_filtered < lower_num:
-                retry -= 1
-                if retry <= 0:
-                    break
-            else:
-                retry = retry_num
+                    for prompt, response in zip(prompts, responses):
+                        logging.info(f"\033[32m prompt: {prompt} finish_reason: {response['finish_reason']}\033[0m\n\033[31mresponse: {response['text']}\033[0m\n\n")
                 
-            if once:
-                break
+                for filter_idx, filter in enumerate(self.data_filters):
+                    # if self.verbose:
+                        # print(f"started filter: {filter_idx}: {filter}")
+                    responses = filter.filter(responses)
+                    # if self.verbose:
+                        # print(f"end filter: {filter_idx}")
+                
+                num_filtered = 0
+                for response in responses:
+                    if self.verbose:
+                        logging.info(f"\033[34mresponse: {response}\033[0m]")
+                    yield response
+                    num_filtered += 1
+                    num_generated += 1
+                    process_bar.update(1)
+                
+                if num_filtered < lower_num:
+                    retry -= 1
+                    if retry <= 0:
+                        break
+                else:
+                    retry = retry_num
+                    
+                if once or num_generated >= num_data:
+                    break
+        finally:
+            batches.close()
             
 
 if __name__ == '__main__':